@@ -10,7 +10,11 @@ except PackageNotFoundError:
 finally:
     del version, PackageNotFoundError
 
+from .api import Evaluation, evaluate  # noqa: E402
+
 __all__ = [
+    "Evaluation",
+    "evaluate",
     "__copyright__",
     "__packagename__",
     "__version__",
@@ -0,0 +1,274 @@
+"""
+Accumulate the statistics needed for QC-FC, so that the connectivity matrices
+of new subjects can be added to a group without loading the matrices that were
+added before.
+
+The QC-FC partial correlations only depend on the sums of products between the
+edges, the motion metrics and the covariates. These sums are stored for each
+group, and sums from different batches of subjects can be added together.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+from patsy.highlevel import dmatrix
+
+from .base import ConnectivityMatrix, load_connectivity_array
+from .features.quality_control_connectivity import QCFCResult
+
+
+def make_covariate_frame(data_frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Make the covariates "age" and "gender" with the same model as `fit_qcfc_model`.
+
+    A categorical "gender" column is coded with one column per level instead of
+    relative to a reference level. This spans the same space as the model with an
+    intercept, but the columns of batches that contain different levels can be
+    aligned by name.
+    """
+    formula = "age + gender"
+    if not pd.api.types.is_numeric_dtype(data_frame["gender"]):
+        formula = "0 + gender + age"
+    return dmatrix(formula, data_frame, return_type="dataframe")
+
+
+@dataclass
+class QCFCAccumulator:
+    """
+    The sums of products needed to calculate QC-FC for a group of connectivity matrices.
+
+    Attributes:
+        region_count (int): The number of regions in the connectivity matrices.
+        metric_keys (list[str]): The keys of the motion metrics.
+        covariate_names (list[str]): The names of the covariate columns (see `make_covariate_frame`).
+        paths (list[str]): The connectivity matrices that have been added.
+        covariate_products (ndarray): The covariates multiplied with themselves.
+        edge_covariate_products (ndarray): The edges multiplied with the covariates, with one row per edge.
+        metric_covariate_products (ndarray): The metrics multiplied with the covariates, with one row per metric.
+        edge_metric_products (ndarray): The edges multiplied with the metrics, with one row per edge.
+        edge_squares (ndarray): The sum of squares of each edge.
+        metric_squares (ndarray): The sum of squares of each metric.
+    """
+
+    region_count: int
+    metric_keys: list[str]
+    covariate_names: list[str]
+    paths: list[str]
+    covariate_products: npt.NDArray[np.float64]
+    edge_covariate_products: npt.NDArray[np.float64]
+    metric_covariate_products: npt.NDArray[np.float64]
+    edge_metric_products: npt.NDArray[np.float64]
+    edge_squares: npt.NDArray[np.float64]
+    metric_squares: npt.NDArray[np.float64]
+
+    @classmethod
+    def empty(cls, region_count: int, metric_keys: Sequence[str]) -> QCFCAccumulator:
+        edge_count = region_count * (region_count - 1) // 2
+        metric_count = len(metric_keys)
+        return cls(
+            region_count=region_count,
+            metric_keys=list(metric_keys),
+            covariate_names=list(),
+            paths=list(),
+            covariate_products=np.zeros((0, 0)),
+            edge_covariate_products=np.zeros((edge_count, 0)),
+            metric_covariate_products=np.zeros((metric_count, 0)),
+            edge_metric_products=np.zeros((edge_count, metric_count)),
+            edge_squares=np.zeros(edge_count),
+            metric_squares=np.zeros(metric_count),
+        )
+
+    @property
+    def sample_count(self) -> int:
+        return len(self.paths)
+
+    def get_new(self, connectivity_matrices: Sequence[ConnectivityMatrix]) -> list[ConnectivityMatrix]:
+        """
+        Returns:
+            list[ConnectivityMatrix]: The connectivity matrices that have not been added yet.
+        """
+        paths = set(self.paths)
+        return [connectivity_matrix for connectivity_matrix in connectivity_matrices if str(connectivity_matrix.path) not in paths]
+
+    def get_removed(self, connectivity_matrices: Sequence[ConnectivityMatrix]) -> list[str]:
+        """
+        Returns:
+            list[str]: The paths that have been added, but are not among the connectivity matrices any more.
+                Their contributions cannot be subtracted from the sums.
+        """
+        paths = {str(connectivity_matrix.path) for connectivity_matrix in connectivity_matrices}
+        return [path for path in self.paths if path not in paths]
+
+    def add(
+        self,
+        data_frame: pd.DataFrame,
+        connectivity_matrices: Sequence[ConnectivityMatrix],
+        connectivity_array: npt.NDArray[np.float64] | None = None,
+    ) -> None:
+        """
+        Add connectivity matrices to the sums. Connectivity matrices that have already been added are skipped.
+
+        Parameters:
+            data_frame (pd.DataFrame): The data frame containing the covariates "age" and "gender". It needs to have
+                one row for each connectivity matrix.
+            connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to add.
+            connectivity_array (ndarray, optional): The lower triangles of the connectivity matrices as returned by
+                `load_connectivity_array`, if they were already loaded.
+        """
+        paths = set(self.paths)
+        is_new = np.asarray([str(connectivity_matrix.path) not in paths for connectivity_matrix in connectivity_matrices], dtype=bool)
+        if not is_new.any():
+            return
+        new_connectivity_matrices = [connectivity_matrix for connectivity_matrix, new in zip(connectivity_matrices, is_new) if new]
+        if len(set(str(connectivity_matrix.path) for connectivity_matrix in new_connectivity_matrices)) < len(new_connectivity_matrices):
+            raise ValueError("Connectivity matrices cannot be added more than once")
+
+        if connectivity_array is None:
+            connectivity_array = load_connectivity_array(new_connectivity_matrices)
+        elif not is_new.all():
+            connectivity_array = connectivity_array[:, is_new]
+        metrics = np.asarray(
+            [
+                [connectivity_matrix.metadata.get(metric_key, np.nan) for connectivity_matrix in new_connectivity_matrices]
+                for metric_key in self.metric_keys
+            ],
+            dtype=np.float64,
+        )
+        covariate_frame = make_covariate_frame(data_frame.loc[is_new])
+
+        self.merge(
+            QCFCAccumulator(
+                region_count=self.region_count,
+                metric_keys=self.metric_keys,
+                covariate_names=list(covariate_frame.columns),
+                paths=[str(connectivity_matrix.path) for connectivity_matrix in new_connectivity_matrices],
+                covariate_products=covariate_frame.T.to_numpy() @ covariate_frame.to_numpy(),
+                edge_covariate_products=connectivity_array @ covariate_frame.to_numpy(),
+                metric_covariate_products=metrics @ covariate_frame.to_numpy(),
+                edge_metric_products=connectivity_array @ metrics.T,
+                edge_squares=np.einsum("ij,ij->i", connectivity_array, connectivity_array),
+                metric_squares=np.einsum("ij,ij->i", metrics, metrics),
+            )
+        )
+
+    def merge(self, other: QCFCAccumulator) -> None:
+        """
+        Add the sums of another accumulator, for example from a different batch of subjects.
+
+        Covariate columns that only one of the accumulators has are treated as zero in the other one.
+        """
+        if other.region_count != self.region_count:
+            raise ValueError(f"Cannot merge accumulators with {other.region_count} and {self.region_count} regions")
+        if other.metric_keys != self.metric_keys:
+            raise ValueError(f"Cannot merge accumulators for metrics {other.metric_keys} and {self.metric_keys}")
+        duplicate_paths = set(self.paths) & set(other.paths)
+        if duplicate_paths:
+            raise ValueError(f"Cannot merge accumulators that both contain {sorted(duplicate_paths)}")
+
+        covariate_names = self.covariate_names + [name for name in other.covariate_names if name not in self.covariate_names]
+        self._extend_covariates(covariate_names)
+        indices = np.asarray([covariate_names.index(name) for name in other.covariate_names], dtype=np.int64)
+
+        self.covariate_products[np.ix_(indices, indices)] += other.covariate_products
+        self.edge_covariate_products[:, indices] += other.edge_covariate_products
+        self.metric_covariate_products[:, indices] += other.metric_covariate_products
+        self.edge_metric_products += other.edge_metric_products
+        self.edge_squares += other.edge_squares
+        self.metric_squares += other.metric_squares
+        self.paths.extend(other.paths)
+
+    def _extend_covariates(self, covariate_names: list[str]) -> None:
+        count = len(covariate_names) - len(self.covariate_names)
+        if count == 0:
+            return
+        self.covariate_products = np.pad(self.covariate_products, ((0, count), (0, count)))
+        self.edge_covariate_products = np.pad(self.edge_covariate_products, ((0, 0), (0, count)))
+        self.metric_covariate_products = np.pad(self.metric_covariate_products, ((0, 0), (0, count)))
+        self.covariate_names = covariate_names
+
+    def get_results(self) -> dict[str, QCFCResult]:
+        """
+        Calculate the QC-FC partial correlations from the sums.
+
+        Returns:
+            dict[str, QCFCResult]: The QCFC values between connectivity matrices and each metric.
+        """
+        inverse_covariate_products = np.linalg.pinv(self.covariate_products)
+        edge_projection = self.edge_covariate_products @ inverse_covariate_products
+        metric_projection = self.metric_covariate_products @ inverse_covariate_products
+
+        # Sums of products of the residuals after removing the covariates
+        edge_metric_residuals = self.edge_metric_products - edge_projection @ self.metric_covariate_products.T
+        edge_residuals = self.edge_squares - np.einsum("ij,ij->i", edge_projection, self.edge_covariate_products)
+        metric_residuals = self.metric_squares - np.einsum("ij,ij->i", metric_projection, self.metric_covariate_products)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlation = edge_metric_residuals / np.sqrt(np.outer(edge_residuals, metric_residuals))
+
+        return {
+            metric_key: QCFCResult(
+                region_count=self.region_count,
+                correlation=np.ascontiguousarray(correlation[:, k]),
+                sample_count=self.sample_count,
+            )
+            for k, metric_key in enumerate(self.metric_keys)
+        }
+
+    def save(self, path: Path) -> None:
+        """
+        Save the accumulator to a ".npz" file.
+
+        The file is written to a temporary path first and then renamed, so that
+        an interrupted run never leaves a partial file behind.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_name(f".{path.name}.tmp")
+        with temporary_path.open("wb") as file:
+            np.savez(
+                file,
+                region_count=np.asarray(self.region_count),
+                metric_keys=np.asarray(self.metric_keys, dtype=str),
+                covariate_names=np.asarray(self.covariate_names, dtype=str),
+                paths=np.asarray(self.paths, dtype=str),
+                covariate_products=self.covariate_products,
+                edge_covariate_products=self.edge_covariate_products,
+                metric_covariate_products=self.metric_covariate_products,
+                edge_metric_products=self.edge_metric_products,
+                edge_squares=self.edge_squares,
+                metric_squares=self.metric_squares,
+            )
+        temporary_path.replace(path)
+
+    @classmethod
+    def load_paths(cls, path: Path) -> list[str]:
+        """
+        Load the paths of the connectivity matrices that were added to an accumulator that was saved with `save`,
+        without reading its sums.
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            return arrays["paths"].tolist()
+
+    @classmethod
+    def load(cls, path: Path) -> QCFCAccumulator:
+        """
+        Load an accumulator that was saved with `save`.
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(
+                region_count=int(arrays["region_count"]),
+                metric_keys=arrays["metric_keys"].tolist(),
+                covariate_names=arrays["covariate_names"].tolist(),
+                paths=arrays["paths"].tolist(),
+                covariate_products=arrays["covariate_products"],
+                edge_covariate_products=arrays["edge_covariate_products"],
+                metric_covariate_products=arrays["metric_covariate_products"],
+                edge_metric_products=arrays["edge_metric_products"],
+                edge_squares=arrays["edge_squares"],
+                metric_squares=arrays["metric_squares"],
+            )
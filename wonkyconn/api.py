@@ -0,0 +1,166 @@
+"""
+Evaluate connectomes that are already in memory, without reading or writing files.
+
+The command line workflow uses the same functions for each group after loading
+the connectivity matrices and their metadata.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Mapping, Sequence
+
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+
+from .atlas import Atlas
+from .base import SparseConnectivityArray
+from .features.calculate_degrees_of_freedom import calculate_degrees_of_freedom_loss_from_metadata
+from .features.distance_dependence import calculate_distance_dependence
+from .features.influence import calculate_leave_one_out_influence
+from .features.quality_control_connectivity import (
+    QCFCModel,
+    QCFCResult,
+    calculate_median_absolute,
+    calculate_sparse_qcfc,
+    calculate_qcfc_percentage,
+    make_column_name,
+)
+
+
+@dataclass
+class Evaluation:
+    """
+    The metrics of a group of connectivity matrices.
+
+    Attributes:
+        record (dict[str, Any]): The metrics, as in one row of `metrics.tsv`.
+        qcfc (dict[str, QCFCResult]): The edge-level QC-FC values for each motion metric.
+        influence (pd.DataFrame | None): The influence of each subject, if `leave_one_out` was requested
+            (see `calculate_leave_one_out_influence`).
+    """
+
+    record: dict[str, Any]
+    qcfc: dict[str, QCFCResult]
+    influence: pd.DataFrame | None = None
+
+
+def to_connectivity_array(connectomes: npt.ArrayLike, overwrite: bool = False) -> npt.NDArray[np.float64]:
+    """
+    Convert connectomes to an array with one row per edge and one column per connectivity matrix.
+
+    Parameters:
+        connectomes (ArrayLike): Either a stack of square connectivity matrices with the shape
+            (matrix count, region count, region count), or the lower triangles of the connectivity
+            matrices with the shape (edge count, matrix count) in the order given by
+            `np.tril_indices(region_count, k=-1)`.
+        overwrite (bool, optional): Whether a lower triangle array can be returned without copying it,
+            so that it is overwritten by later calculations. Defaults to False.
+
+    Returns:
+        ndarray: The lower triangles of the connectivity matrices.
+    """
+    array = np.asarray(connectomes)
+    if array.ndim == 3:
+        matrix_count, region_count, other_region_count = array.shape
+        if region_count != other_region_count:
+            raise ValueError(f"Expected square connectivity matrices, but got the shape {array.shape}")
+        i, j = np.tril_indices(region_count, k=-1)
+        return np.ascontiguousarray(array[:, i, j].T, dtype=np.float64)
+    if array.ndim == 2:
+        if overwrite and array.dtype == np.float64:
+            return array
+        return np.array(array, dtype=np.float64)
+    raise ValueError(f"Expected a three-dimensional stack of connectivity matrices or a two-dimensional edge array, but got {array.ndim} dimensions")
+
+
+def summarize_qcfc(
+    qcfc_by_metric: Mapping[str, QCFCResult],
+    atlas: Atlas | npt.NDArray[np.float64] | None = None,
+) -> dict[str, Any]:
+    """
+    Calculate the QC-FC metrics of `metrics.tsv` for each motion metric.
+
+    The columns for the first motion metric have no suffix (see `make_column_name`).
+
+    Parameters:
+        qcfc_by_metric (Mapping[str, QCFCResult]): The QC-FC values for each motion metric.
+        atlas (Atlas | ndarray | None, optional): The atlas, or the distances between its regions as a matrix or
+            in the order of `np.tril_indices(region_count, k=-1)`, used for the distance dependence. Defaults to
+            None, which skips the distance dependence.
+
+    Returns:
+        dict[str, Any]: The metrics.
+    """
+    metric_keys = list(qcfc_by_metric.keys())
+    record: dict[str, Any] = dict()
+    for metric_key, qcfc in qcfc_by_metric.items():
+        record[make_column_name("median_absolute_qcfc", metric_key, metric_keys)] = calculate_median_absolute(qcfc.correlation)
+        record[make_column_name("percentage_significant_qcfc", metric_key, metric_keys)] = calculate_qcfc_percentage(qcfc)
+        if atlas is not None:
+            record[make_column_name("distance_dependence", metric_key, metric_keys)] = calculate_distance_dependence(qcfc, atlas)
+    return record
+
+
+def evaluate(
+    connectomes: npt.ArrayLike | SparseConnectivityArray,
+    motion: npt.ArrayLike | Mapping[str, npt.ArrayLike],
+    covariates: pd.DataFrame,
+    atlas: Atlas | npt.NDArray[np.float64] | None = None,
+    metadata: Sequence[Mapping[str, Any]] | None = None,
+    subjects: Sequence[str] | None = None,
+    leave_one_out: bool = False,
+    overwrite: bool = False,
+) -> Evaluation:
+    """
+    Evaluate the residual motion in a group of connectivity matrices.
+
+    Parameters:
+        connectomes (ArrayLike | SparseConnectivityArray): The connectivity matrices, as a stack of square matrices or
+            as an edge array (see `to_connectivity_array`), or the edges of sparse connectivity matrices. For sparse
+            connectivity matrices, QC-FC is calculated for the union of their edges, and each edge only uses the
+            connectivity matrices that contain it (see `calculate_sparse_qcfc`).
+        motion (ArrayLike | Mapping[str, ArrayLike]): The mean framewise displacement of each connectivity matrix,
+            or the values of several motion metrics by name. The first metric is used for the columns without suffix.
+        covariates (pd.DataFrame): The covariates "age" and "gender", with one row for each connectivity matrix.
+        atlas (Atlas | ndarray | None, optional): The atlas, or the distances between its regions as a matrix or in
+            the order of `np.tril_indices(region_count, k=-1)`, used for the distance dependence. Defaults to None,
+            which skips the distance dependence.
+        metadata (Sequence[Mapping[str, Any]] | None, optional): The metadata of each connectivity matrix, used for
+            the loss of degrees of freedom. Defaults to None, which skips the loss of degrees of freedom.
+        subjects (Sequence[str] | None, optional): The subject of each connectivity matrix, used for `leave_one_out`.
+            Defaults to the index of `covariates`.
+        leave_one_out (bool, optional): Whether to calculate the influence of each subject. Defaults to False.
+        overwrite (bool, optional): Whether an edge array can be overwritten instead of copied. Defaults to False.
+
+    Returns:
+        Evaluation: The metrics and the edge-level QC-FC values.
+    """
+    if not isinstance(motion, Mapping):
+        motion = dict(MeanFramewiseDisplacement=motion)
+
+    model: QCFCModel | None = None
+    if isinstance(connectomes, SparseConnectivityArray):
+        if leave_one_out:
+            raise ValueError("`leave_one_out` is not supported for sparse connectivity matrices")
+        qcfc_by_metric = calculate_sparse_qcfc(covariates, connectomes, motion)
+        region_count = connectomes.region_count
+    else:
+        connectivity_array = to_connectivity_array(connectomes, overwrite=overwrite)
+        model = QCFCModel.fit(covariates, connectivity_array, motion)
+        qcfc_by_metric = model.get_results()
+        region_count = model.region_count
+    record = summarize_qcfc(qcfc_by_metric, atlas)
+
+    if metadata is not None:
+        count = [region_count] * len(metadata)
+        record.update(calculate_degrees_of_freedom_loss_from_metadata(metadata, count)._asdict())
+
+    influence_frame: pd.DataFrame | None = None
+    if model is not None and leave_one_out:
+        if subjects is None:
+            subjects = [str(subject) for subject in covariates.index]
+        influence_frame = calculate_leave_one_out_influence(model, subjects)
+
+    return Evaluation(record=record, qcfc=qcfc_by_metric, influence=influence_frame)
@@ -9,6 +9,163 @@ import scipy
 from .logger import gc_log
 
 
+@dataclass
+class RegionDistance(ABC):
+    """
+    Abstract base class for a definition of the distance between the regions of an atlas.
+
+    Distances are calculated for the pairs of regions below the diagonal, in the order
+    given by `np.tril_indices(region_count, k=-1)`, so that the edges of connectivity
+    matrices can be matched to their distance without a full matrix of distances.
+
+    Attributes:
+        block_size (int): The number of pairs of regions to calculate at a time.
+    """
+
+    block_size: int = 2**22
+
+    @abstractmethod
+    def get_distance_vector(self, atlas: "Atlas") -> npt.NDArray[np.float64]:
+        """
+        Calculate the distances between the regions of an atlas.
+
+        Parameters:
+            atlas (Atlas): The atlas.
+
+        Returns:
+            npt.NDArray[np.float64]: The distance of each pair of regions below the diagonal.
+        """
+        raise NotImplementedError
+
+
+@dataclass
+class CentroidDistance(RegionDistance):
+    """
+    The Euclidean distance between the centroids of the regions in millimeters.
+    """
+
+    def get_distance_vector(self, atlas: "Atlas") -> npt.NDArray[np.float64]:
+        centroids = atlas.get_centroids()
+        n = len(centroids)
+        distance_vector = np.empty(n * (n - 1) // 2)
+        row_count = max(1, self.block_size // max(n, 1))
+        for start in range(1, n, row_count):
+            stop = min(start + row_count, n)
+            block = scipy.spatial.distance.cdist(centroids[start:stop], centroids[: stop - 1])
+            # Only the columns below the diagonal of each row
+            below_diagonal = np.tri(stop - start, stop - 1, k=start - 1, dtype=bool)
+            distance_vector[start * (start - 1) // 2 : stop * (stop - 1) // 2] = block[below_diagonal]
+        return distance_vector
+
+
+@dataclass
+class MinimumDistance(RegionDistance):
+    """
+    The minimum Euclidean distance between the surface voxels of the regions in millimeters.
+
+    The surface voxels of each region are put into a KD-tree, and the surface voxels of
+    the regions before it are looked up in it, in blocks of whole regions with about
+    `block_size` voxels. To avoid looking up every voxel, a ball and a box around the
+    surface of the region give a lower bound of the distance of each voxel. The voxel of
+    each other region that is closest to the center of the ball is looked up first, and
+    only the voxels whose lower bound is not larger than its distance are looked up after.
+    Regions that touch or overlap have a distance of at most one voxel. The distance
+    to a region without voxels is NaN.
+
+    Unlike `CentroidDistance`, the time does not only grow with the number of pairs of
+    regions. The lower bounds are calculated for each region and each surface voxel of
+    the atlas, so the time grows with the number of regions times the number of surface
+    voxels, which is slow for atlases with thousands of regions.
+    """
+
+    def get_distance_vector(self, atlas: "Atlas") -> npt.NDArray[np.float64]:
+        points = [nib.affines.apply_affine(atlas.image.affine, region_points) for region_points in atlas.get_surface_points()]
+        n = len(points)
+        counts = np.asarray([len(region_points) for region_points in points], dtype=np.int64)
+        all_points = np.concatenate(points) if n > 0 else np.empty((0, 3))
+        # The region of each point, so that the distances can be reduced to one per pair of regions
+        labels = np.repeat(np.arange(n), counts)
+        ends = np.cumsum(counts)
+        starts = ends - counts
+
+        # The ball and the box around the surface points of each region
+        centers = np.zeros((n, 3))
+        radii = np.zeros(n)
+        lower_corners = np.zeros((n, 3))
+        upper_corners = np.zeros((n, 3))
+        for i, region_points in enumerate(points):
+            if len(region_points) == 0:
+                continue
+            centers[i] = region_points.mean(axis=0)
+            radii[i] = np.sqrt(np.max(np.sum((region_points - centers[i]) ** 2, axis=1)))
+            lower_corners[i] = region_points.min(axis=0)
+            upper_corners[i] = region_points.max(axis=0)
+
+        # The first region of each block, so that each region is in a single block
+        block_starts = [0]
+        for i in range(n):
+            if ends[i] - starts[block_starts[-1]] >= self.block_size:
+                block_starts.append(i + 1)
+
+        distance_vector = np.full(n * (n - 1) // 2, np.inf)
+        for i in range(1, n):
+            if counts[i] == 0:
+                continue
+            tree = scipy.spatial.cKDTree(points[i])
+            # The distances from region i to the regions before it
+            row = distance_vector[i * (i - 1) // 2 : i * (i + 1) // 2]
+            for first, last in zip(block_starts, [*block_starts[1:], n]):
+                if first >= i:
+                    break
+                last = min(last, i)
+                if ends[last - 1] == starts[first]:
+                    continue  # Only regions without voxels
+
+                block_points = all_points[starts[first] : ends[last - 1]]
+                block_labels = labels[starts[first] : ends[last - 1]]
+
+                # Look up the point of each region that is closest to the center first
+                offsets = block_points - centers[i]
+                squared_center_distances = np.einsum("ij,ij->i", offsets, offsets)
+                regions = first + np.flatnonzero(counts[first:last])
+                closest = np.full(n, np.inf)
+                closest[regions] = np.minimum.reduceat(squared_center_distances, starts[regions] - starts[first])
+                (candidates,) = np.nonzero(squared_center_distances == closest[block_labels])
+                _, first_candidates = np.unique(block_labels[candidates], return_index=True)
+                seeds = candidates[first_candidates]
+                row[block_labels[seeds]], _ = tree.query(block_points[seeds], k=1)
+
+                # Only look up the points that can be closer than the first point
+                upper_bounds = row[block_labels]
+                (candidates,) = np.nonzero(squared_center_distances <= (upper_bounds + radii[i]) ** 2)
+                box_offsets = np.maximum(0, np.maximum(lower_corners[i] - block_points[candidates], block_points[candidates] - upper_corners[i]))
+                candidates = candidates[np.einsum("ij,ij->i", box_offsets, box_offsets) <= upper_bounds[candidates] ** 2]
+                distances, _ = tree.query(block_points[candidates], k=1)
+                np.minimum.at(row, block_labels[candidates], distances)
+        distance_vector[np.isinf(distance_vector)] = np.nan
+        return distance_vector
+
+
+# The definitions of the distance between regions that can be selected with `--region-distance`
+region_distances: dict[str, type[RegionDistance]] = dict(centroid=CentroidDistance, minimum=MinimumDistance)
+
+
+def get_surface_points(mask: npt.NDArray[np.bool_], offset: tuple[int, ...] = (0, 0, 0)) -> npt.NDArray[np.int64]:
+    """
+    Get the voxels of a region that have a neighbor outside of the region.
+
+    Parameters:
+        mask (ndarray): The voxels of the region.
+        offset (tuple[int, ...], optional): The position of the mask in the image. Defaults to (0, 0, 0).
+
+    Returns:
+        ndarray: The voxel indices of the surface, with one row per voxel.
+    """
+    padded = np.pad(mask, 1)
+    surface = padded & ~scipy.ndimage.binary_erosion(padded)
+    return np.argwhere(surface) - 1 + np.asarray(offset)
+
+
 @dataclass
 class Atlas(ABC):
     """
@@ -18,6 +175,7 @@ class Atlas(ABC):
         seg (str): The "seg" value that the atlas corresponds to. A "seg" uniquely
             identifies an atlas in a given space and resolution.
         image (nib.nifti1.Nifti1Image): The Nifti1Image object for the atlas file.
+        distance (RegionDistance): The definition of the distance between regions.
 
     """
 
@@ -25,6 +183,9 @@ class Atlas(ABC):
     image: nib.nifti1.Nifti1Image
 
     structure: npt.NDArray[np.bool_] = field(default_factory=lambda: np.ones((3, 3, 3), dtype=bool))
+    distance: RegionDistance = field(default_factory=CentroidDistance)
+
+    _distance_vector: npt.NDArray[np.float64] | None = field(default=None, init=False, repr=False, compare=False)
 
     @abstractmethod
     def get_centroid_points(self) -> npt.NDArray[np.float64]:
@@ -36,6 +197,26 @@ class Atlas(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def get_surface_points(self) -> list[npt.NDArray[np.int64]]:
+        """
+        Returns the voxels at the surface of each atlas region.
+
+        Returns:
+            list[npt.NDArray[np.int64]]: The voxel indices of each region, with one row per voxel.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_region_count(self) -> int:
+        """
+        Returns the number of regions of the atlas, which is the size of the connectivity matrices.
+
+        Returns:
+            int: The number of regions.
+        """
+        raise NotImplementedError
+
     def get_centroids(self) -> npt.NDArray[np.float64]:
         """
         Returns the centroid coordinates of the atlas regions.
@@ -47,25 +228,47 @@ class Atlas(ABC):
         centroid_coordinates = nib.affines.apply_affine(self.image.affine, centroid_points)
         return centroid_coordinates
 
+    def get_distance_vector(self) -> npt.NDArray[np.float64]:
+        """
+        Calculates the distances between the atlas regions, as defined by `distance`,
+        in the order given by `np.tril_indices(region_count, k=-1)`.
+
+        The result is cached, because calculating the distances can be slow.
+
+        Returns:
+            npt.NDArray[np.float64]: The distance of each pair of regions below the diagonal.
+        """
+        if self._distance_vector is None:
+            self._distance_vector = self.distance.get_distance_vector(self)
+        return self._distance_vector
+
     def get_distance_matrix(self) -> npt.NDArray[np.float64]:
         """
-        Calculates the pairwise distance matrix between the centroids
-        of the atlas regions.
+        Calculates the pairwise distance matrix between the atlas regions.
+
+        This needs memory for the square of the number of regions. Use
+        `get_distance_vector` for large atlases.
 
         Returns:
             npt.NDArray[np.float64]: The distance matrix.
         """
-        centroids = self.get_centroids()
-        return scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(centroids))
+        distance_vector = self.get_distance_vector()
+        n = int(round((1 + np.sqrt(1 + 8 * distance_vector.size)) / 2))
+        distance_matrix = np.zeros((n, n))
+        i, j = np.tril_indices(n, k=-1)
+        distance_matrix[i, j] = distance_matrix[j, i] = distance_vector
+        return distance_matrix
 
     @staticmethod
-    def create(seg: str, path: Path) -> "Atlas":
+    def create(seg: str, path: Path, distance: RegionDistance | None = None) -> "Atlas":
         """
         Create an Atlas object based based on it's "seg" value and path.
 
         Parameters:
             seg (str): The "seg" value.
             path (Path): The path to the image.
+            distance (RegionDistance | None, optional): The definition of the distance between regions.
+                Defaults to the distance between the centroids.
 
         Returns:
             Atlas: An instance of the Atlas class.
@@ -76,10 +279,13 @@ class Atlas(ABC):
         """
         image = nib.nifti1.load(path)
 
+        if distance is None:
+            distance = CentroidDistance()
+
         if image.ndim <= 3 or image.shape[3] == 1:
-            return DsegAtlas(seg, nib.funcs.squeeze_image(image))
+            return DsegAtlas(seg, nib.funcs.squeeze_image(image), distance=distance)
         else:
-            return ProbsegAtlas(seg, image)
+            return ProbsegAtlas(seg, image, distance=distance)
 
 
 @dataclass
@@ -87,6 +293,9 @@ class DsegAtlas(Atlas):
     def get_array(self) -> npt.NDArray[np.int64]:
         return np.asarray(self.image.dataobj, dtype=np.int64)
 
+    def get_region_count(self) -> int:
+        return int(self.get_array().max())
+
     def _check_single_connected_component(self, array: npt.NDArray[np.int64]) -> None:
         for i in range(1, array.max() + 1):
             mask = array == i
@@ -94,6 +303,18 @@ class DsegAtlas(Atlas):
             if num_features > 1:
                 gc_log.warning(f'Atlas "{self.seg}" region {i} has more than a single connected component')
 
+    def get_surface_points(self) -> list[npt.NDArray[np.int64]]:
+        array = self.get_array()
+        surface_points: list[npt.NDArray[np.int64]] = []
+        # Only look at the bounding box of each region
+        for i, slices in enumerate(scipy.ndimage.find_objects(array, max_label=self.get_region_count()), start=1):
+            if slices is None:
+                surface_points.append(np.empty((0, array.ndim), dtype=np.int64))
+                continue
+            offset = tuple(s.start for s in slices)
+            surface_points.append(get_surface_points(array[slices] == i, offset))
+        return surface_points
+
     def get_centroid_points(self) -> npt.NDArray[np.float64]:
         array = self.get_array()
         self._check_single_connected_component(array)
@@ -110,6 +331,9 @@ class DsegAtlas(Atlas):
 class ProbsegAtlas(Atlas):
     epsilon: float = 1e-6
 
+    def get_region_count(self) -> int:
+        return int(self.image.shape[3])
+
     def _get_centroid_point(self, i: int, array: npt.NDArray[np.float64]) -> tuple[float, ...]:
         mask = array > self.epsilon
         _, num_features = scipy.ndimage.label(mask, structure=self.structure)
@@ -117,5 +341,8 @@ class ProbsegAtlas(Atlas):
             gc_log.warning(f'Atlas "{self.seg}" region {i} has more than a single connected component')
         return scipy.ndimage.center_of_mass(array)
 
+    def get_surface_points(self) -> list[npt.NDArray[np.int64]]:
+        return [get_surface_points(image.get_fdata() > self.epsilon) for image in nib.funcs.four_to_three(self.image)]
+
     def get_centroid_points(self) -> npt.NDArray[np.float64]:
         return np.asarray([self._get_centroid_point(i, image.get_fdata()) for i, image in enumerate(nib.funcs.four_to_three(self.image))])
@@ -1,10 +1,77 @@
+from collections import defaultdict
 from dataclasses import dataclass
 from functools import cached_property
 from pathlib import Path
-from typing import Any
+from typing import Any, Mapping, Sequence
 
 import numpy as np
+import scipy.sparse
 from numpy import typing as npt
+from tqdm.auto import tqdm
+
+from .progress import progress
+
+hdf5_extensions: tuple[str, ...] = (".h5", ".hdf5")
+# Sparse connectivity matrices saved with `scipy.sparse.save_npz`
+sparse_extensions: tuple[str, ...] = (".npz",)
+
+
+def split_hdf5_path(path: Path) -> tuple[Path, str] | None:
+    """
+    Split a path that points to a dataset inside an HDF5 file.
+
+    Datasets inside HDF5 files are indexed with a path that continues past the
+    HDF5 file, for example "sub-1.h5/func/sub-1_seg-x_relmat".
+
+    Parameters:
+        path (Path): The path to split.
+
+    Returns:
+        tuple[Path, str] | None: The path to the HDF5 file and the name of the dataset
+            inside it, or None if the path does not point into an HDF5 file.
+    """
+    for parent in path.parents:
+        if parent.suffix in hdf5_extensions:
+            return parent, path.relative_to(parent).as_posix()
+    return None
+
+
+def get_region_count(edge_count: int) -> int:
+    """
+    Get the number of regions from the number of edges below the diagonal.
+
+    >>> get_region_count(4950)
+    100
+    """
+    return int(round((1 + np.sqrt(1 + 8 * edge_count)) / 2))
+
+
+def get_edge_indices(i: npt.ArrayLike, j: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    """
+    Get the position of edges in the order given by `np.tril_indices(n, k=-1)`, which does not depend on `n`.
+
+    >>> get_edge_indices([1, 2, 0], [0, 1, 3])
+    array([0, 2, 3])
+    """
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    row = np.maximum(i, j)
+    return row * (row - 1) // 2 + np.minimum(i, j)
+
+
+def get_edge_coordinates(edge_indices: npt.ArrayLike) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    """
+    Get the row and column below the diagonal of edges from their position (see `get_edge_indices`).
+
+    >>> get_edge_coordinates([0, 2, 3])
+    (array([1, 2, 3]), array([0, 1, 0]))
+    """
+    edge_indices = np.asarray(edge_indices, dtype=np.int64)
+    i = ((1 + np.sqrt(1 + 8 * edge_indices.astype(np.float64))) // 2).astype(np.int64)
+    # Correct for rounding errors of the square root
+    i -= i * (i - 1) // 2 > edge_indices
+    i += (i + 1) * i // 2 <= edge_indices
+    return i, edge_indices - i * (i - 1) // 2
 
 
 @dataclass
@@ -13,28 +80,435 @@ class ConnectivityMatrix:
     Represents a connectivity matrix.
 
     Attributes:
-        path (Path): The path to the ".tsv" file containing the connectivity matrix.
+        path (Path): The path to the ".tsv" file containing the connectivity matrix,
+            to a dataset inside an HDF5 file (see `split_hdf5_path`), or to a sparse
+            matrix saved with `scipy.sparse.save_npz`.
         metadata (dict[str, Any]): Additional metadata associated with the connectivity matrix.
     """
 
     path: Path
     metadata: dict[str, Any]
 
+    @property
+    def is_sparse(self) -> bool:
+        return self.path.suffix in sparse_extensions
+
     def load(self) -> npt.NDArray[np.float64]:
         """
         Load the connectivity matrix from the file.
 
         Returns:
-            ndarray: The loaded connectivity matrix as a NumPy array.
+            ndarray: The loaded connectivity matrix as a NumPy array. For a sparse
+                connectivity matrix, the edges that are not stored are NaN.
+        """
+        if self.is_sparse:
+            n = self.region_count
+            array = np.full((n, n), np.nan)
+            np.fill_diagonal(array, 1)
+            edge_indices, values = self.load_edges()
+            i, j = get_edge_coordinates(edge_indices)
+            array[i, j] = array[j, i] = values
+            return array
+        hdf5_path = split_hdf5_path(self.path)
+        if hdf5_path is not None:
+            import h5py
+
+            file_path, name = hdf5_path
+            with h5py.File(file_path, "r") as file:
+                dataset = file[name]
+                progress.add_matrix(dataset.size * dataset.dtype.itemsize)
+                if dataset.ndim == 1:  # Stored as a lower triangle
+                    lower_triangle = np.asarray(dataset[:], dtype=np.float64)
+                    n = self.region_count
+                    array = np.eye(n)
+                    i, j = np.tril_indices(n, k=-1)
+                    array[i, j] = lower_triangle
+                    array[j, i] = lower_triangle
+                    return array
+                return np.asarray(dataset[:], dtype=np.float64)
+        array = np.loadtxt(self.path, delimiter="\t", skiprows=1)
+        progress.add_matrix(self.path.stat().st_size)
+        return array
+
+    def load_lower_triangle(self) -> npt.NDArray[np.float64]:
         """
-        return np.loadtxt(self.path, delimiter="\t", skiprows=1)
+        Load the values below the diagonal of the connectivity matrix.
+
+        For HDF5 datasets only the lower triangle is read from disk, one block of
+        rows at a time.
+
+        Returns:
+            ndarray: The values in the order given by `np.tril_indices(n, k=-1)`.
+        """
+        if self.is_sparse:
+            lower_triangle = np.full(self.region_count * (self.region_count - 1) // 2, np.nan)
+            edge_indices, values = self.load_edges()
+            lower_triangle[edge_indices] = values
+            return lower_triangle
+
+        hdf5_path = split_hdf5_path(self.path)
+        if hdf5_path is None:
+            i, j = np.tril_indices(self.region_count, k=-1)
+            return self.load()[i, j]
+
+        import h5py
+
+        file_path, name = hdf5_path
+        with h5py.File(file_path, "r") as file:
+            dataset = file[name]
+            if dataset.ndim == 1:  # Stored as a lower triangle
+                progress.add_matrix(dataset.size * dataset.dtype.itemsize)
+                return np.asarray(dataset[:], dtype=np.float64)
+
+            n = dataset.shape[0]
+            if dataset.chunks is not None:
+                block_size = dataset.chunks[0]
+            else:
+                block_size = max(1, 2**20 // n)
+
+            rows: list[npt.NDArray[np.float64]] = []
+            read_count = 0
+            for start in range(1, n, block_size):
+                stop = min(start + block_size, n)
+                # Only read the columns that are below the diagonal for this block
+                block = np.asarray(dataset[start:stop, : stop - 1], dtype=np.float64)
+                rows.extend(block[k, : start + k] for k in range(stop - start))
+                read_count += block.size
+            progress.add_matrix(read_count * dataset.dtype.itemsize)
+            return np.concatenate(rows) if rows else np.empty(0)
+
+    def load_lower_triangle_sample(self, edge_indices: npt.NDArray[np.int64]) -> npt.NDArray[np.float64]:
+        """
+        Load selected values below the diagonal of the connectivity matrix.
+
+        For HDF5 datasets only the selected values, or the rows that contain them, are
+        read from disk. Text files need to be read completely.
+
+        Parameters:
+            edge_indices (ndarray): The sorted positions of the edges to load (see `get_edge_indices`).
+
+        Returns:
+            ndarray: The values of the edges. For a sparse connectivity matrix, the edges that are not stored are NaN.
+        """
+        if self.is_sparse:
+            stored_edge_indices, values = self.load_edges()
+            lower_triangle_sample = np.full(edge_indices.size, np.nan)
+            positions = np.searchsorted(stored_edge_indices, edge_indices)
+            found = positions < stored_edge_indices.size
+            found[found] = stored_edge_indices[positions[found]] == edge_indices[found]
+            lower_triangle_sample[found] = values[positions[found]]
+            return lower_triangle_sample
+
+        hdf5_path = split_hdf5_path(self.path)
+        if hdf5_path is None:
+            return self.load_lower_triangle()[edge_indices]
+
+        import h5py
+
+        file_path, name = hdf5_path
+        with h5py.File(file_path, "r") as file:
+            dataset = file[name]
+            if edge_indices.size == 0:
+                progress.add_matrix(0)
+                return np.empty(0)
+            if dataset.ndim == 1:  # Stored as a lower triangle
+                progress.add_matrix(edge_indices.size * dataset.dtype.itemsize)
+                return np.asarray(dataset[edge_indices], dtype=np.float64)
+
+            i, j = get_edge_coordinates(edge_indices)
+            rows, row_positions = np.unique(i, return_inverse=True)
+            block = np.asarray(dataset[rows, : j.max() + 1], dtype=np.float64)
+            progress.add_matrix(block.size * dataset.dtype.itemsize)
+            return block[row_positions, j]
+
+    def load_edges(self) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]]:
+        """
+        Load the edges that are stored in a sparse connectivity matrix.
+
+        Entries on or above the diagonal are mapped to the lower triangle, and entries
+        that are NaN are treated as missing. Edges that are stored with the value zero
+        are present.
+
+        Returns:
+            tuple[ndarray, ndarray]: The sorted positions of the edges (see `get_edge_indices`) and their values.
+        """
+        if not self.is_sparse:
+            lower_triangle = self.load_lower_triangle()
+            edge_indices = np.flatnonzero(~np.isnan(lower_triangle))
+            return edge_indices, lower_triangle[edge_indices]
+
+        matrix = scipy.sparse.load_npz(self.path).tocoo()
+        progress.add_matrix(self.path.stat().st_size)
+        off_diagonal = (matrix.row != matrix.col) & ~np.isnan(matrix.data)
+        edge_indices = get_edge_indices(matrix.row[off_diagonal], matrix.col[off_diagonal])
+        # Symmetric matrices store each edge twice
+        edge_indices, unique = np.unique(edge_indices, return_index=True)
+        return edge_indices, np.asarray(matrix.data[off_diagonal][unique], dtype=np.float64)
 
     @cached_property
     def region_count(self) -> int:
         """
         Get the number of regions in the connectivity matrix.
 
+        The count is taken from the header of the ".tsv" file or from the
+        shape of the HDF5 dataset or sparse matrix, so that the matrix does
+        not need to be loaded.
+
         Returns:
             int: The number of regions.
         """
-        return self.load().shape[0]
+        if self.is_sparse:
+            with np.load(self.path) as arrays:
+                rows, columns = arrays["shape"]
+            if rows != columns:
+                raise ValueError(f'Expected a square connectivity matrix in "{self.path}", but got the shape {(rows, columns)}')
+            return int(rows)
+
+        hdf5_path = split_hdf5_path(self.path)
+        if hdf5_path is not None:
+            import h5py
+
+            file_path, name = hdf5_path
+            with h5py.File(file_path, "r") as file:
+                shape = file[name].shape
+            if len(shape) == 1:  # Stored as a lower triangle of length n * (n - 1) / 2
+                return get_region_count(shape[0])
+            return shape[0]
+
+        with self.path.open("r") as file:
+            header = file.readline()
+        return len(header.rstrip("\n").split("\t"))
+
+
+def load_connectivity_array(connectivity_matrices: Sequence[ConnectivityMatrix]) -> npt.NDArray[np.float64]:
+    """
+    Load the lower triangles of connectivity matrices into a single array.
+
+    Parameters:
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to load.
+            They need to have the same number of regions.
+
+    Returns:
+        ndarray: An array with one row per edge and one column per connectivity matrix.
+    """
+    n = get_group_region_count(connectivity_matrices)
+
+    connectivity_array = np.empty((n * (n - 1) // 2, len(connectivity_matrices)))
+    for k, connectivity_matrix in enumerate(
+        tqdm(
+            connectivity_matrices,
+            desc="Loading connectivity matrices",
+            leave=False,
+        )
+    ):
+        connectivity_array[:, k] = connectivity_matrix.load_lower_triangle()
+    return connectivity_array
+
+
+def map_connectivity_array(connectivity_matrices: Sequence[ConnectivityMatrix], path: Path) -> np.memmap:
+    """
+    Save the lower triangles of connectivity matrices into a memory-mapped array, loading one at a time,
+    so that blocks of edges can be read later without loading all connectivity matrices.
+
+    Parameters:
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to save.
+            They need to have the same number of regions.
+        path (Path): The ".npy" file for the array.
+
+    Returns:
+        np.memmap: An array with one row per edge and one column per connectivity matrix. The columns are
+            contiguous, so that each connectivity matrix is written in one piece.
+    """
+    n = get_group_region_count(connectivity_matrices)
+
+    connectivity_array = np.lib.format.open_memmap(
+        path,
+        mode="w+",
+        dtype=np.float64,
+        shape=(n * (n - 1) // 2, len(connectivity_matrices)),
+        fortran_order=True,
+    )
+    for k, connectivity_matrix in enumerate(
+        tqdm(
+            connectivity_matrices,
+            desc="Saving connectivity matrices",
+            leave=False,
+        )
+    ):
+        connectivity_array[:, k] = connectivity_matrix.load_lower_triangle()
+    connectivity_array.flush()
+    return connectivity_array
+
+
+@dataclass
+class EdgeStore:
+    """
+    The lower triangles of connectivity matrices that are loaded once and shared by several groups.
+    Groups can also contain connectivity matrices that are not in the store, which are loaded when needed.
+
+    Attributes:
+        columns (dict[Path, int]): The column of each connectivity matrix, by path.
+        connectivity_arrays (dict[int, ndarray]): For each number of regions, an array with one row per edge and
+            one column per connectivity matrix.
+    """
+
+    columns: dict[Path, int]
+    connectivity_arrays: dict[int, npt.NDArray[np.float64]]
+
+    @staticmethod
+    def get_size(connectivity_matrices: Sequence[ConnectivityMatrix], keys: Mapping[Path, str] | None = None) -> int:
+        """
+        Returns:
+            int: The number of bytes that `load` needs for the connectivity matrices.
+        """
+        unique = {
+            connectivity_matrix.path if keys is None else keys[connectivity_matrix.path]: connectivity_matrix
+            for connectivity_matrix in connectivity_matrices
+        }.values()
+        return sum(np.dtype(np.float64).itemsize * (c.region_count * (c.region_count - 1) // 2) for c in unique)
+
+    @classmethod
+    def load(cls, connectivity_matrices: Sequence[ConnectivityMatrix], keys: Mapping[Path, str] | None = None) -> "EdgeStore":
+        """
+        Load connectivity matrices. Connectivity matrices with the same path are only loaded once.
+
+        Parameters:
+            connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to load.
+            keys (Mapping[Path, str] | None, optional): A key for each connectivity matrix by path, such as
+                its fingerprint (see `wonkyconn.deduplicate`). Connectivity matrices with the same key share
+                one column. Defaults to None, which only shares the columns of the same path.
+        """
+        by_region_count: dict[int, dict[Path | str, ConnectivityMatrix]] = defaultdict(dict)
+        for connectivity_matrix in connectivity_matrices:
+            key = connectivity_matrix.path if keys is None else keys[connectivity_matrix.path]
+            by_region_count[connectivity_matrix.region_count].setdefault(key, connectivity_matrix)
+
+        columns: dict[Path, int] = dict()
+        connectivity_arrays: dict[int, npt.NDArray[np.float64]] = dict()
+        for region_count, unique in by_region_count.items():
+            column_by_key = {key: k for k, key in enumerate(unique.keys())}
+            for connectivity_matrix in connectivity_matrices:
+                if connectivity_matrix.region_count == region_count:
+                    key = connectivity_matrix.path if keys is None else keys[connectivity_matrix.path]
+                    columns[connectivity_matrix.path] = column_by_key[key]
+            connectivity_arrays[region_count] = load_connectivity_array(list(unique.values()))
+        return cls(columns=columns, connectivity_arrays=connectivity_arrays)
+
+    def get(self, connectivity_matrices: Sequence[ConnectivityMatrix]) -> npt.NDArray[np.float64]:
+        """
+        Returns:
+            ndarray: A copy of the columns for the connectivity matrices, which can be overwritten. The connectivity
+                matrices that are not in the store are loaded from disk.
+        """
+        n = get_group_region_count(connectivity_matrices)
+        stored = [k for k, connectivity_matrix in enumerate(connectivity_matrices) if connectivity_matrix.path in self.columns]
+        columns = [self.columns[connectivity_matrices[k].path] for k in stored]
+        if len(stored) == len(connectivity_matrices):
+            return self.connectivity_arrays[n][:, columns]
+
+        connectivity_array = np.empty((n * (n - 1) // 2, len(connectivity_matrices)))
+        if stored:
+            connectivity_array[:, stored] = self.connectivity_arrays[n][:, columns]
+        for k, connectivity_matrix in enumerate(connectivity_matrices):
+            if connectivity_matrix.path not in self.columns:
+                connectivity_array[:, k] = connectivity_matrix.load_lower_triangle()
+        return connectivity_array
+
+
+def get_group_region_count(connectivity_matrices: Sequence[ConnectivityMatrix]) -> int:
+    """
+    Get the number of regions of a group of connectivity matrices, which needs to be the same for all of them.
+    """
+    region_counts = set(connectivity_matrix.region_count for connectivity_matrix in connectivity_matrices)
+    if len(region_counts) != 1:
+        raise ValueError(f"Expected connectivity matrices with the same number of regions, but got {sorted(region_counts)}")
+    (n,) = region_counts
+    return n
+
+
+def is_sparse_group(connectivity_matrices: Sequence[ConnectivityMatrix]) -> bool:
+    """
+    Whether a group consists of sparse connectivity matrices. Sparse and dense connectivity matrices cannot be mixed.
+    """
+    sparse = set(connectivity_matrix.is_sparse for connectivity_matrix in connectivity_matrices)
+    if len(sparse) > 1:
+        raise ValueError("Sparse and dense connectivity matrices cannot be evaluated in the same group")
+    return sparse == {True}
+
+
+@dataclass
+class SparseConnectivityArray:
+    """
+    The edges of sparse connectivity matrices, for the union of the edges that are present in any of them.
+
+    Memory scales with the number of stored edges instead of the number of regions squared.
+    Edges that are missing from a connectivity matrix are not stored, so they can be told
+    apart from edges with the value zero.
+
+    Attributes:
+        region_count (int): The number of regions in the connectivity matrices.
+        edge_indices (ndarray): The sorted positions of the edges (see `get_edge_indices`).
+        values (scipy.sparse.csr_matrix): The values, with one row per edge and one column per connectivity matrix.
+        present (scipy.sparse.csr_matrix): One for the values that are present, with the same structure as `values`.
+    """
+
+    region_count: int
+    edge_indices: npt.NDArray[np.int64]
+    values: scipy.sparse.csr_matrix
+    present: scipy.sparse.csr_matrix
+
+    @property
+    def edge_count(self) -> int:
+        return self.edge_indices.size
+
+    @property
+    def sample_count(self) -> int:
+        return self.values.shape[1]
+
+    @classmethod
+    def from_edges(
+        cls,
+        region_count: int,
+        edges: Sequence[tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]]],
+    ) -> "SparseConnectivityArray":
+        """
+        Parameters:
+            region_count (int): The number of regions in the connectivity matrices.
+            edges (Sequence[tuple[ndarray, ndarray]]): The positions and values of the edges of each connectivity matrix,
+                as returned by `ConnectivityMatrix.load_edges`.
+        """
+        edge_count = region_count * (region_count - 1) // 2
+        for edge_indices, _ in edges:
+            if edge_indices.size > 0 and edge_indices.max() >= edge_count:
+                raise ValueError(f"Edge positions need to be below {edge_count} for {region_count} regions")
+        if edges:
+            union = np.unique(np.concatenate([edge_indices for edge_indices, _ in edges]))
+        else:
+            union = np.empty(0, dtype=np.int64)
+        rows = np.concatenate([np.searchsorted(union, edge_indices) for edge_indices, _ in edges] or [np.empty(0, dtype=np.int64)])
+        columns = np.repeat(np.arange(len(edges)), [edge_indices.size for edge_indices, _ in edges])
+        data = np.concatenate([values for _, values in edges] or [np.empty(0)])
+        values = scipy.sparse.csr_matrix((data, (rows, columns)), shape=(union.size, len(edges)))
+        values.sort_indices()
+        present = scipy.sparse.csr_matrix((np.ones_like(values.data), values.indices, values.indptr), shape=values.shape)
+        return cls(region_count=region_count, edge_indices=union, values=values, present=present)
+
+
+def load_sparse_connectivity_array(connectivity_matrices: Sequence[ConnectivityMatrix]) -> SparseConnectivityArray:
+    """
+    Load the edges of sparse connectivity matrices (see `SparseConnectivityArray`).
+
+    Parameters:
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to load.
+            They need to have the same number of regions.
+    """
+    n = get_group_region_count(connectivity_matrices)
+    edges = [
+        connectivity_matrix.load_edges()
+        for connectivity_matrix in tqdm(
+            connectivity_matrices,
+            desc="Loading connectivity matrices",
+            leave=False,
+        )
+    ]
+    return SparseConnectivityArray.from_edges(n, edges)
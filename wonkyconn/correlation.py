@@ -4,13 +4,170 @@ from numba import guvectorize
 from numpy import typing as npt
 
 
-def correlation_p_value(r: npt.NDArray[np.float64], m: int) -> npt.NDArray[np.float64]:
+def correlation_p_value(r: npt.NDArray[np.float64], m: int | npt.NDArray[np.int64]) -> npt.NDArray[np.float64]:
     ab = m / 2 - 1
     distribution = scipy.stats.beta(ab, ab, loc=-1, scale=2)
     pvalue = 2 * (distribution.sf(np.abs(r)))
     return pvalue
 
 
+def correlation_critical_value(m: int, alpha: float = 0.05) -> float:
+    """The absolute correlation above which the two-sided p-value is below `alpha`.
+
+    Comparing correlations to this value gives the same result as comparing
+    `correlation_p_value` to `alpha`, without evaluating the distribution for
+    every correlation.
+
+    Parameters
+    ----------
+    m : int
+        Number of observations.
+
+    alpha : float
+        Significance level.
+
+    Returns
+    -------
+    float
+        The critical absolute correlation.
+    """
+    ab = m / 2 - 1
+    distribution = scipy.stats.beta(ab, ab, loc=-1, scale=2)
+    return float(distribution.isf(alpha / 2))
+
+
+def correlation_significant(
+    r: npt.NDArray[np.float64],
+    m: int | npt.NDArray[np.int64],
+    alpha: float = 0.05,
+) -> npt.NDArray[np.bool_]:
+    """Whether the two-sided p-value of each correlation is below `alpha`.
+
+    The critical correlation is calculated once for each distinct number of observations.
+
+    Parameters
+    ----------
+    r : np.ndarray
+        Correlations.
+
+    m : int or np.ndarray
+        Number of observations, either for all correlations or for each correlation.
+
+    alpha : float
+        Significance level.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the significant correlations.
+    """
+    absolute = np.abs(r)
+    if np.ndim(m) == 0:
+        return absolute > correlation_critical_value(int(m), alpha)
+    values, inverse = np.unique(m, return_inverse=True)
+    critical_values = np.asarray([correlation_critical_value(int(value), alpha) for value in values])
+    return absolute > critical_values[inverse.reshape(absolute.shape)]
+
+
+def benjamini_hochberg(p: npt.NDArray[np.float64], alpha: float = 0.05) -> npt.NDArray[np.bool_]:
+    """Benjamini-Hochberg procedure for controlling the false discovery rate.
+
+    Gives the same result as `statsmodels.stats.multitest.multipletests` with
+    `method="fdr_bh"`. Missing p-values are never rejected and do not count as tests.
+
+    Parameters
+    ----------
+    p : np.ndarray
+        Uncorrected p-values.
+
+    alpha : float
+        False discovery rate.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the rejected hypotheses.
+    """
+    p = np.asarray(p)
+    finite = np.flatnonzero(np.isfinite(p))
+    order = finite[np.argsort(p[finite], kind="stable")]
+    thresholds = alpha * np.arange(1, order.size + 1) / order.size
+    (below,) = np.nonzero(p[order] <= thresholds)
+
+    reject = np.zeros(p.shape, dtype=bool)
+    if below.size > 0:
+        reject[order[: below[-1] + 1]] = True
+    return reject
+
+
+def residualize(
+    array: npt.NDArray[np.float64],
+    cov: npt.NDArray[np.float64],
+    block_size: int = 2**14,
+) -> npt.NDArray[np.float64]:
+    """Remove covariates from each row and scale the residuals to unit norm.
+
+    The dot product of two rows of the result is their partial correlation.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        Variables of interest, with one row per variable and one column per observation.
+        The array is overwritten with the result.
+
+    cov : np.ndarray
+        Variables to be removed, with one row per observation.
+
+    block_size : int
+        Number of rows to process at a time, to limit the size of temporary arrays.
+
+    Returns
+    -------
+    np.ndarray
+        The scaled residuals.
+    """
+    # Orthonormal basis of the covariates, dropping directions that are not spanned
+    u, s, _ = np.linalg.svd(cov, full_matrices=False)
+    q = u[:, s > s.max() * max(cov.shape) * np.finfo(np.float64).eps]
+    for start in range(0, array.shape[0], block_size):
+        block = array[start : start + block_size]
+        block -= (block @ q) @ q.T
+        block -= block.mean(axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block /= np.linalg.norm(block, axis=1, keepdims=True)
+    return array
+
+
+def partial_correlation_matrix(
+    x: npt.NDArray[np.float64],
+    y: npt.NDArray[np.float64],
+    cov: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    """Partial correlation between every row of `x` and every row of `y`.
+
+    Equivalent to calling `partial_correlation` for each pair of rows, but
+    the covariates are removed from each row only once, and all correlations
+    are calculated with a single matrix product.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Variables of interest, with one row per variable and one column per observation.
+        `x` is overwritten with its residuals.
+
+    cov : np.ndarray
+        Variable to be removed from variable of interest.
+
+    Returns
+    -------
+    np.ndarray
+        Correlation for each row of `x` (first dimension) and row of `y` (second dimension).
+    """
+    resid_x = residualize(x, cov)
+    resid_y = residualize(np.array(y, dtype=np.float64, ndmin=2), cov)
+    return resid_x @ resid_y.T
+
+
 @guvectorize(
     ["void(float64[:], float64[:], float64[:, :], float64[:])"],
     "(n),(n),(n,m)->()",
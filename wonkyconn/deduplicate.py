@@ -0,0 +1,174 @@
+"""
+Find connectivity matrices and groups with the same content.
+
+The same connectome can be reachable under different tags, for example through
+symlinked sessions, strategies that were exported twice, or copies across dataset
+versions. Each connectivity matrix is identified by a fingerprint of its size and a
+hash of evenly spaced samples of its content (see `get_fingerprint`), which is cheap
+to calculate for large files. Connectivity matrices with the same fingerprint are only
+loaded once, and groups with the same connectivity matrices, subjects and metadata
+are only evaluated once (see `find_duplicate_groups`).
+
+Two files that only differ outside of the sampled blocks get the same fingerprint.
+This is unlikely for connectivity matrices, which differ almost everywhere, but it
+is the reason why deduplication needs to be enabled with `--deduplicate`.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+from .base import ConnectivityMatrix, split_hdf5_path
+from .export import make_file_label
+from .file_index.bids import BIDSIndex
+from .validation import get_subject
+
+
+def get_file_fingerprint(path: Path, sample_count: int = 16, block_size: int = 2**12) -> str:
+    """
+    Fingerprint a file by its size and a hash of evenly spaced blocks. Small files are hashed completely.
+
+    Parameters:
+        path (Path): The file.
+        sample_count (int, optional): The number of blocks to hash. Defaults to 16.
+        block_size (int, optional): The number of bytes in each block. Defaults to 4 KiB.
+
+    Returns:
+        str: The fingerprint.
+    """
+    size = path.stat().st_size
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as file:
+        if size <= sample_count * block_size:
+            digest.update(file.read())
+        else:
+            for offset in np.linspace(0, size - block_size, sample_count, dtype=np.int64):
+                file.seek(int(offset))
+                digest.update(file.read(block_size))
+    return f"{size}-{digest.hexdigest()}"
+
+
+def get_fingerprint(connectivity_matrix: ConnectivityMatrix, sample_count: int = 16, block_size: int = 2**12) -> str:
+    """
+    Fingerprint a connectivity matrix (see `get_file_fingerprint`).
+
+    HDF5 files contain many connectivity matrices, so for a dataset inside an HDF5
+    file the shape, the data type and evenly spaced rows of the dataset are hashed instead.
+    """
+    hdf5_path = split_hdf5_path(connectivity_matrix.path)
+    if hdf5_path is None:
+        return get_file_fingerprint(connectivity_matrix.path, sample_count, block_size)
+
+    import h5py
+
+    file_path, name = hdf5_path
+    with h5py.File(file_path, "r") as file:
+        dataset = file[name]
+        size = dataset.size * dataset.dtype.itemsize
+        digest = hashlib.blake2b(f"{dataset.shape} {dataset.dtype.str}".encode(), digest_size=16)
+        if dataset.shape[0] > 0:
+            row_count = max(1, block_size // max(1, size // dataset.shape[0]))
+            for start in np.unique(np.linspace(0, dataset.shape[0] - 1, sample_count, dtype=np.int64)):
+                digest.update(np.ascontiguousarray(dataset[start : start + row_count]).tobytes())
+    return f"{size}-{digest.hexdigest()}"
+
+
+def get_fingerprints(connectivity_matrices: Sequence[ConnectivityMatrix], max_workers: int | None = None) -> dict[Path, str]:
+    """
+    Fingerprint connectivity matrices in parallel.
+
+    Returns:
+        dict[Path, str]: The fingerprint of each connectivity matrix, by path.
+    """
+    unique = list({connectivity_matrix.path: connectivity_matrix for connectivity_matrix in connectivity_matrices}.values())
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fingerprints = list(executor.map(get_fingerprint, unique))
+    return {connectivity_matrix.path: fingerprint for connectivity_matrix, fingerprint in zip(unique, fingerprints)}
+
+
+def find_duplicate_matrices(fingerprints: dict[Path, str]) -> dict[Path, Path]:
+    """
+    Find the connectivity matrices with the same fingerprint.
+
+    >>> find_duplicate_matrices({Path("b"): "1", Path("a"): "1", Path("c"): "2"})
+    {PosixPath('b'): PosixPath('a')}
+
+    Returns:
+        dict[Path, Path]: The first path in sorted order with the same fingerprint, for each other path.
+    """
+    paths_by_fingerprint: dict[str, list[Path]] = defaultdict(list)
+    for path, fingerprint in fingerprints.items():
+        paths_by_fingerprint[fingerprint].append(path)
+    duplicates: dict[Path, Path] = dict()
+    for paths in paths_by_fingerprint.values():
+        original, *others = sorted(paths)
+        duplicates.update((path, original) for path in others)
+    return duplicates
+
+
+def find_duplicate_groups(
+    index: BIDSIndex,
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    fingerprints: dict[Path, str],
+) -> dict[tuple[str, ...], tuple[str, ...]]:
+    """
+    Find the groups whose records are the same, because they have connectivity matrices with the
+    same fingerprints for the same subjects and with the same metadata.
+
+    Parameters:
+        grouped_connectivity_matrix (dict): The connectivity matrices by group, as returned by `make_groups`.
+        fingerprints (dict[Path, str]): The fingerprint of each connectivity matrix, as returned by `get_fingerprints`.
+
+    Returns:
+        dict: The first group with the same content, for each other group.
+    """
+    original_by_key: dict[tuple[tuple[str, str, str], ...], tuple[str, ...]] = dict()
+    duplicates: dict[tuple[str, ...], tuple[str, ...]] = dict()
+    for group, connectivity_matrices in grouped_connectivity_matrix.items():
+        key = tuple(
+            sorted(
+                (
+                    fingerprints[connectivity_matrix.path],
+                    get_subject(index, connectivity_matrix),
+                    json.dumps(connectivity_matrix.metadata, sort_keys=True, default=str),
+                )
+                for connectivity_matrix in connectivity_matrices
+            )
+        )
+        if key in original_by_key:
+            duplicates[group] = original_by_key[key]
+        else:
+            original_by_key[key] = group
+    return duplicates
+
+
+def make_duplicates_frame(
+    duplicate_matrices: dict[Path, Path],
+    duplicate_groups: Sequence[tuple[list[str], dict[tuple[str, ...], tuple[str, ...]]]],
+) -> pd.DataFrame:
+    """
+    List the duplicates that were found, with one row for each duplicate connectivity matrix or group.
+
+    Parameters:
+        duplicate_matrices (dict[Path, Path]): The duplicate connectivity matrices, as returned by `find_duplicate_matrices`.
+        duplicate_groups (Sequence): Pairs of the tags that the groups are defined by, and the duplicate groups
+            as returned by `find_duplicate_groups`.
+
+    Returns:
+        pd.DataFrame: The columns "kind" ("matrix" or "group"), "duplicate" and "original".
+    """
+    rows = [("matrix", str(duplicate), str(original)) for duplicate, original in sorted(duplicate_matrices.items())]
+    for group_by, duplicates in duplicate_groups:
+        rows.extend(
+            ("group", make_file_label(dict(zip(group_by, duplicate))), make_file_label(dict(zip(group_by, original))))
+            for duplicate, original in duplicates.items()
+        )
+    return pd.DataFrame(rows, columns=["kind", "duplicate", "original"])
@@ -0,0 +1,108 @@
+"""
+Save and load the edge-level QC-FC values of each group.
+
+Each group is stored as two ".npy" files with the correlation and p-value
+vectors, and a JSON file that describes the group and points to the arrays.
+For sparse connectivity matrices, the positions of the edges and the sample
+count of each edge are stored as two more ".npy" files.
+The arrays can be loaded with memory mapping, so that many groups can be
+compared without reading all the data into memory.
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Literal, Mapping
+
+import numpy as np
+
+from .features.quality_control_connectivity import QCFCResult
+
+
+def make_file_label(group: Mapping[str, str]) -> str:
+    """
+    Make a BIDS-style file name label for a group.
+
+    >>> make_file_label(dict(seg="Schaefer20187Networks100Parcels", desc="simple"))
+    'seg-Schaefer20187Networks100Parcels_desc-simple'
+    """
+    return "_".join(f"{key}-{value}" for key, value in group.items())
+
+
+def save_qcfc_edges(edges_dir: Path, group: Mapping[str, str], qcfc: QCFCResult) -> Path:
+    """
+    Save the edge-level QC-FC values of a group.
+
+    Parameters:
+        edges_dir (Path): The directory to save the files into.
+        group (Mapping[str, str]): The tags and values that identify the group.
+        qcfc (QCFCResult): The QC-FC values to save.
+
+    Returns:
+        Path: The path to the JSON file that describes the group.
+    """
+    edges_dir.mkdir(parents=True, exist_ok=True)
+    label = make_file_label(group)
+
+    correlation_path = edges_dir / f"{label}_correlation.npy"
+    np.save(correlation_path, np.ascontiguousarray(qcfc.correlation, dtype=np.float64))
+    p_value_path = edges_dir / f"{label}_p_value.npy"
+    np.save(p_value_path, np.ascontiguousarray(qcfc.p_value, dtype=np.float64))
+
+    index: dict[str, Any] = dict(
+        group=dict(group),
+        region_count=qcfc.region_count,
+        sample_count=qcfc.sample_count,
+        correlation=correlation_path.name,
+        p_value=p_value_path.name,
+    )
+    if np.ndim(qcfc.sample_count) > 0:
+        sample_count_path = edges_dir / f"{label}_sample_count.npy"
+        np.save(sample_count_path, np.asarray(qcfc.sample_count, dtype=np.int64))
+        index["sample_count"] = sample_count_path.name
+    if qcfc.edge_indices is not None:
+        edge_indices_path = edges_dir / f"{label}_edge_indices.npy"
+        np.save(edge_indices_path, np.asarray(qcfc.edge_indices, dtype=np.int64))
+        index["edge_indices"] = edge_indices_path.name
+
+    index_path = edges_dir / f"{label}_qcfc.json"
+    with index_path.open("w") as file:
+        json.dump(index, file, indent=4)
+    return index_path
+
+
+def load_qcfc_edges(index_path: Path, mmap: bool = True) -> tuple[dict[str, str], QCFCResult]:
+    """
+    Load the edge-level QC-FC values of a group saved with `save_qcfc_edges`.
+
+    Parameters:
+        index_path (Path): The path to the JSON file that describes the group.
+        mmap (bool, optional): Whether to memory map the arrays instead of reading them. Defaults to True.
+
+    Returns:
+        tuple[dict[str, str], QCFCResult]: The tags and values that identify the group, and the QC-FC values.
+    """
+    with index_path.open("r") as file:
+        index = json.load(file)
+
+    mmap_mode: Literal["r", "r+", "w+", "c"] | None = "r" if mmap else None
+    sample_count = index["sample_count"]
+    if isinstance(sample_count, str):  # Saved for each edge
+        sample_count = np.load(index_path.parent / sample_count, mmap_mode=mmap_mode)
+    edge_indices = None
+    if "edge_indices" in index:
+        edge_indices = np.load(index_path.parent / index["edge_indices"], mmap_mode=mmap_mode)
+    qcfc = QCFCResult(
+        region_count=index["region_count"],
+        correlation=np.load(index_path.parent / index["correlation"], mmap_mode=mmap_mode),
+        sample_count=sample_count,
+        edge_indices=edge_indices,
+        _p_value=np.load(index_path.parent / index["p_value"], mmap_mode=mmap_mode),
+    )
+    return index["group"], qcfc
+
+
+def find_qcfc_edges(edges_dir: Path, mmap: bool = True) -> list[tuple[dict[str, str], QCFCResult]]:
+    """
+    Load the edge-level QC-FC values of all groups in a directory.
+    """
+    return [load_qcfc_edges(index_path, mmap=mmap) for index_path in sorted(edges_dir.glob("*_qcfc.json"))]
@@ -1,7 +1,7 @@
 """Calculate degree of freedom"""
 
 from functools import partial
-from typing import NamedTuple, Sequence
+from typing import Any, Mapping, NamedTuple, Sequence
 
 import numpy as np
 import pandas as pd
@@ -16,7 +16,7 @@ class DegreesOfFreedomLossResult(NamedTuple):
 
 
 def calculate_degrees_of_freedom_loss(
-    connectivity_matrices: list[ConnectivityMatrix],
+    connectivity_matrices: Sequence[ConnectivityMatrix],
 ) -> DegreesOfFreedomLossResult:
     """
     Calculate the percent of degrees of freedom lost during denoising.
@@ -29,9 +29,27 @@ def calculate_degrees_of_freedom_loss(
 
     """
     # seann: ensure count is a list of integers instead of a numpy array
-    count: list[int] = [connectivity_matrix.load().shape[0] for connectivity_matrix in connectivity_matrices]
+    count: list[int] = [connectivity_matrix.region_count for connectivity_matrix in connectivity_matrices]
+    metadata = [connectivity_matrix.metadata for connectivity_matrix in connectivity_matrices]
+    return calculate_degrees_of_freedom_loss_from_metadata(metadata, count)
 
-    calculate = partial(_calculate_for_key, connectivity_matrices, count)
+
+def calculate_degrees_of_freedom_loss_from_metadata(
+    metadata: Sequence[Mapping[str, Any]],
+    count: Sequence[int],
+) -> DegreesOfFreedomLossResult:
+    """
+    Calculate the percent of degrees of freedom lost during denoising from the metadata of each connectivity matrix.
+
+    Parameters:
+    - metadata (Sequence[Mapping[str, Any]]): The metadata of each connectivity matrix.
+    - count (Sequence[int]): The number of regions of each connectivity matrix.
+
+    Returns:
+    - DegreesOfFreedomLossResult: The percentages of degrees of freedom lost.
+
+    """
+    calculate = partial(_calculate_for_key, metadata, count)
     return DegreesOfFreedomLossResult(
         confound_regression_percentage=calculate("ConfoundRegressors"),
         motion_scrubbing_percentage=calculate("NumberOfVolumesDiscardedByMotionScrubbing"),
@@ -41,11 +59,11 @@ def calculate_degrees_of_freedom_loss(
 
 # seann: ensure function accepts sequence of integers
 def _calculate_for_key(
-    connectivity_matrices: list[ConnectivityMatrix],
+    metadata: Sequence[Mapping[str, Any]],
     count: Sequence[int],
     key: str,
 ) -> float:
-    values: Sequence[int | list[str] | None] = [connectivity_matrix.metadata.get(key, None) for connectivity_matrix in connectivity_matrices]
+    values: Sequence[int | list[str] | None] = [m.get(key, None) for m in metadata]
 
     if all(value is None for value in values):
         return np.nan
@@ -1,24 +1,57 @@
 import numpy as np
-import pandas as pd
+from numpy import typing as npt
 
 from ..atlas import Atlas
+from .quality_control_connectivity import QCFCResult
 from scipy.stats import spearmanr
 
 
-def calculate_distance_dependence(qcfc: pd.DataFrame, atlas: Atlas) -> float:
+def get_edge_distances(qcfc: QCFCResult, atlas: Atlas | npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Get the distance between the regions of each edge of the QC-FC correlation values.
+
+    Parameters:
+    - qcfc (QCFCResult): The QC-FC correlation values for the lower triangular indices
+    - atlas (Atlas | ndarray): The Atlas object used to calculate the distances, the distance matrix itself,
+      or the distances below the diagonal in the order given by `np.tril_indices(n, k=-1)`.
+
+    Returns:
+    - ndarray: The distance of each edge, in the order of `qcfc.correlation`.
+
+    """
+    distances = atlas.get_distance_vector() if isinstance(atlas, Atlas) else np.asarray(atlas)
+    if distances.ndim == 2:
+        i, j = qcfc.get_indices()
+        return distances[i, j]
+    if qcfc.edge_indices is not None:
+        return distances[qcfc.edge_indices]
+    return distances
+
+
+def get_valid_edges(qcfc: QCFCResult, distance_vector: npt.NDArray[np.float64]) -> npt.NDArray[np.bool_]:
+    """
+    Get the edges that have both a QC-FC correlation value and a distance. Edges of sparse connectivity
+    matrices can have too few samples for a correlation, and edges of atlas regions without voxels have
+    no distance (see `MinimumDistance`).
+    """
+    return ~np.isnan(qcfc.correlation) & ~np.isnan(distance_vector)
+
+
+def calculate_distance_dependence(qcfc: QCFCResult, atlas: Atlas | npt.NDArray[np.float64]) -> float:
     """
     Calculate the Spearman correlation between the distance matrix and the QC-FC correlation values.
+    Edges without a correlation value or a distance are left out (see `get_valid_edges`).
 
     Parameters:
-    - qcfc (pd.DataFrame): The qcfc DataFrame containing the correlation values with a multi-index of the lower triangular indices
-    - atlas (Atlas): The Atlas object used to calculate the distance matrix.
+    - qcfc (QCFCResult): The QC-FC correlation values for the lower triangular indices
+    - atlas (Atlas | ndarray): The Atlas object used to calculate the distances, the distance matrix itself,
+      or the distances below the diagonal in the order given by `np.tril_indices(n, k=-1)`.
 
     Returns:
     - float: The distance dependence value.
 
     """
-    distance_matrix = atlas.get_distance_matrix()
-    i, j = map(np.asarray, zip(*qcfc.index))
-    distance_vector = distance_matrix[i, j]
-    r, _ = spearmanr(distance_vector, qcfc.correlation)
+    distance_vector = get_edge_distances(qcfc, atlas)
+    valid = get_valid_edges(qcfc, distance_vector)
+    r, _ = spearmanr(distance_vector[valid], qcfc.correlation[valid])
     return np.abs(r)
@@ -0,0 +1,121 @@
+"""Leave-one-subject-out influence on the QC-FC metrics"""
+
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+
+from ..correlation import correlation_significant
+from .quality_control_connectivity import QCFCModel, make_column_name
+
+
+def calculate_leave_one_out_influence(model: QCFCModel, subjects: Sequence[str]) -> pd.DataFrame:
+    """
+    Calculate how much each subject changes the median absolute QC-FC and the
+    percentage of significant QC-FC edges.
+
+    Instead of fitting the covariates again without the subject, the residuals
+    in `model` are corrected for the held-out connectivity matrices with the
+    leave-out formula for least squares. The correlations without the subject
+    are then recalculated from the sums of products of the remaining residuals.
+    This only needs the columns of the subject, so the cost per subject is
+    proportional to the number of edges.
+
+    Parameters:
+        model (QCFCModel): The residuals of the edges and metrics for all subjects.
+        subjects (Sequence[str]): The subject of each connectivity matrix. All matrices of
+            a subject are held out together.
+
+    Returns:
+        pd.DataFrame: One row per subject, with the metrics calculated without the subject,
+            and the influence of the subject, which is the metric with the subject minus the
+            metric without the subject.
+    """
+    subject_array = np.asarray(subjects)
+    covariates = model.covariates
+    cross_product = covariates.T @ covariates
+    inverse_cross_product = np.asarray(np.linalg.pinv(cross_product), dtype=np.float64)
+    rank = np.linalg.matrix_rank(covariates)
+
+    full_correlation = model.edges @ model.metrics.T
+    full_median_absolute = np.nanmedian(np.abs(full_correlation), axis=0)
+    full_percentage = 100 * correlation_significant(full_correlation, model.sample_count).mean(axis=0)
+
+    records: list[dict[str, float | int | str]] = []
+    for subject in dict.fromkeys(subjects):  # Unique subjects in order of appearance
+        (held_out,) = np.nonzero(subject_array == subject)
+        remaining_count = model.sample_count - held_out.size
+
+        record: dict[str, float | int | str] = dict(participant_id=subject, matrix_count=held_out.size)
+        covariates_held_out = covariates[held_out]
+        if np.linalg.matrix_rank(np.delete(covariates, held_out, axis=0)) < rank:
+            # The covariates cannot be estimated without the subject
+            correlation = np.full_like(full_correlation, np.nan)
+        else:
+            correlation = _leave_out_correlation(
+                model,
+                full_correlation,
+                held_out,
+                covariates_held_out,
+                cross_product - covariates_held_out.T @ covariates_held_out,
+                inverse_cross_product,
+            )
+
+        median_absolute = np.nanmedian(np.abs(correlation), axis=0)
+        percentage = 100 * correlation_significant(correlation, remaining_count).mean(axis=0)
+        for k, metric_key in enumerate(model.metric_keys):
+            record[make_column_name("median_absolute_qcfc", metric_key, model.metric_keys)] = median_absolute[k]
+            record[make_column_name("median_absolute_qcfc_influence", metric_key, model.metric_keys)] = full_median_absolute[k] - median_absolute[k]
+            record[make_column_name("percentage_significant_qcfc", metric_key, model.metric_keys)] = percentage[k]
+            record[make_column_name("percentage_significant_qcfc_influence", metric_key, model.metric_keys)] = full_percentage[k] - percentage[k]
+        records.append(record)
+
+    return pd.DataFrame.from_records(records, index="participant_id")
+
+
+def _leave_out_correlation(
+    model: QCFCModel,
+    full_correlation: npt.NDArray[np.float64],
+    held_out: npt.NDArray[np.int64],
+    covariates_held_out: npt.NDArray[np.float64],
+    remaining_cross_product: npt.NDArray[np.float64],
+    inverse_cross_product: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    # Without the held out rows the residuals of the remaining rows change by
+    # covariates @ w, where w = (C'C)^-1 C_s' (I - H_ss)^-1 e_s
+    leverage = covariates_held_out @ inverse_cross_product @ covariates_held_out.T
+    scale = np.linalg.inv(np.eye(held_out.size) - leverage)
+    projection = scale @ covariates_held_out @ inverse_cross_product
+
+    edges_held_out = model.edges[:, held_out]
+    metrics_held_out = model.metrics[:, held_out]
+    edges_w = edges_held_out @ projection
+    metrics_w = metrics_held_out @ projection
+    # The residuals are orthogonal to the covariates, so the product of the remaining
+    # residuals and covariates is the negative of the product for the held out rows
+    edges_covariates = edges_held_out @ covariates_held_out
+    metrics_covariates = metrics_held_out @ covariates_held_out
+
+    # The residuals have unit norm over all rows
+    products = (
+        full_correlation
+        - edges_held_out @ metrics_held_out.T
+        - edges_covariates @ metrics_w.T
+        - edges_w @ metrics_covariates.T
+        + edges_w @ remaining_cross_product @ metrics_w.T
+    )
+    edges_norm = (
+        1
+        - np.square(edges_held_out).sum(axis=1)
+        - 2 * (edges_covariates * edges_w).sum(axis=1)
+        + ((edges_w @ remaining_cross_product) * edges_w).sum(axis=1)
+    )
+    metrics_norm = (
+        1
+        - np.square(metrics_held_out).sum(axis=1)
+        - 2 * (metrics_covariates * metrics_w).sum(axis=1)
+        + ((metrics_w @ remaining_cross_product) * metrics_w).sum(axis=1)
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return products / np.sqrt(np.outer(edges_norm, metrics_norm))
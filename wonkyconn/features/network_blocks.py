@@ -0,0 +1,144 @@
+"""Summarize QC-FC within and between the networks of an atlas"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+
+from ..base import get_region_count
+from ..correlation import correlation_significant
+from .quality_control_connectivity import QCFCResult
+
+
+def get_label_path(atlas_path: Path) -> Path:
+    """
+    Get the path of the label file that describes the regions of an atlas image.
+
+    >>> get_label_path(Path("sub-1_seg-Schaefer20187Networks100Parcels_dseg.nii.gz"))
+    PosixPath('sub-1_seg-Schaefer20187Networks100Parcels_dseg.tsv')
+    """
+    name = atlas_path.name.removesuffix(".gz").removesuffix(".nii")
+    return atlas_path.with_name(f"{name}.tsv")
+
+
+def parse_network_name(region_name: str) -> str:
+    """
+    Get the network from the name of a region in the Schaefer atlas. Other names are returned unchanged.
+
+    >>> parse_network_name("7Networks_LH_Vis_1")
+    'Vis'
+    >>> parse_network_name("RH_SomMot_4")
+    'SomMot'
+    >>> parse_network_name("Thalamus")
+    'Thalamus'
+    """
+    parts = region_name.split("_")
+    if parts[0].endswith("Networks"):
+        parts = parts[1:]
+    if len(parts) >= 3 and parts[0] in ("LH", "RH"):
+        return parts[1]
+    return region_name
+
+
+def load_region_networks(label_path: Path) -> list[str]:
+    """
+    Load the network of each region from a label file.
+
+    The label file is a ".tsv" file with a "name" column and one row per region.
+    If there is an "index" column, the rows are sorted by it and the background
+    index zero is skipped. The networks are taken from the "network" column if it
+    exists, and are parsed from the region names otherwise (see `parse_network_name`).
+
+    Returns:
+        list[str]: The network of each region, in the order of the connectivity matrix.
+    """
+    labels = pd.read_csv(label_path, sep="\t")
+    if "index" in labels.columns:
+        labels = labels.loc[labels["index"] != 0].sort_values("index")
+    if "network" in labels.columns:
+        return [str(network) for network in labels["network"]]
+    if "name" not in labels.columns:
+        raise ValueError(f'Label file "{label_path}" needs a "name" or "network" column')
+    return [parse_network_name(str(name)) for name in labels["name"]]
+
+
+@dataclass
+class NetworkBlocks:
+    """
+    Assigns each edge of a connectivity matrix to a pair of networks.
+
+    Attributes:
+        networks (list[str]): The names of the networks, sorted.
+        edge_blocks (ndarray): The block of each edge, in the order given by `np.tril_indices(n, k=-1)`.
+            Block `a * len(networks) + b` contains the edges between networks `a <= b`.
+    """
+
+    networks: list[str]
+    edge_blocks: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_region_networks(cls, region_networks: list[str]) -> NetworkBlocks:
+        networks, codes = np.unique(np.asarray(region_networks, dtype=str), return_inverse=True)
+        i, j = np.tril_indices(len(region_networks), k=-1)
+        a = np.minimum(codes[i], codes[j])
+        b = np.maximum(codes[i], codes[j])
+        return cls(networks=networks.tolist(), edge_blocks=(a * len(networks) + b).astype(np.int64))
+
+    @property
+    def region_count(self) -> int:
+        return get_region_count(self.edge_blocks.size)
+
+    def calculate(self, qcfc: QCFCResult, alpha: float = 0.05) -> pd.DataFrame:
+        """
+        Calculate the median absolute QC-FC and the percentage of significant QC-FC edges for each pair of networks.
+
+        The edges are sorted once by block and absolute value, so that the medians of all blocks
+        can be read off at the block boundaries. The percentages are counted with `np.bincount`.
+
+        Parameters:
+            qcfc (QCFCResult): The QC-FC values of the group.
+            alpha (float, optional): The significance level. Defaults to 0.05.
+
+        Returns:
+            pd.DataFrame: A symmetric matrix for each measure, with the index levels "measure"
+                and "network" and one column per network.
+        """
+        if qcfc.region_count != self.region_count:
+            raise ValueError(f"The atlas labels have {self.region_count} regions, but the connectivity matrices have {qcfc.region_count}")
+        network_count = len(self.networks)
+        block_count = network_count * network_count
+        edge_blocks = self.edge_blocks if qcfc.edge_indices is None else self.edge_blocks[qcfc.edge_indices]
+
+        absolute = np.abs(qcfc.correlation)
+        valid = ~np.isnan(absolute)
+        counts = np.bincount(edge_blocks, minlength=block_count)
+        valid_counts = np.bincount(edge_blocks, weights=valid, minlength=block_count).astype(np.int64)
+        significant_counts = np.bincount(
+            edge_blocks,
+            weights=correlation_significant(qcfc.correlation, qcfc.sample_count, alpha=alpha),
+            minlength=block_count,
+        )
+
+        # Missing values are sorted to the end of each block
+        order = np.lexsort((absolute, edge_blocks))
+        sorted_absolute = absolute[order]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        has_values = valid_counts > 0
+        lower = starts[has_values] + (valid_counts[has_values] - 1) // 2
+        upper = starts[has_values] + valid_counts[has_values] // 2
+        median = np.full(block_count, np.nan)
+        median[has_values] = (sorted_absolute[lower] + sorted_absolute[upper]) / 2
+
+        percentage = np.full(block_count, np.nan)
+        percentage[counts > 0] = 100 * significant_counts[counts > 0] / counts[counts > 0]
+
+        frames: dict[str, pd.DataFrame] = dict()
+        for measure, values in [("median_absolute_qcfc", median), ("percentage_significant_qcfc", percentage)]:
+            matrix = values.reshape(network_count, network_count)
+            matrix = np.where(np.isnan(matrix), matrix.T, matrix)  # Only the upper triangle is filled
+            frames[measure] = pd.DataFrame(matrix, index=pd.Index(self.networks, name="network"), columns=self.networks)
+        return pd.concat(frames, names=["measure"])
@@ -1,124 +1,399 @@
 from __future__ import annotations  # seann: added future import for annotations to allow type hints in function signatures
 
-from itertools import chain
-from typing import Iterable
+from dataclasses import dataclass, field
+from typing import Mapping, Sequence
 
 import numpy as np
 import pandas as pd
 from numpy import typing as npt
 from patsy.highlevel import dmatrix
 from statsmodels.stats.multitest import multipletests
-from tqdm.auto import tqdm
 
-from ..base import ConnectivityMatrix
-from ..correlation import correlation_p_value, partial_correlation
+from ..base import ConnectivityMatrix, SparseConnectivityArray, get_edge_coordinates, get_region_count, load_connectivity_array
+from ..correlation import (
+    benjamini_hochberg,
+    correlation_p_value,
+    correlation_significant,
+    residualize,
+)
+
+
+@dataclass(slots=True)
+class QCFCResult:
+    """
+    The QC-FC values for every edge of a connectivity matrix.
+
+    For dense connectivity matrices, the edges are not stored explicitly. They are
+    implied by the order of the arrays, which is the order given by
+    `np.tril_indices(region_count, k=-1)`. For sparse connectivity matrices, only
+    the edges in `edge_indices` have values.
+
+    The p-values are only calculated when they are first accessed, because
+    counting the significant edges does not need them (see `calculate_qcfc_percentage`).
+
+    Attributes:
+        region_count (int): The number of regions in the connectivity matrices.
+        correlation (ndarray): The QC-FC correlation for each edge.
+        sample_count (int | ndarray): The number of connectivity matrices that the correlations were calculated from,
+            either for all edges or for each edge.
+        edge_indices (ndarray | None): The positions of the edges (see `get_edge_indices`),
+            or None if there is a value for every edge.
+    """
+
+    region_count: int
+    correlation: npt.NDArray[np.float64]
+    sample_count: int | npt.NDArray[np.int64]
+    edge_indices: npt.NDArray[np.int64] | None = None
+    _p_value: npt.NDArray[np.float64] | None = field(default=None, repr=False)
+
+    @property
+    def p_value(self) -> npt.NDArray[np.float64]:
+        """
+        Returns:
+            ndarray: The p-value of the QC-FC correlation for each edge.
+        """
+        if self._p_value is None:
+            self._p_value = correlation_p_value(self.correlation, self.sample_count)
+        return self._p_value
+
+    def get_indices(self) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """
+        Returns:
+            tuple[ndarray, ndarray]: The row and column indices of the edges.
+        """
+        if self.edge_indices is not None:
+            return get_edge_coordinates(self.edge_indices)
+        return np.tril_indices(self.region_count, k=-1)
+
+    def to_data_frame(self) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: The columns "correlation" and "p_value" with a multi-index
+                of the lower triangular indices "i" and "j".
+        """
+        i, j = self.get_indices()
+        qcfc = pd.DataFrame(dict(i=i, j=j, correlation=self.correlation, p_value=self.p_value))
+        return qcfc.set_index(["i", "j"])
 
 
 def calculate_qcfc(
     data_frame: pd.DataFrame,
-    connectivity_matrices: Iterable[ConnectivityMatrix],
+    connectivity_matrices: Sequence[ConnectivityMatrix],
     metric_key: str = "MeanFramewiseDisplacement",
-) -> pd.DataFrame:
+) -> QCFCResult:
     """
     metric calculation: quality control / functional connectivity
 
-    For each edge, we then computed the correlation between the weight of
-    that edge and the mean relative RMS motion.
-    QC-FC relationships were calculated as partial correlations that
-    accounted for participant age and sex
+    See `calculate_qcfc_for_metrics` for details.
 
     Parameters:
         data_frame (pd.DataFrame): The data frame containing the covariates "age" and "gender". It needs to have one row for each connectivity matrix.
-        connectivity_matrices (Iterable[ConnectivityMatrix]): The connectivity matrices to calculate QCFC for.
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to calculate QCFC for.
         metric_key (str, optional): The key of the metric to use for QCFC calculation. Defaults to "MeanFramewiseDisplacement".
 
     Returns:
-        pd.DataFrame: The QCFC values between connectivity matrices and the metric.
+        QCFCResult: The QCFC values between connectivity matrices and the metric.
 
     """
-    metrics = np.asarray([connectivity_matrix.metadata.get(metric_key, np.nan) for connectivity_matrix in connectivity_matrices])
+    return calculate_qcfc_for_metrics(data_frame, connectivity_matrices, [metric_key])[metric_key]
+
+
+@dataclass
+class QCFCModel:
+    """
+    The connectivity edges and motion metrics of a group after removing the covariates.
+
+    The residuals of each edge and each metric are scaled to unit norm, so that
+    the QC-FC partial correlations are the dot products between them.
+
+    Attributes:
+        metric_keys (list[str]): The keys of the motion metrics.
+        covariates (ndarray): The covariates, with one row per connectivity matrix.
+        edges (ndarray): The scaled residuals of the edges, with one row per edge and one column per connectivity matrix.
+        metrics (ndarray): The scaled residuals of the metrics, with one row per metric and one column per connectivity matrix.
+    """
+
+    metric_keys: list[str]
+    covariates: npt.NDArray[np.float64]
+    edges: npt.NDArray[np.float64]
+    metrics: npt.NDArray[np.float64]
+
+    @classmethod
+    def fit(
+        cls,
+        data_frame: pd.DataFrame,
+        connectivity_array: npt.NDArray[np.float64],
+        metrics: Mapping[str, npt.ArrayLike],
+    ) -> QCFCModel:
+        """
+        Remove the covariates "age" and "gender" from the edges and the motion metrics.
+
+        Parameters:
+            data_frame (pd.DataFrame): The data frame containing the covariates "age" and "gender", with one row for each connectivity matrix.
+            connectivity_array (ndarray): The lower triangles of the connectivity matrices, with one row per edge and one column
+                per connectivity matrix. The array is overwritten with the residuals.
+            metrics (Mapping[str, ArrayLike]): The values of each motion metric, with one value for each connectivity matrix.
+
+        Returns:
+            QCFCModel: The residuals of the edges and the metrics.
+        """
+        metric_array = np.asarray([np.asarray(values, dtype=np.float64) for values in metrics.values()], dtype=np.float64)
+        covariates = np.asarray(dmatrix("age + gender", data_frame))
+        if not connectivity_array.shape[1] == metric_array.shape[1] == covariates.shape[0]:
+            raise ValueError(
+                f"Expected the same number of connectivity matrices ({connectivity_array.shape[1]}), "
+                f"motion values ({metric_array.shape[1]}) and covariate rows ({covariates.shape[0]})"
+            )
+
+        return cls(
+            metric_keys=list(metrics.keys()),
+            covariates=covariates,
+            edges=residualize(connectivity_array, covariates),
+            metrics=residualize(metric_array, covariates),
+        )
+
+    @property
+    def region_count(self) -> int:
+        return get_region_count(self.edges.shape[0])
+
+    @property
+    def sample_count(self) -> int:
+        return self.edges.shape[1]
+
+    def get_results(self) -> dict[str, QCFCResult]:
+        """
+        Calculate the QC-FC correlations for all metrics with a single matrix product.
+
+        Returns:
+            dict[str, QCFCResult]: The QCFC values between connectivity matrices and each metric.
+        """
+        correlation = self.edges @ self.metrics.T
+
+        qcfc: dict[str, QCFCResult] = dict()
+        for k, metric_key in enumerate(self.metric_keys):
+            metric_correlation = np.ascontiguousarray(correlation[:, k])
+            qcfc[metric_key] = QCFCResult(region_count=self.region_count, correlation=metric_correlation, sample_count=self.sample_count)
+        return qcfc
+
+
+def calculate_sparse_qcfc(
+    data_frame: pd.DataFrame,
+    connectivity_array: SparseConnectivityArray,
+    metrics: Mapping[str, npt.ArrayLike],
+    block_size: int = 2**16,
+) -> dict[str, QCFCResult]:
+    """
+    Calculate QC-FC for the union of the edges of sparse connectivity matrices.
+
+    The partial correlation of each edge is calculated from the connectivity matrices
+    that contain the edge, so missing edges are left out instead of being treated as zero.
+    Because the covariates differ between edges, the covariates are not removed once for the
+    whole group as in `QCFCModel`. Instead, the sums of products between the edges, the
+    metrics and the covariates over the present connectivity matrices are calculated with
+    sparse matrix products, and the covariates are removed from the sums of each edge. Time
+    and memory scale with the number of stored edges.
+
+    Parameters:
+        data_frame (pd.DataFrame): The data frame containing the covariates "age" and "gender", with one row for each connectivity matrix.
+        connectivity_array (SparseConnectivityArray): The edges of the connectivity matrices.
+        metrics (Mapping[str, ArrayLike]): The values of each motion metric, with one value for each connectivity matrix.
+        block_size (int, optional): The number of edges to process at a time. Defaults to 2**16.
+
+    Returns:
+        dict[str, QCFCResult]: The QCFC values between connectivity matrices and each metric, with the number of
+            connectivity matrices that contain each edge as the sample count.
+    """
+    metric_array = np.asarray([np.asarray(values, dtype=np.float64) for values in metrics.values()], dtype=np.float64)
     covariates = np.asarray(dmatrix("age + gender", data_frame))
+    if not connectivity_array.sample_count == metric_array.shape[1] == covariates.shape[0]:
+        raise ValueError(
+            f"Expected the same number of connectivity matrices ({connectivity_array.sample_count}), "
+            f"motion values ({metric_array.shape[1]}) and covariate rows ({covariates.shape[0]})"
+        )
+    metric_count = metric_array.shape[0]
+    covariate_count = covariates.shape[1]
 
-    connectivity_arrays = [
-        connectivity_matrix.load()
-        for connectivity_matrix in tqdm(
-            connectivity_matrices,
-            desc="Loading connectivity matrices",
-            leave=False,
+    # The products for each connectivity matrix, which are summed over the present connectivity matrices of each edge
+    covariate_products = np.einsum("si,sj->sij", covariates, covariates).reshape(covariates.shape[0], -1)
+    metric_covariate_products = np.einsum("ks,si->ski", metric_array, covariates).reshape(covariates.shape[0], -1)
+    metric_squares = (metric_array**2).T
+
+    edge_count = connectivity_array.edge_count
+    correlation = np.empty((edge_count, metric_count))
+    sample_count = np.asarray(connectivity_array.present.sum(axis=1), dtype=np.int64).ravel()
+    for start in range(0, edge_count, block_size):
+        stop = min(start + block_size, edge_count)
+        values = connectivity_array.values[start:stop]
+        present = connectivity_array.present[start:stop]
+
+        inverse_covariate_products = np.linalg.pinv((present @ covariate_products).reshape(-1, covariate_count, covariate_count))
+        edge_covariate_products = values @ covariates
+        metric_covariate_sums = (present @ metric_covariate_products).reshape(-1, metric_count, covariate_count)
+        edge_projection = np.einsum("ei,eij->ej", edge_covariate_products, inverse_covariate_products)
+
+        # Sums of products of the residuals after removing the covariates
+        edge_metric_residuals = values @ metric_array.T - np.einsum("ej,ekj->ek", edge_projection, metric_covariate_sums)
+        edge_residuals = np.asarray(values.multiply(values).sum(axis=1)).ravel() - np.einsum("ej,ej->e", edge_projection, edge_covariate_products)
+        metric_residuals = present @ metric_squares - np.einsum(
+            "eki,eij,ekj->ek", metric_covariate_sums, inverse_covariate_products, metric_covariate_sums
         )
-    ]
 
-    # Ensure that all arrays are square and have the same shape
-    (n,) = set(chain.from_iterable(a.shape for a in connectivity_arrays))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlation[start:stop] = edge_metric_residuals / np.sqrt(edge_residuals[:, np.newaxis] * metric_residuals)
+
+    # Edges with too few connectivity matrices for the covariates have no correlation
+    correlation[sample_count <= covariate_count + 1] = np.nan
+
+    return {
+        metric_key: QCFCResult(
+            region_count=connectivity_array.region_count,
+            correlation=np.ascontiguousarray(correlation[:, k]),
+            sample_count=sample_count,
+            edge_indices=connectivity_array.edge_indices,
+        )
+        for k, metric_key in enumerate(metrics.keys())
+    }
+
+
+def fit_qcfc_model(
+    data_frame: pd.DataFrame,
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    metric_keys: Sequence[str],
+    connectivity_array: npt.NDArray[np.float64] | None = None,
+) -> QCFCModel:
+    """
+    Remove the covariates "age" and "gender" from the edges and the motion metrics.
+
+    Parameters:
+        data_frame (pd.DataFrame): The data frame containing the covariates "age" and "gender". It needs to have one row for each connectivity matrix.
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to calculate QCFC for.
+        metric_keys (Sequence[str]): The keys of the metrics to use for QCFC calculation.
+        connectivity_array (ndarray, optional): The lower triangles of the connectivity matrices as returned by
+            `load_connectivity_array`, if they were already loaded. The array is overwritten with the residuals.
+
+    Returns:
+        QCFCModel: The residuals of the edges and the metrics.
+    """
+    metrics = {
+        metric_key: [connectivity_matrix.metadata.get(metric_key, np.nan) for connectivity_matrix in connectivity_matrices]
+        for metric_key in metric_keys
+    }
+
+    if connectivity_array is None:
+        connectivity_array = load_connectivity_array(connectivity_matrices)
+
+    return QCFCModel.fit(data_frame, connectivity_array, metrics)
+
+
+def calculate_qcfc_for_metrics(
+    data_frame: pd.DataFrame,
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    metric_keys: Sequence[str],
+    connectivity_array: npt.NDArray[np.float64] | None = None,
+) -> dict[str, QCFCResult]:
+    """
+    metric calculation: quality control / functional connectivity
+
+    For each edge, we then computed the correlation between the weight of
+    that edge and the mean relative RMS motion.
+    QC-FC relationships were calculated as partial correlations that
+    accounted for participant age and sex
 
-    # Extract the lower triangles
-    i, j = np.tril_indices(n, k=-1)
-    connectivity_array = np.concatenate(
-        [a[i, j, np.newaxis] for a in connectivity_arrays],
-        axis=1,
-    )
+    The covariates are removed from the edges once, and the residuals are then
+    correlated with all metrics in a single matrix product (see `QCFCModel`).
 
-    _, m = connectivity_array.shape
-    correlation = partial_correlation(connectivity_array, metrics, covariates)
+    Parameters:
+        data_frame (pd.DataFrame): The data frame containing the covariates "age" and "gender". It needs to have one row for each connectivity matrix.
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices to calculate QCFC for.
+        metric_keys (Sequence[str]): The keys of the metrics to use for QCFC calculation.
+        connectivity_array (ndarray, optional): The lower triangles of the connectivity matrices as returned by
+            `load_connectivity_array`, if they were already loaded. The array is overwritten during the calculation.
 
-    p_value = correlation_p_value(correlation, m)
+    Returns:
+        dict[str, QCFCResult]: The QCFC values between connectivity matrices and each metric.
 
-    qcfc = pd.DataFrame(dict(i=i, j=j, correlation=correlation, p_value=p_value))
-    qcfc = qcfc.set_index(["i", "j"])
+    """
+    return fit_qcfc_model(data_frame, connectivity_matrices, metric_keys, connectivity_array).get_results()
 
-    return qcfc
 
+def make_column_name(name: str, metric_key: str, metric_keys: Sequence[str]) -> str:
+    """
+    Make the name of a result column for a metric. The first metric is used for the columns without suffix.
+
+    >>> make_column_name("median_absolute_qcfc", "MeanFramewiseDisplacement", ["MeanFramewiseDisplacement", "MaxFramewiseDisplacement"])
+    'median_absolute_qcfc'
+    >>> make_column_name("median_absolute_qcfc", "MaxFramewiseDisplacement", ["MeanFramewiseDisplacement", "MaxFramewiseDisplacement"])
+    'median_absolute_qcfc_MaxFramewiseDisplacement'
+    """
+    if metric_key == metric_keys[0]:
+        return name
+    return f"{name}_{metric_key}"
 
-# seann: added type for series
-def calculate_median_absolute(x: "pd.Series[float]") -> float:
+
+def calculate_median_absolute(x: npt.NDArray[np.float64]) -> float:
     """Calculate Absolute median value"""
-    return x.abs().median()
+    return float(np.nanmedian(np.abs(x)))
 
 
-# seann: added type for series
-def significant_level(x: "pd.Series[float]", alpha: float = 0.05, correction: str | None = None) -> npt.NDArray[np.bool_]:
+def significant_level(x: npt.NDArray[np.float64], alpha: float = 0.05, correction: str | None = None) -> npt.NDArray[np.bool_]:
     """
-    Apply FDR correction to a pandas.Series p-value object.
+    Apply FDR correction to an array of p-values.
 
     Parameters
     ----------
 
-    x : pandas.Series
+    x : ndarray
         Uncorrected p-values.
 
     alpha : float
         Alpha threshold.
 
-    method : None or str
+    correction : None or str
         Default as None for no multiple comparison
         Multiple comparison methods.
-        See statsmodels.stats.multitest.multipletests
+        "fdr_bh" uses a vectorized implementation, other methods
+        use statsmodels.stats.multitest.multipletests
 
     Returns
     -------
     ndarray, boolean
         Mask for data passing multiple comparison test.
     """
-    if isinstance(correction, str):
+    if correction == "fdr_bh":
+        res = benjamini_hochberg(x, alpha=alpha)
+    elif isinstance(correction, str):
         res, _, _, _ = multipletests(x, alpha=alpha, method=correction)
     else:
-        res = x < 0.05
+        res = x < alpha
     return res
 
 
-def calculate_qcfc_percentage(qcfc: pd.DataFrame) -> float:
+def calculate_qcfc_percentage(qcfc: QCFCResult, alpha: float = 0.05, correction: str | None = None) -> float:
     """
     Calculate the percentage of significant QC-FC relationships.
 
+    Without multiple comparison correction the correlations are compared to the
+    critical correlation for the sample size, so no p-values need to be calculated.
+
     Parameters
     ----------
-    qcfc : pd.DataFrame
+    qcfc : QCFCResult
         The QC-FC values between connectivity matrices and the metric.
 
+    alpha : float
+        Alpha threshold.
+
+    correction : None or str
+        Multiple comparison method, see `significant_level`.
+
     Returns
     -------
     float
         The percentage of significant QC-FC relationships.
     """
+    if correction is None:
+        significant = correlation_significant(qcfc.correlation, qcfc.sample_count, alpha=alpha)
+    else:
+        significant = significant_level(qcfc.p_value, alpha=alpha, correction=correction)
     # seann: cast mean p_value to float for type consistency
-    return 100 * float(significant_level(qcfc.p_value).mean())
+    return 100 * float(significant.mean())
@@ -0,0 +1,228 @@
+"""
+Compare denoising strategies on the connectivity matrices that they share.
+
+Each strategy is a group of connectivity matrices, and the groups are aligned so that
+the same scans are compared. For each edge and each pair of strategies, the paired
+difference is the absolute QC-FC of one strategy minus that of the other. The test
+statistic for a pair of strategies is the mean of the paired differences over all edges.
+Under the null hypothesis that the strategies do not differ, the connectivity matrices
+of a scan are exchangeable between the strategies. Each permutation shuffles the
+strategies within each scan, and is shared by all pairs, so that the QC-FC of all
+strategies and the differences of all pairs are calculated together for a batch of
+permutations. Sharing the permutations also gives p-values that are corrected for the
+number of pairs, and for the number of edges and pairs, with the maximum statistic.
+
+The edges are processed in blocks, so that only a block of the connectivity arrays of all
+strategies and its permutations need to be in memory at a time.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+from patsy.highlevel import dmatrix
+
+
+@dataclass
+class StrategyComparison:
+    """
+    The paired comparison of all pairs of strategies.
+
+    Attributes:
+        labels (list[str]): The label of each strategy.
+        median_absolute_qcfc (ndarray): The median absolute QC-FC of each strategy for the shared connectivity matrices.
+        difference (ndarray): The mean paired difference of the absolute QC-FC of the row strategy minus that of the
+            column strategy over all edges.
+        p_value (ndarray): The two-sided permutation p-value of each difference.
+        corrected_p_value (ndarray): The p-values corrected for all pairs with the maximum statistic.
+        percentage_different_edges (ndarray): The percentage of edges whose paired difference is significant,
+            corrected for all edges and pairs with the maximum statistic.
+        sample_count (int): The number of shared connectivity matrices.
+        permutation_count (int): The number of permutations.
+    """
+
+    labels: list[str]
+    median_absolute_qcfc: npt.NDArray[np.float64]
+    difference: npt.NDArray[np.float64]
+    p_value: npt.NDArray[np.float64]
+    corrected_p_value: npt.NDArray[np.float64]
+    percentage_different_edges: npt.NDArray[np.float64]
+    sample_count: int
+    permutation_count: int
+
+    def to_data_frames(self) -> dict[str, pd.DataFrame]:
+        """
+        Returns:
+            dict[str, pd.DataFrame]: The strategy by strategy matrices by name.
+        """
+        return {
+            name: pd.DataFrame(array, index=pd.Index(self.labels, name="strategy"), columns=self.labels)
+            for name, array in [
+                ("difference", self.difference),
+                ("p_value", self.p_value),
+                ("corrected_p_value", self.corrected_p_value),
+                ("percentage_different_edges", self.percentage_different_edges),
+            ]
+        }
+
+
+def calculate_qcfc(
+    connectivity_arrays: npt.NDArray[np.float64],
+    motion: npt.NDArray[np.float64],
+    basis: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    """
+    Calculate the QC-FC of a batch of strategies.
+
+    Parameters:
+        connectivity_arrays (ndarray): The edges with the shape (..., edge count, sample count).
+        motion (ndarray): The motion values with the shape (..., sample count).
+        basis (ndarray): An orthonormal basis of the covariates, with one row per sample.
+
+    Returns:
+        ndarray: The QC-FC with the shape (..., edge count).
+    """
+    # Remove the covariates without forming the projection matrix, which would be quadratic in the number of samples
+    edges = connectivity_arrays - (connectivity_arrays @ basis) @ basis.T
+    motion = motion - (motion @ basis) @ basis.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.einsum("...em,...m->...e", edges, motion) / (np.linalg.norm(edges, axis=-1) * np.linalg.norm(motion, axis=-1)[..., np.newaxis])
+
+
+def get_spread(absolute_qcfc: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Get the largest absolute paired difference of each edge over all pairs of strategies, which is the
+    largest minus the smallest absolute QC-FC. Strategies without a QC-FC for an edge are left out, and
+    the spread is -inf if none of them has one.
+
+    Parameters:
+        absolute_qcfc (ndarray): The absolute QC-FC with the shape (..., strategy count, edge count).
+
+    Returns:
+        ndarray: The spread with the shape (..., edge count).
+    """
+    missing = np.isnan(absolute_qcfc)
+    return np.where(missing, -np.inf, absolute_qcfc).max(axis=-2) - np.where(missing, np.inf, absolute_qcfc).min(axis=-2)
+
+
+def compare_strategies(
+    labels: list[str],
+    data_frame: pd.DataFrame,
+    connectivity_arrays: Sequence[npt.NDArray[np.float64]],
+    motion: npt.NDArray[np.float64],
+    permutation_count: int = 1000,
+    memory_limit: int = 2**28,
+    seed: int = 0,
+    alpha: float = 0.05,
+) -> StrategyComparison:
+    """
+    Test the paired differences of the absolute QC-FC between all pairs of strategies.
+
+    Parameters:
+        labels (list[str]): The label of each strategy.
+        data_frame (pd.DataFrame): The covariates "age" and "gender", with one row for each shared connectivity matrix.
+        connectivity_arrays (Sequence[ndarray]): The edges of each strategy, with the shape (edge count, sample count).
+            The samples need to be in the same order for all strategies. Only blocks of edges are read at a time, so
+            these can be memory-mapped arrays.
+        motion (ndarray): The motion values of each strategy, with the shape (strategy count, sample count).
+        permutation_count (int, optional): The number of permutations. Defaults to 1000.
+        memory_limit (int, optional): The number of bytes to use for a block of edges of all strategies and its
+            permutations. The observed QC-FC of all edges and strategies is kept in addition. Defaults to 256 MiB.
+        seed (int, optional): The seed for the random number generator. Defaults to 0.
+        alpha (float, optional): The significance level for `percentage_different_edges`. Defaults to 0.05.
+
+    Returns:
+        StrategyComparison: The differences and p-values.
+    """
+    strategy_count = len(connectivity_arrays)
+    if strategy_count < 2:
+        raise ValueError("At least two strategies are needed for a comparison")
+    shapes = {connectivity_array.shape for connectivity_array in connectivity_arrays}
+    if len(shapes) != 1:
+        raise ValueError(f"Expected connectivity arrays with the same shape for all strategies, but got {sorted(shapes)}")
+    ((edge_count, sample_count),) = shapes
+    covariates = np.asarray(dmatrix("age + gender", data_frame))
+    if not motion.shape == (strategy_count, sample_count) or covariates.shape[0] != sample_count:
+        raise ValueError(
+            f"Expected the same number of connectivity matrices ({sample_count}), "
+            f"motion values ({motion.shape[-1]}) and covariate rows ({covariates.shape[0]}) for {strategy_count} strategies"
+        )
+    if sample_count <= covariates.shape[1] + 1:
+        raise ValueError(f"The strategies only share {sample_count} connectivity matrices, which is too few for QC-FC")
+
+    # The residuals of the covariates are the same as with their pseudo-inverse
+    u, s, _ = np.linalg.svd(covariates, full_matrices=False)
+    basis = u[:, s > s.max() * max(covariates.shape) * np.finfo(np.float64).eps]
+
+    # A block of edges of all strategies is held once, and each permutation of it about three times,
+    # by the permuted edges, their residuals and a temporary
+    edge_size = np.dtype(np.float64).itemsize * strategy_count * sample_count
+    batch_size = int(np.clip((memory_limit // (edge_size * max(1, edge_count)) - 1) // 3, 1, max(1, permutation_count)))
+    block_size = int(np.clip(memory_limit // (edge_size * (1 + 3 * batch_size)), 1, max(1, edge_count)))
+
+    observed = np.empty((strategy_count, edge_count))
+    permuted_sum = np.zeros((permutation_count, strategy_count))
+    permuted_count = np.zeros((permutation_count, strategy_count), dtype=np.int64)
+    max_spread = np.full(permutation_count, -np.inf)
+    samples = np.arange(sample_count)
+    strategies = np.broadcast_to(np.arange(strategy_count)[:, np.newaxis], (strategy_count, sample_count))
+    for block_start in range(0, edge_count, block_size):
+        block_stop = min(block_start + block_size, edge_count)
+        block = np.stack([np.asarray(connectivity_array[block_start:block_stop], dtype=np.float64) for connectivity_array in connectivity_arrays])
+        observed[:, block_start:block_stop] = calculate_qcfc(block, motion, basis)
+
+        edges = np.arange(block_stop - block_start)
+        for start in range(0, permutation_count, batch_size):
+            stop = min(start + batch_size, permutation_count)
+            # The strategy that each strategy takes the connectivity matrix of each sample from. Each permutation
+            # only depends on the seed and its number, so that all blocks and batch sizes give the same permutations
+            sources = np.stack([np.random.default_rng([seed, k]).permuted(strategies, axis=0) for k in range(start, stop)])
+            permuted_arrays = block[sources[:, :, np.newaxis, :], edges[:, np.newaxis], samples]
+            permuted_motion = motion[sources, samples]
+
+            absolute = np.abs(calculate_qcfc(permuted_arrays, permuted_motion, basis))
+            permuted_sum[start:stop] += np.nansum(absolute, axis=-1)
+            permuted_count[start:stop] += np.count_nonzero(~np.isnan(absolute), axis=-1)
+            max_spread[start:stop] = np.maximum(max_spread[start:stop], get_spread(absolute).max(axis=-1, initial=-np.inf))
+
+    absolute_observed = np.abs(observed)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nanmean(absolute_observed, axis=-1) if edge_count > 0 else np.full(strategy_count, np.nan)
+        permuted_mean = permuted_sum / permuted_count
+    difference = mean[:, np.newaxis] - mean[np.newaxis, :]
+    permuted_difference = np.abs(permuted_mean[:, :, np.newaxis] - permuted_mean[:, np.newaxis, :])
+    exceed_count = (permuted_difference >= np.abs(difference) - 1e-12).sum(axis=0)
+    max_difference = permuted_difference.max(axis=(1, 2), initial=-np.inf)
+    max_exceed_count = (max_difference[:, np.newaxis, np.newaxis] >= np.abs(difference) - 1e-12).sum(axis=0)
+
+    p_value = (exceed_count + 1) / (permutation_count + 1)
+    corrected_p_value = (max_exceed_count + 1) / (permutation_count + 1)
+    np.fill_diagonal(p_value, 1.0)
+    np.fill_diagonal(corrected_p_value, 1.0)
+
+    # An edge of a pair is significant if few permutations have a larger paired difference at any edge of any pair
+    sorted_max_spread = np.sort(max_spread)
+    percentage_different_edges = np.zeros((strategy_count, strategy_count))
+    for i in range(strategy_count):
+        for j in range(i):
+            paired_difference = np.abs(absolute_observed[i] - absolute_observed[j])
+            paired_difference = paired_difference[~np.isnan(paired_difference)]
+            edge_exceed_count = permutation_count - np.searchsorted(sorted_max_spread, paired_difference - 1e-12, side="left")
+            edge_p_value = (edge_exceed_count + 1) / (permutation_count + 1)
+            if paired_difference.size > 0:
+                percentage_different_edges[i, j] = percentage_different_edges[j, i] = 100 * np.mean(edge_p_value < alpha)
+
+    return StrategyComparison(
+        labels=labels,
+        median_absolute_qcfc=np.nanmedian(absolute_observed, axis=-1) if edge_count > 0 else np.full(strategy_count, np.nan),
+        difference=difference,
+        p_value=p_value,
+        corrected_p_value=corrected_p_value,
+        percentage_different_edges=percentage_different_edges,
+        sample_count=sample_count,
+        permutation_count=permutation_count,
+    )
@@ -87,6 +87,19 @@ class FileIndex:
             self.tags_by_paths[path][key] = value
             self.paths_by_tags[key][value].add(path)
 
+    def remove(self, path: Path) -> None:
+        """
+        Remove a path and its tags from the index. Paths that are not in the index are ignored.
+        """
+        tags = self.tags_by_paths.pop(path, None)
+        if tags is None:
+            return
+        for key, value in tags.items():
+            paths = self.paths_by_tags[key][value]
+            paths.discard(path)
+            if not paths:
+                del self.paths_by_tags[key][value]
+
     def get_tag_mapping(self, key: str) -> Mapping[str, set[Path]]:
         return self.paths_by_tags[key]
 
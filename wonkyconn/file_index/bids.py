@@ -3,11 +3,29 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
 import json
+import os
 from pathlib import Path
-from typing import Any, MutableSequence
+from typing import Any, Iterable, Mapping
 
+import numpy as np
+
+from ..base import hdf5_extensions
 from .base import FileIndex
 
+# Attributes written by giga-connectome to HDF5 outputs, and the sidecar keys
+# that they correspond to
+hdf5_attribute_keys: Mapping[str, str] = {
+    "mean_framewise_displacement": "MeanFramewiseDisplacement",
+    "confound_regressors": "ConfoundRegressors",
+    "number_of_volumes_discarded_by_motion_scrubbing": "NumberOfVolumesDiscardedByMotionScrubbing",
+    "number_of_volumes_discarded_by_nonsteady_states_detector": "NumberOfVolumesDiscardedByNonsteadyStatesDetector",
+    "sampling_frequency": "SamplingFrequency",
+}
+# Dataset suffixes in HDF5 outputs that have a different name in BEP17
+hdf5_suffixes: Mapping[str, str] = {
+    "connectome": "relmat",
+}
+
 
 def split_ext(path: str | Path) -> tuple[str, str]:
     """Splits filename and extension (.gz safe)
@@ -37,6 +55,116 @@ def split_ext(path: str | Path) -> tuple[str, str]:
     return stem, name[len(stem) :]
 
 
+def split_name(name: str) -> tuple[str, str]:
+    """Splits a file name into stem and extension like `split_ext`, without creating `Path` objects.
+
+    >>> split_name("file.nii.gz")
+    ('file', '.nii.gz')
+    >>> split_name(".hidden")
+    ('.hidden', '')
+    """
+    safe_name = name
+    for compound_extension in [".gz", ".xz"]:
+        safe_name = safe_name.removesuffix(compound_extension)
+
+    if safe_name == ".":
+        safe_name = ""  # Like `Path(".").name`
+
+    # Same rule as `PurePath.suffix`
+    i = safe_name.rfind(".")
+    stem = safe_name[:i] if 0 < i < len(safe_name) - 1 else safe_name
+    return stem, name[len(stem) :]
+
+
+class FilenameParser:
+    """
+    Parses BIDS-formatted file names.
+
+    Parsed tokens are memoized, and their tag keys and values are interned, because
+    the same tokens (such as "task-rest" or "desc-simple") repeat across many files.
+    This means that the tags of all files share the same string objects. The memo of
+    the parser of an index is kept for the lifetime of the index. The shared parser that
+    `parse` uses lives as long as the module, so its memo is cleared when it exceeds
+    `max_size` entries.
+
+    Attributes:
+        max_size (int | None): The number of memoized tokens and strings at which the memo is
+            cleared, or None to keep it for the lifetime of the parser.
+    """
+
+    def __init__(self, max_size: int | None = None) -> None:
+        self.max_size = max_size
+        self.tokens: dict[str, tuple[str | None, str]] = dict()
+        self.strings: dict[str, str] = dict()
+
+    def intern(self, value: str) -> str:
+        return self.strings.setdefault(value, value)
+
+    def parse_token(self, token: str) -> tuple[str | None, str]:
+        parsed = self.tokens.get(token)
+        if parsed is None:
+            key, separator, value = token.partition("-")
+            if separator:  # A bids tag
+                parsed = (self.intern(key), self.intern(value))
+            else:  # A suffix
+                parsed = (None, self.intern(token))
+            self.tokens[token] = parsed
+        return parsed
+
+    def parse_name(self, name: str, parent_name: str) -> dict[str, str] | None:
+        """
+        Parses a BIDS-formatted file name with the same result as `parse`.
+
+        Args:
+            name (str): The name of the file, for example from `os.DirEntry.name`.
+            parent_name (str): The name of the directory that contains the file.
+
+        Returns:
+            dict[str, str] | None: A dictionary of the file's BIDS tags, or None if the
+                file is hidden.
+        """
+        stem, extension = split_name(name)
+        if stem.startswith("."):
+            return None  # Skip hidden files
+
+        if self.max_size is not None and len(self.tokens) + len(self.strings) > self.max_size:
+            self.tokens.clear()
+            self.strings.clear()
+
+        memo = self.tokens
+        tokens = [memo.get(token) or self.parse_token(token) for token in stem.split("_")]
+
+        # Extract bids suffixes
+        end = len(tokens)
+        while end > 0 and tokens[end - 1][0] is None:
+            end -= 1
+        if end == len(tokens) - 1:
+            suffix = tokens[-1][1]
+        else:
+            suffix = self.intern("_".join(value for _, value in tokens[end:]))
+
+        tags = dict(suffix=suffix)
+        if extension:
+            tags["extension"] = self.intern(extension)
+        if parent_name in ("anat", "func", "fmap"):
+            tags["datatype"] = self.intern(parent_name)
+
+        for i in range(end):
+            key, value = tokens[i]
+            if key is None:
+                continue
+            # Merge the first other suffix with its preceding tag value
+            if i + 1 < end and tokens[i + 1][0] is None:
+                value = f"{value}_{tokens[i + 1][1]}"
+            tags[key] = value
+        return tags
+
+
+# The parser behind `parse`, so that repeated calls share its memo. The memo is bounded,
+# so that a long-running process that calls `parse` does not grow a global cache
+filename_parser = FilenameParser(max_size=2**16)
+
+
 def parse(path: Path) -> dict[str, str] | None:
     """
     Parses a BIDS-formatted filename and returns a dictionary of its tags.
@@ -50,68 +178,154 @@ def parse(path: Path) -> dict[str, str] | None:
     """
     if path.is_dir():
         return None  # Skip directories
+    return filename_parser.parse_name(path.name, path.parent.name)
 
-    stem, extension = split_ext(path)
-    if stem.startswith("."):
-        return None  # Skip hidden files
 
-    tokens = stem.split("_")
+def to_metadata_value(value: Any) -> Any:
+    """
+    Converts an HDF5 attribute value to the equivalent JSON sidecar value.
 
-    # Parse tokens
-    keys: MutableSequence[str | None] = list()
-    values: MutableSequence[str] = list()
-    for token in tokens:
-        if "-" in token:  # A bids tag
-            key: str | None = token.split("-")[0]
-            if key is None:
-                continue
-            keys.append(key)
-            values.append(token[len(key) + 1 :])
-
-        else:  # A suffix
-            keys.append(None)
-            values.append(token)
-
-    # Extract bids suffixes
-    suffixes: list[str] = list()
-    while keys and keys[-1] is None:
-        keys.pop(-1)
-        suffixes.insert(0, values.pop(-1))
-
-    # Merge other suffixes with their preceding tag value
-    for i, (key, value) in enumerate(zip(keys, values, strict=False)):
-        if i < 1:
-            continue
-        if key is None:
-            values[i - 1] += f"_{value}"
-
-    # Build tags
-    tags = dict(
-        suffix="_".join(suffixes),
-    )
-    if extension:
-        tags["extension"] = extension
-    parent_name = Path(str(path.parent)).name
-    if parent_name in ("anat", "func", "fmap"):
-        tags["datatype"] = parent_name
-    for key, value in zip(keys, values, strict=False):
-        if key is not None:
-            tags[key] = value
-    return tags
+    >>> to_metadata_value(np.int64(5))
+    5
+    >>> to_metadata_value(np.array([b"csf", b"white_matter"]))
+    ['csf', 'white_matter']
+    """
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return [to_metadata_value(item) for item in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def to_metadata(attributes: Mapping[str, Any]) -> dict[str, Any]:
+    return {hdf5_attribute_keys.get(key, key): to_metadata_value(value) for key, value in attributes.items()}
 
 
 class BIDSIndex(FileIndex):
+    def __init__(self) -> None:
+        super().__init__()
+        self.metadata_by_paths: dict[Path, dict[str, Any]] = dict()
+        self.parser = FilenameParser()
+
+    def copy(self) -> "BIDSIndex":
+        """
+        Copy the index, so that it can be updated while the original is still in use. The tags and
+        metadata of each path are shared, because the index replaces them instead of changing them.
+        """
+        index = BIDSIndex()
+        index.parser = self.parser
+        for key, paths_by_value in self.paths_by_tags.items():
+            index.paths_by_tags[key].update({value: set(paths) for value, paths in paths_by_value.items()})
+        index.tags_by_paths.update(self.tags_by_paths)
+        index.metadata_by_paths.update(self.metadata_by_paths)
+        return index
+
     def put(self, root: Path) -> None:
-        for path in root.glob("**/*"):
-            tags = parse(path)
+        """
+        Adds all files below a directory to the index.
+
+        The directory tree is walked with `os.scandir`, so that the file type is usually
+        known without an extra system call, and file names are parsed as strings.
+        """
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Like `Path.glob`, symbolic links to directories are not followed
+                        if not entry.is_symlink():
+                            directories.append(directory / entry.name)
+                        continue
+                    tags = self.parser.parse_name(entry.name, directory.name)
+                    if tags is not None:
+                        self.put_tags(directory / entry.name, tags)
 
-            if tags is None:
-                continue  # not a valid path
+    def put_path(self, path: Path) -> None:
+        if path.is_dir():
+            return  # Skip directories
+        tags = self.parser.parse_name(path.name, path.parent.name)
+        if tags is not None:
+            self.put_tags(path, tags)
 
-            for key, value in tags.items():
-                self.paths_by_tags[key][value].add(path)
+    def put_tags(self, path: Path, tags: dict[str, str]) -> None:
+        if tags.get("extension") in hdf5_extensions:
+            self.put_hdf5(path)
+            return
 
-            self.tags_by_paths[path] = tags
+        self.add(path, tags)
+
+    def remove(self, path: Path) -> None:
+        """
+        Removes a path from the index. For an HDF5 file, the datasets inside it are removed.
+        """
+        if split_ext(path)[1] in hdf5_extensions:
+            for dataset_path in [p for p in self.tags_by_paths if path in p.parents]:
+                self.remove(dataset_path)
+        super().remove(path)
+        self.metadata_by_paths.pop(path, None)
+
+    def update(self, changed_paths: Iterable[Path], removed_paths: Iterable[Path]) -> None:
+        """
+        Updates the index for files that were added, changed or removed since it was created.
+
+        Args:
+            changed_paths (Iterable[Path]): The files that were added or changed.
+            removed_paths (Iterable[Path]): The files that were removed.
+        """
+        changed_paths = list(changed_paths)
+        for path in [*removed_paths, *changed_paths]:
+            self.remove(path)
+        for path in changed_paths:
+            if path.is_file():
+                self.put_path(path)
+
+    def add(self, path: Path, tags: dict[str, str]) -> None:
+        for key, value in tags.items():
+            self.paths_by_tags[key][value].add(path)
+
+        self.tags_by_paths[path] = tags
+
+    def put_hdf5(self, hdf5_path: Path) -> None:
+        """
+        Adds the datasets inside an HDF5 file to the index.
+
+        Each dataset is indexed under a path that continues past the HDF5 file
+        (see `split_hdf5_path`), with the tags parsed from the dataset name.
+        The attributes of the file, its groups and the dataset are used as metadata.
+        """
+        import h5py
+
+        with h5py.File(hdf5_path, "r") as file:
+            file_metadata = to_metadata(file.attrs)
+
+            def visit(name: str, node: h5py.HLObject) -> None:
+                if not isinstance(node, h5py.Dataset):
+                    return
+
+                path = hdf5_path / name
+                tags = self.parser.parse_name(path.name, path.parent.name)
+                if tags is None:
+                    return
+                tags["suffix"] = hdf5_suffixes.get(tags["suffix"], tags["suffix"])
+                tags["extension"] = hdf5_path.suffix
+
+                metadata = dict(file_metadata)
+                parent = node.parent
+                groups: list[h5py.Group] = []
+                while parent.name != "/":
+                    groups.insert(0, parent)
+                    parent = parent.parent
+                for group in groups:
+                    metadata.update(to_metadata(group.attrs))
+                metadata.update(to_metadata(node.attrs))
+
+                self.add(path, tags)
+                self.metadata_by_paths[path] = metadata
+
+            file.visititems(visit)
 
     def get_metadata(self, path: Path) -> dict[str, Any]:
         metadata: dict[str, Any] = dict()
@@ -120,4 +334,6 @@ class BIDSIndex(FileIndex):
             with metadata_path.open("r") as file:
                 metadata.update(json.load(file))
 
+        metadata.update(self.metadata_by_paths.get(path, dict()))
+
         return metadata
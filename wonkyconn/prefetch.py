@@ -0,0 +1,113 @@
+"""
+Load the connectivity matrices of upcoming groups in the background while the
+current group is being evaluated.
+"""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Generic, Hashable, Iterator, Mapping, Sequence, TypeVar
+
+import numpy as np
+from numpy import typing as npt
+
+from .base import ConnectivityMatrix
+from .logger import gc_log
+
+Key = TypeVar("Key", bound=Hashable)
+
+
+def estimate_connectivity_array_size(connectivity_matrices: Sequence[ConnectivityMatrix]) -> int:
+    """
+    Estimate the number of bytes needed for the array returned by `load_connectivity_array`.
+
+    Only the first connectivity matrix is inspected, because reading the header of every
+    file would defeat the purpose of loading them in the background.
+    """
+    if not connectivity_matrices:
+        return 0
+    n = connectivity_matrices[0].region_count
+    return n * (n - 1) // 2 * len(connectivity_matrices) * np.dtype(np.float64).itemsize
+
+
+class PendingGroup:
+    def __init__(self, executor: ThreadPoolExecutor, connectivity_matrices: Sequence[ConnectivityMatrix]) -> None:
+        self.size = estimate_connectivity_array_size(connectivity_matrices)
+
+        n = connectivity_matrices[0].region_count if connectivity_matrices else 0
+        self.connectivity_array = np.empty((n * (n - 1) // 2, len(connectivity_matrices)))
+        self.futures: list[Future[None]] = [
+            executor.submit(self._load, k, connectivity_matrix) for k, connectivity_matrix in enumerate(connectivity_matrices)
+        ]
+
+    def _load(self, k: int, connectivity_matrix: ConnectivityMatrix) -> None:
+        self.connectivity_array[:, k] = connectivity_matrix.load_lower_triangle()
+
+    def result(self) -> npt.NDArray[np.float64]:
+        for future in self.futures:
+            future.result()  # Raises any exception from loading
+        return self.connectivity_array
+
+
+class Prefetcher(Generic[Key]):
+    """
+    Iterate over groups of connectivity matrices together with their loaded
+    connectivity arrays (see `load_connectivity_array`).
+
+    While the caller evaluates one group, the connectivity matrices of the following
+    groups are read and parsed by a pool of threads. Reading ahead stops when the
+    estimated size of the arrays that have been loaded but not yet returned would
+    exceed the memory budget. A group that does not fit into the budget is only
+    loaded when the caller asks for it. Groups without connectivity matrices
+    are returned with an empty array.
+
+    Attributes:
+        groups (Mapping[Key, Sequence[ConnectivityMatrix]]): The connectivity matrices for each group.
+        memory_budget (int): The maximum number of bytes to read ahead. Set to zero to disable prefetching.
+        thread_count (int): The number of threads used for loading.
+    """
+
+    def __init__(
+        self,
+        groups: Mapping[Key, Sequence[ConnectivityMatrix]],
+        memory_budget: int,
+        thread_count: int | None = None,
+    ) -> None:
+        self.groups = groups
+        self.memory_budget = memory_budget
+        if thread_count is None:
+            thread_count = min(8, os.cpu_count() or 1)
+        self.thread_count = thread_count
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    def __iter__(self) -> Iterator[tuple[Key, Sequence[ConnectivityMatrix], npt.NDArray[np.float64]]]:
+        keys = list(self.groups.keys())
+        pending: dict[int, PendingGroup] = dict()
+
+        with ThreadPoolExecutor(max_workers=self.thread_count, thread_name_prefix="prefetch") as executor:
+            try:
+                for k, key in enumerate(keys):
+                    if k not in pending:
+                        pending[k] = PendingGroup(executor, self.groups[key])
+
+                    # Read ahead as far as the memory budget allows
+                    read_ahead_size = sum(pending_group.size for i, pending_group in pending.items() if i > k)
+                    for i in range(k + 1, len(keys)):
+                        if i in pending:
+                            continue
+                        size = estimate_connectivity_array_size(self.groups[keys[i]])
+                        if read_ahead_size + size > self.memory_budget:
+                            break
+                        gc_log.debug(f"Prefetching group {keys[i]}")
+                        pending[i] = PendingGroup(executor, self.groups[keys[i]])
+                        read_ahead_size += size
+
+                    connectivity_array = pending.pop(k).result()
+                    yield key, self.groups[key], connectivity_array
+            finally:
+                for pending_group in pending.values():
+                    for future in pending_group.futures:
+                        future.cancel()
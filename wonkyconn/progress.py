@@ -0,0 +1,276 @@
+"""
+Report the progress of a run in a machine-readable form.
+
+Long runs are monitored by orchestration tools, which should not need to parse the
+log. The `progress` of the current run keeps the current stage, the number of groups
+that are done and pending, and the number of connectivity matrices and bytes that
+were read from disk. It is written as a JSON status file that is replaced atomically
+every few seconds (see `StatusWriter`), and can be served in the Prometheus text
+format on `GET /metrics` on localhost (see `MetricsServer`).
+
+The counters are updated where connectivity matrices are read, so they include the
+matrices that are loaded by the prefetcher, the scheduler and the shared edge store.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from .logger import gc_log
+from .records import replace_non_finite
+
+
+class Progress:
+    """
+    The progress of a run. All methods can be called from several threads.
+
+    Attributes:
+        clock (Callable[[], float]): The clock that elapsed times are measured with.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Start a new run.
+        """
+        with self.lock:
+            self.stage = "starting"
+            self.start_time = self.clock()
+            self.started = time.time()
+            self.group_count = 0
+            self.done_count = 0
+            self.matrix_count = 0
+            self.byte_count = 0
+            # The groups that were added while others were pending are evaluated as one batch,
+            # and the time per group of the current batch is used for the ETA
+            self.batch_start_time = self.start_time
+            self.batch_done_count = 0
+
+    def set_stage(self, stage: str) -> None:
+        with self.lock:
+            self.stage = stage
+
+    def add_groups(self, count: int) -> None:
+        """
+        Add groups that will be evaluated. A negative count removes groups that will not be evaluated after all.
+        """
+        with self.lock:
+            if self.group_count == self.done_count:
+                self.batch_start_time = self.clock()
+                self.batch_done_count = 0
+            self.group_count += count
+
+    def finish_group(self) -> None:
+        with self.lock:
+            self.done_count += 1
+            self.batch_done_count += 1
+
+    def add_matrix(self, byte_count: int) -> None:
+        """
+        Count a connectivity matrix that was read from disk.
+
+        Parameters:
+            byte_count (int): The number of bytes that were read.
+        """
+        with self.lock:
+            self.matrix_count += 1
+            self.byte_count += byte_count
+
+    def get_status(self) -> dict[str, Any]:
+        """
+        Returns:
+            dict[str, Any]: The progress as a JSON-serializable dictionary. The ETA is None while it cannot be estimated.
+        """
+        with self.lock:
+            now = self.clock()
+            elapsed = now - self.start_time
+            pending_count = max(self.group_count - self.done_count, 0)
+            eta: float | None = None
+            if pending_count == 0:
+                eta = 0.0
+            elif self.batch_done_count > 0:
+                eta = (now - self.batch_start_time) / self.batch_done_count * pending_count
+            return dict(
+                stage=self.stage,
+                started=self.started,
+                updated=time.time(),
+                elapsed_seconds=elapsed,
+                groups_total=self.group_count,
+                groups_done=self.done_count,
+                groups_pending=pending_count,
+                matrices_loaded=self.matrix_count,
+                bytes_read=self.byte_count,
+                matrices_per_second=self.matrix_count / elapsed if elapsed > 0 else 0.0,
+                eta_seconds=eta,
+            )
+
+    def format_metrics(self) -> str:
+        """
+        Returns:
+            str: The progress in the Prometheus text format.
+        """
+        status = self.get_status()
+        lines: list[str] = []
+        for name, kind, description, value in [
+            ("groups_total", "gauge", "The number of groups to evaluate.", status["groups_total"]),
+            ("groups_done_total", "counter", "The number of groups that were evaluated.", status["groups_done"]),
+            ("groups_pending", "gauge", "The number of groups that are left to evaluate.", status["groups_pending"]),
+            ("matrices_loaded_total", "counter", "The number of connectivity matrices that were read.", status["matrices_loaded"]),
+            ("bytes_read_total", "counter", "The number of bytes of connectivity matrices that were read.", status["bytes_read"]),
+            ("matrices_per_second", "gauge", "The average number of connectivity matrices read per second.", status["matrices_per_second"]),
+            ("elapsed_seconds", "gauge", "The time since the run started.", status["elapsed_seconds"]),
+            ("eta_seconds", "gauge", "The estimated time until all groups are evaluated.", status["eta_seconds"]),
+        ]:
+            lines.append(f"# HELP wonkyconn_{name} {description}")
+            lines.append(f"# TYPE wonkyconn_{name} {kind}")
+            lines.append(f"wonkyconn_{name} {format_value(value)}")
+        lines.append("# HELP wonkyconn_stage The current stage of the run.")
+        lines.append("# TYPE wonkyconn_stage gauge")
+        lines.append(f'wonkyconn_stage{{stage="{status["stage"]}"}} 1')
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value: float | None) -> str:
+    """
+    >>> format_value(3), format_value(0.25), format_value(None)
+    ('3', '0.25', 'NaN')
+    """
+    if value is None or math.isnan(value):
+        return "NaN"
+    return repr(value)
+
+
+progress = Progress()
+
+
+def format_status(status: dict[str, Any], indent: int | None = None) -> str:
+    """
+    Format the status as strict JSON, with null for the values that are not finite.
+    """
+    return json.dumps(replace_non_finite(status), indent=indent, allow_nan=False)
+
+
+def write_status(path: Path, status: dict[str, Any]) -> None:
+    """
+    Write the status as JSON, replacing the file atomically so that readers never see a partial file.
+    """
+    temporary_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    temporary_path.write_text(format_status(status, indent=2))
+    os.replace(temporary_path, path)
+
+
+class StatusWriter(threading.Thread):
+    """
+    Write the status of a `Progress` to a JSON file at a regular interval, and once more when stopped.
+
+    Attributes:
+        path (Path): The status file.
+        interval (float): The time between writes in seconds.
+    """
+
+    def __init__(self, path: Path, progress: Progress, interval: float = 2.0) -> None:
+        super().__init__(name="wonkyconn-status", daemon=True)
+        self.path = path
+        self.progress = progress
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        try:
+            write_status(self.path, self.progress.get_status())
+        except OSError as e:
+            gc_log.warning(f'Could not write the status file "{self.path}": {e}')
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+        self.write()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    server: MetricsServer
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self.send_body(200, "text/plain; version=0.0.4", self.server.progress.format_metrics().encode())
+        elif self.path == "/status":
+            self.send_body(200, "application/json", format_status(self.server.progress.get_status()).encode())
+        else:
+            self.send_body(404, "text/plain", f"Unknown path {self.path}\n".encode())
+
+    def send_body(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        gc_log.debug(format % args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Serve the progress in the Prometheus text format on `GET /metrics`, and as JSON on `GET /status`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], progress: Progress) -> None:
+        super().__init__(address, MetricsRequestHandler)
+        self.progress = progress
+
+
+@contextmanager
+def report_progress(status_file: Path | None = None, metrics_port: int | None = None) -> Iterator[Progress]:
+    """
+    Reset the `progress` for a new run, and report it while the context is active. The stage is set
+    to "done" or "failed" at the end.
+
+    Parameters:
+        status_file (Path | None, optional): Keep this JSON file updated with the status. Defaults to None.
+        metrics_port (int | None, optional): Serve the metrics on this port on localhost. Zero picks a free port.
+            Defaults to None, which does not start a server.
+    """
+    progress.reset()
+    status_writer: StatusWriter | None = None
+    if status_file is not None:
+        status_writer = StatusWriter(status_file, progress)
+        status_writer.write()
+        status_writer.start()
+    server: MetricsServer | None = None
+    if metrics_port is not None:
+        server = MetricsServer(("127.0.0.1", metrics_port), progress)
+        host, port = server.server_address[:2]
+        gc_log.info(f"Serving metrics on http://{host!s}:{port}/metrics")
+        threading.Thread(target=server.serve_forever, name="wonkyconn-metrics", daemon=True).start()
+
+    try:
+        yield progress
+    except BaseException:
+        progress.set_stage("failed")
+        raise
+    else:
+        progress.set_stage("done")
+    finally:
+        if status_writer is not None:
+            status_writer.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,179 @@
+"""
+Approximate the metrics of a group from a random sample of its edges.
+
+With `--quick`, QC-FC is only calculated for a random sample of the edges, and
+optionally for a random sample of the subjects of each group. Only the sampled
+values are read from HDF5 datasets and sparse connectivity matrices. The metrics
+are summaries over edges, so the error from sampling edges can be estimated from
+the sample itself, and each metric is reported with confidence bounds.
+
+Sampling subjects is not covered by the bounds. It lowers the power of the QC-FC
+tests, so the percentage of significant edges is biased downwards.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Mapping, Sequence
+
+import numpy as np
+import scipy.stats
+from numpy import typing as npt
+
+from .atlas import Atlas
+from .base import ConnectivityMatrix, SparseConnectivityArray, get_group_region_count
+from .correlation import correlation_significant
+from .features.distance_dependence import calculate_distance_dependence, get_edge_distances, get_valid_edges
+from .features.quality_control_connectivity import QCFCResult, make_column_name
+
+
+def sample_edges(region_count: int, edge_count: int, seed: int = 0) -> npt.NDArray[np.int64]:
+    """
+    Draw a random sample of edges without replacement.
+
+    The sample only depends on the number of regions and the seed, so groups with
+    the same atlas are evaluated on the same edges.
+
+    Parameters:
+        region_count (int): The number of regions.
+        edge_count (int): The number of edges to sample. All edges are returned if there are fewer.
+        seed (int, optional): The seed for the random number generator. Defaults to 0.
+
+    Returns:
+        ndarray: The sorted positions of the sampled edges (see `get_edge_indices`).
+    """
+    total = region_count * (region_count - 1) // 2
+    if edge_count >= total:
+        return np.arange(total, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(total, size=edge_count, replace=False)).astype(np.int64)
+
+
+def sample_subjects(subjects: Sequence[str], subject_count: int, seed: int = 0) -> npt.NDArray[np.int64]:
+    """
+    Draw a random sample of subjects, keeping all connectivity matrices of the sampled subjects.
+
+    Parameters:
+        subjects (Sequence[str]): The subject of each connectivity matrix.
+        subject_count (int): The number of subjects to sample. All subjects are kept if there are fewer.
+        seed (int, optional): The seed for the random number generator. Defaults to 0.
+
+    Returns:
+        ndarray: The sorted positions of the connectivity matrices of the sampled subjects.
+    """
+    unique_subjects = sorted(set(subjects))
+    if subject_count >= len(unique_subjects):
+        return np.arange(len(subjects), dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    sampled = set(rng.choice(unique_subjects, size=subject_count, replace=False))
+    return np.asarray([k for k, subject in enumerate(subjects) if subject in sampled], dtype=np.int64)
+
+
+def load_edge_sample(connectivity_matrices: Sequence[ConnectivityMatrix], edge_indices: npt.NDArray[np.int64]) -> SparseConnectivityArray:
+    """
+    Load the sampled edges of connectivity matrices.
+
+    Edges that are missing from sparse connectivity matrices are left out, so the
+    result can be evaluated with `calculate_sparse_qcfc` for dense and sparse groups.
+
+    Parameters:
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices of a group.
+        edge_indices (ndarray): The sorted positions of the edges to load.
+
+    Returns:
+        SparseConnectivityArray: The sampled edges.
+    """
+    region_count = get_group_region_count(connectivity_matrices)
+    edges: list[tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]]] = []
+    for connectivity_matrix in connectivity_matrices:
+        values = connectivity_matrix.load_lower_triangle_sample(edge_indices)
+        present = ~np.isnan(values)
+        edges.append((edge_indices[present], values[present]))
+    return SparseConnectivityArray.from_edges(region_count, edges)
+
+
+def calculate_median_bounds(x: npt.NDArray[np.float64], confidence: float = 0.95) -> tuple[float, float]:
+    """
+    Calculate a distribution-free confidence interval for the median from the order statistics of a sample.
+
+    >>> calculate_median_bounds(np.arange(101, dtype=np.float64))
+    (40.0, 60.0)
+    """
+    x = np.sort(x[~np.isnan(x)])
+    n = x.size
+    if n == 0:
+        return np.nan, np.nan
+    # The number of values below the median is binomial with p = 1/2
+    lower = int(scipy.stats.binom.ppf((1 - confidence) / 2, n, 0.5))
+    upper = int(scipy.stats.binom.isf((1 - confidence) / 2, n, 0.5))
+    return float(x[max(lower - 1, 0)]), float(x[min(upper, n - 1)])
+
+
+def calculate_proportion_bounds(successes: int, n: int, confidence: float = 0.95) -> tuple[float, float]:
+    """
+    Calculate the Wilson score interval for a proportion.
+
+    >>> [round(bound, 3) for bound in calculate_proportion_bounds(10, 100)]
+    [0.055, 0.174]
+    """
+    if n == 0:
+        return np.nan, np.nan
+    z = scipy.stats.norm.isf((1 - confidence) / 2)
+    p = successes / n
+    center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+    half_width = z / (1 + z**2 / n) * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+    return float(max(0.0, center - half_width)), float(min(1.0, center + half_width))
+
+
+def calculate_rank_correlation_bounds(r: float, n: int, confidence: float = 0.95) -> tuple[float, float]:
+    """
+    Calculate a confidence interval for the absolute value of a Spearman correlation
+    with the Fisher transformation and the variance of Fieller, Hartley and Pearson (1957).
+    """
+    if n <= 3 or np.isnan(r):
+        return np.nan, np.nan
+    z = scipy.stats.norm.isf((1 - confidence) / 2)
+    standard_error = np.sqrt(1.06 / (n - 3))
+    center = np.arctanh(np.clip(r, -0.999999, 0.999999))
+    lower, upper = np.tanh(center - z * standard_error), np.tanh(center + z * standard_error)
+    return float(max(lower, 0.0)), float(upper)
+
+
+def calculate_bounds(
+    qcfc_by_metric: Mapping[str, QCFCResult],
+    atlas: Atlas | npt.NDArray[np.float64] | None = None,
+    confidence: float = 0.95,
+) -> dict[str, Any]:
+    """
+    Calculate confidence bounds for the QC-FC metrics of `metrics.tsv` from a sample of edges.
+
+    The bounds are saved with the suffixes "_lower" and "_upper", and only cover the error
+    from sampling edges.
+
+    Parameters:
+        qcfc_by_metric (Mapping[str, QCFCResult]): The QC-FC values of the sampled edges for each motion metric.
+        atlas (Atlas | ndarray | None, optional): The atlas or the distances between its regions (see `summarize_qcfc`).
+            Defaults to None, which skips the distance dependence.
+        confidence (float, optional): The confidence level. Defaults to 0.95.
+
+    Returns:
+        dict[str, Any]: The bounds of each metric.
+    """
+    metric_keys = list(qcfc_by_metric.keys())
+    record: dict[str, Any] = dict()
+
+    def add(name: str, metric_key: str, bounds: tuple[float, float]) -> None:
+        column_name = make_column_name(name, metric_key, metric_keys)
+        record[f"{column_name}_lower"], record[f"{column_name}_upper"] = bounds
+
+    for metric_key, qcfc in qcfc_by_metric.items():
+        add("median_absolute_qcfc", metric_key, calculate_median_bounds(np.abs(qcfc.correlation), confidence))
+
+        significant = correlation_significant(qcfc.correlation, qcfc.sample_count)
+        lower, upper = calculate_proportion_bounds(int(significant.sum()), significant.size, confidence)
+        add("percentage_significant_qcfc", metric_key, (100 * lower, 100 * upper))
+
+        if atlas is not None:
+            distance_dependence = calculate_distance_dependence(qcfc, atlas)
+            valid_count = int(np.count_nonzero(get_valid_edges(qcfc, get_edge_distances(qcfc, atlas))))
+            add("distance_dependence", metric_key, calculate_rank_correlation_bounds(distance_dependence, valid_count, confidence))
+    return record
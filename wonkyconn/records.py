@@ -0,0 +1,68 @@
+"""
+Save and load the metric records of groups, so that the records of separate
+runs can be combined into the final `metrics.tsv` and `metrics.png`.
+"""
+
+import json
+import math
+from pathlib import Path
+from typing import Any, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def save_records(path: Path, group_by: Sequence[str], records: Sequence[dict[str, Any]]) -> None:
+    """
+    Save metric records to a JSON file.
+
+    The file is written to a temporary path first and then renamed, so that
+    an interrupted run never leaves a partial file behind.
+
+    Parameters:
+        path (Path): The path to the JSON file.
+        group_by (Sequence[str]): The tags that the records are grouped by.
+        records (Sequence[dict[str, Any]]): The records, which contain the group tags and the metrics.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(f".{path.name}.tmp")
+    with temporary_path.open("w") as file:
+        json.dump(dict(group_by=list(group_by), records=list(records)), file, indent=4)
+    temporary_path.replace(path)
+
+
+def load_records(path: Path) -> tuple[list[str], list[dict[str, Any]]]:
+    """
+    Load metric records from a JSON file written by `save_records`.
+
+    Returns:
+        tuple[list[str], list[dict[str, Any]]]: The tags that the records are grouped by, and the records.
+    """
+    with path.open("r") as file:
+        content = json.load(file)
+    return content["group_by"], content["records"]
+
+
+def make_result_frame(records: Sequence[dict[str, Any]], group_by: Sequence[str]) -> pd.DataFrame:
+    """
+    Make the data frame that is saved as `metrics.tsv`, sorted by the group tags.
+    """
+    result_frame = pd.DataFrame.from_records(list(records), index=list(group_by))
+    return result_frame.sort_index()
+
+
+def replace_non_finite(content: Any) -> Any:
+    """
+    Replace the floats that are NaN or infinite with None, so that the content can be
+    written as strict JSON, where they become null.
+
+    >>> replace_non_finite(dict(a=[1.0, float("nan")], b=float("inf"), c="text"))
+    {'a': [1.0, None], 'b': None, 'c': 'text'}
+    """
+    if isinstance(content, (float, np.floating)):
+        return content if math.isfinite(content) else None
+    if isinstance(content, dict):
+        return {key: replace_non_finite(value) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [replace_non_finite(value) for value in content]
+    return content
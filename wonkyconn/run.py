@@ -1,17 +1,114 @@
 from __future__ import annotations
 
 import argparse
+import sys
 from pathlib import Path
-from typing import Sequence
+from typing import Any, Sequence
 
 from . import __version__
-from .workflow import workflow, gc_log
+from .atlas import region_distances
+from .service import serve
+from .workflow import merge, workflow, gc_log
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parses a shard specification of the form "K/N".
+
+    >>> parse_shard("2/8")
+    (2, 8)
+    """
+    try:
+        shard_index_str, shard_count_str = value.split("/")
+        shard_index, shard_count = int(shard_index_str), int(shard_count_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard "{value}" is not of the form K/N')
+    if not 1 <= shard_index <= shard_count:
+        raise argparse.ArgumentTypeError(f'Shard "{value}" needs to satisfy 1 <= K <= N')
+    return shard_index, shard_count
+
+
+def parse_memory_size(value: str) -> int:
+    """
+    Parses a number of bytes with an optional unit suffix.
+
+    >>> parse_memory_size("512M")
+    536870912
+    >>> parse_memory_size("1.5G")
+    1610612736
+    >>> parse_memory_size("0")
+    0
+    """
+    units = dict(K=2**10, M=2**20, G=2**30, T=2**40)
+    value = value.strip().upper().removesuffix("B")
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Memory size "{value}" is not a number with an optional unit K, M, G or T')
+
+
+# The options that cannot be used together, with the reason
+conflicting_options: list[tuple[str, str, str]] = [
+    ("--watch", "--shard", "each run needs to watch all groups"),
+    ("--compare", "--shard", "the comparison needs all groups"),
+    ("--deduplicate", "--accumulator-dir", "the accumulators need the connectivity matrices of each group"),
+    ("--leave-one-out", "--accumulator-dir", "the influence needs all connectivity matrices of a group at the same time"),
+    ("--quick", "--accumulator-dir", "approximate results cannot be accumulated"),
+    ("--quick", "--leave-one-out", "the influence is not approximated"),
+    ("--quick", "--resume", "approximate results cannot be resumed"),
+]
+# The options that need a single `--group-by`
+single_grouping_options: list[str] = ["--shard", "--watch", "--accumulator-dir", "--compare"]
+
+
+def get_option_value(args: argparse.Namespace, option: str) -> Any:
+    return getattr(args, option.removeprefix("--").replace("-", "_"))
+
+
+def get_argument_problems(args: argparse.Namespace) -> list[str]:
+    """
+    Check the combinations of the options of the workflow.
+
+    Returns:
+        list[str]: A description of each combination of options that cannot be used together.
+    """
+    problems: list[str] = list()
+    for option, other_option, reason in conflicting_options:
+        if get_option_value(args, option) and get_option_value(args, other_option):
+            problems.append(f"`{option}` cannot be combined with `{other_option}`, because {reason}")
+
+    groupings = {tuple(group_by) for group_by in args.group_by or []}
+    if len(groupings) > 1:
+        for option in single_grouping_options:
+            if get_option_value(args, option):
+                problems.append(f"Several `--group-by` values cannot be combined with `{option}`")
+    return problems
+
+
+class WorkflowParser(argparse.ArgumentParser):
+    """
+    Parse the options of the workflow, and reject the combinations of options that cannot be used together
+    (see `get_argument_problems`).
+    """
+
+    def parse_known_args(  # type: ignore[override]
+        self, args: Sequence[str] | None = None, namespace: argparse.Namespace | None = None
+    ) -> tuple[argparse.Namespace, list[str]]:
+        namespace, extras = super().parse_known_args(args, namespace)
+        problems = get_argument_problems(namespace)
+        if problems:
+            self.error("\n".join(problems))
+        return namespace, extras
 
 
 def global_parser() -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser(
+    parser = WorkflowParser(
         formatter_class=argparse.RawTextHelpFormatter,
         description=("Evaluating the residual motion in fMRI connectome and visualize reports"),
+        epilog="Run `wonkyconn --merge -h` and `wonkyconn --serve -h` for the commands that combine the results of shards "
+        "and run the evaluation service. These options need to be the first argument.",
     )
 
     # BIDS app required arguments
@@ -37,8 +134,11 @@ def global_parser() -> argparse.ArgumentParser:
         "--group-by",
         type=str,
         nargs="+",
-        default=["seg"],
-        help="Select which tags to group the connectivity matrices by. Default is `seg`.",
+        action="append",
+        help="Select which tags to group the connectivity matrices by. Default is `seg`. "
+        "Repeat the option to compare several groupings in one run, for example `--group-by seg --group-by seg desc`. "
+        "The connectivity matrices are then loaded once and shared by all groupings, and the results of each "
+        "grouping are saved as `metrics_{tags}.tsv` and `metrics_{tags}.png`.",
     )
     parser.add_argument(
         "--phenotypes",
@@ -55,7 +155,288 @@ def global_parser() -> argparse.ArgumentParser:
         default=list(),
         help="Specify the atlas file to use for a segmentation label in the data",
     )
+    parser.add_argument(
+        "--seg-to-labels",
+        type=str,
+        nargs=2,
+        action="append",
+        metavar=("SEG", "LABELS"),
+        default=list(),
+        help="Specify the label file with the region names or networks of the atlas for a segmentation label. "
+        "Default is the `.tsv` file next to the atlas file.",
+    )
+    parser.add_argument(
+        "--region-distance",
+        choices=sorted(region_distances.keys()),
+        default="centroid",
+        help="How to measure the distance between atlas regions for the distance dependence. `centroid` uses the "
+        "distance between the region centroids, and `minimum` uses the smallest distance between the surface voxels "
+        "of the regions, which is slower. Default is `centroid`.",
+    )
+    parser.add_argument(
+        "--motion-metrics",
+        type=str,
+        nargs="+",
+        default=["MeanFramewiseDisplacement"],
+        help="Select which metadata keys to use as motion metrics for QC-FC. Default is `MeanFramewiseDisplacement`. "
+        "The first metric is used for the plot. The results for other metrics are added to `metrics.tsv` "
+        "as columns with the metric name as a suffix.",
+    )
+    parser.add_argument(
+        "--export-edges",
+        action="store_true",
+        default=False,
+        help="Save the edge-level QC-FC correlations and p-values of each group as `.npy` files "
+        "with a JSON index in the `edges` subdirectory of the output directory.",
+    )
+    parser.add_argument(
+        "--network-blocks",
+        action="store_true",
+        default=False,
+        help="Calculate the median absolute QC-FC and the percentage of significant QC-FC edges within and between "
+        "the networks of the atlas. The results are saved as one `.tsv` file per group in the `network_blocks` "
+        "subdirectory of the output directory.",
+    )
+    parser.add_argument(
+        "--leave-one-out",
+        action="store_true",
+        default=False,
+        help="Calculate how much each subject changes the QC-FC metrics of each group by leaving out "
+        "all connectivity matrices of the subject. The results are saved as one `.tsv` file per group "
+        "in the `influence` subdirectory of the output directory.",
+    )
+    parser.add_argument(
+        "--accumulator-dir",
+        type=Path,
+        metavar="DIR",
+        help="Keep the sums of products needed for QC-FC of each group in this directory. Connectivity matrices "
+        "that were added in a previous run are not loaded again, so that new subjects can be added to a growing "
+        "cohort. Subjects that were added before do not need to be in the phenotypes file anymore, unless `--compare` "
+        "is used.",
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        default=False,
+        help="Compare the groups as denoising strategies on the connectivity matrices that all of them share, which are "
+        "matched by their tags other than the `--group-by` tags. For each edge, the paired difference of the absolute "
+        "QC-FC between all pairs of groups is tested with permutations that swap the groups within each connectivity "
+        "matrix. The results are saved as group by group matrices: the mean paired difference in "
+        "`comparison_difference.tsv`, its p-values in `comparison_p_value.tsv` and `comparison_corrected_p_value.tsv`, "
+        "where the corrected p-values account for the number of pairs, and the percentage of edges with a significant "
+        "paired difference, corrected for the number of edges and pairs, in `comparison_percentage_different_edges.tsv`. "
+        "With `--memory-limit`, the edges are compared in blocks that fit into the limit.",
+    )
+    parser.add_argument(
+        "--compare-permutations",
+        type=int,
+        default=1000,
+        metavar="N",
+        help="The number of permutations for `--compare`. Default is 1000.",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        default=False,
+        help="Save a self-contained HTML report `metrics.html` with the metrics and, for each group, the histograms "
+        "of the QC-FC values and of the distance against the QC-FC values for the first motion metric. The binned "
+        "values of each group are saved in the `histograms` subdirectory of the output directory.",
+    )
+    parser.add_argument(
+        "--prefetch-memory",
+        type=parse_memory_size,
+        default=parse_memory_size("1G"),
+        metavar="SIZE",
+        help="Load the connectivity matrices of the next groups in the background while the current group "
+        "is evaluated, using up to this much memory (for example `512M` or `4G`). Default is `1G`. "
+        "Set to `0` to only load the next group when it is needed.",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=parse_memory_size,
+        metavar="SIZE",
+        help="Evaluate several groups in parallel while keeping their estimated memory use below this limit "
+        "(for example `16G`). Groups that do not fit into the limit on their own are evaluated in batches of "
+        "connectivity matrices. When this is set, `--prefetch-memory` is not used.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Skip the groups that were completed by a previous run with the same output directory and options. "
+        "The record of each group is saved in the `records` subdirectory of the output directory as soon as the "
+        "group is complete.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="K/N",
+        help="Only evaluate the K-th of N disjoint subsets of the groups, and save the partial results in the "
+        "`shards` subdirectory of the output directory. Run `wonkyconn --merge` after all shards have finished to "
+        "create `metrics.tsv` and `metrics.png`.",
+    )
 
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        default=False,
+        help="Approximate the metrics from a random sample of the edges, for a first look at the denoising strategies. "
+        "Only the sampled values are read from HDF5 and sparse connectivity matrices. Each metric is reported with "
+        "95%% confidence bounds for the error from sampling edges, in the columns with the suffixes `_lower` and `_upper`.",
+    )
+    parser.add_argument(
+        "--quick-edge-count",
+        type=int,
+        default=10000,
+        metavar="N",
+        help="The number of edges to sample with `--quick`. Default is 10000.",
+    )
+    parser.add_argument(
+        "--quick-subject-count",
+        type=int,
+        metavar="N",
+        help="Only use the connectivity matrices of this many random subjects of each group with `--quick`. "
+        "The confidence bounds do not cover the error from sampling subjects, and fewer subjects make "
+        "significant QC-FC less likely. Default is to use all subjects.",
+    )
+
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        default=False,
+        help="Find connectivity matrices with the same content under different tags, for example symlinked sessions or "
+        "copies of a strategy, from their size and a hash of samples of their content. Groups with the same connectivity "
+        "matrices, subjects and metadata are evaluated once and get the same results, and connectivity matrices that are "
+        "shared between groups are loaded once if they fit into `--memory-limit`. The duplicates among all groups are "
+        "listed in `duplicates.tsv`, which is not written with `--shard`.",
+    )
+
+    parser.add_argument(
+        "--status-file",
+        type=Path,
+        metavar="PATH",
+        help="Keep a JSON file updated with the progress of the run: the current stage, the groups that are done and "
+        "pending, the connectivity matrices loaded per second, the bytes read and the ETA. The file is replaced "
+        "atomically every few seconds.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="Serve the progress of the run in the Prometheus text format on `http://127.0.0.1:PORT/metrics`, " "and as JSON on `/status`.",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="Keep running after the first evaluation and watch the BIDS directory for connectivity matrices and "
+        "sidecar files that are added, changed or removed. Only the affected groups are evaluated again, and "
+        "`metrics.tsv` and `metrics.png` are updated after each batch of changes. Changes to the phenotypes file are "
+        "picked up together with the next change in the BIDS directory. Stop with Ctrl+C.",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=10.0,
+        metavar="SECONDS",
+        help="How often to check the BIDS directory for changes with `--watch`. Default is 10 seconds.",
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=30.0,
+        metavar="SECONDS",
+        help="How long the BIDS directory needs to stay unchanged before the results are updated with `--watch`. "
+        "While files keep landing, the results are still updated at least every ten times this duration. "
+        "Default is 30 seconds.",
+    )
+
+    add_common_arguments(parser)
+    return parser
+
+
+def merge_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="wonkyconn --merge",
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Combine the results of runs with `--shard` into `metrics.tsv` and `metrics.png`",
+    )
+    parser.add_argument(
+        "output_dir",
+        action="store",
+        type=Path,
+        help="The output directory that was passed to all shards.",
+    )
+
+    add_common_arguments(parser)
+    return parser
+
+
+def serve_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="wonkyconn --serve",
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Run a service that evaluates jobs sent as JSON to `POST /evaluate`, and keeps the file indexes, "
+        "atlases and connectivity matrices in memory between jobs. See `wonkyconn.service` for the format of the jobs.",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The address to listen on. Default is `127.0.0.1`.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="The port to listen on. Default is `8080`.",
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        help="Listen on this Unix socket instead of a port.",
+    )
+    parser.add_argument(
+        "--cache-memory",
+        type=parse_memory_size,
+        default=parse_memory_size("4G"),
+        metavar="SIZE",
+        help="The memory to use for keeping loaded connectivity matrices (for example `512M` or `4G`). Default is `4G`.",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=parse_memory_size,
+        default=parse_memory_size("4G"),
+        metavar="SIZE",
+        help="Evaluate the groups of each job in parallel while keeping their estimated memory use below this limit. "
+        "Groups that do not fit into the limit on their own are evaluated in batches of connectivity matrices. Default is `4G`.",
+    )
+
+    add_common_arguments(parser)
+    return parser
+
+
+commands = ("--merge", "--serve")
+
+
+def split_command(argv: Sequence[str]) -> tuple[str | None, list[str]]:
+    """
+    Split the option that selects a command other than the evaluation from the arguments of the command.
+    The option is only recognized as the first argument, so that option values and positional arguments
+    of the evaluation can have any value.
+
+    >>> split_command(["--merge", "output"])
+    ('merge', ['output'])
+    >>> split_command(["--phenotypes", "--merge", "bids", "output", "group"])
+    (None, ['--phenotypes', '--merge', 'bids', 'output', 'group'])
+    """
+    if argv and argv[0] in commands:
+        return argv[0].removeprefix("--"), list(argv[1:])
+    return None, list(argv)
+
+
+def add_common_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-v", "--version", action="version", version=__version__)
     parser.add_argument("--debug", action="store_true", default=False)
     parser.add_argument(
@@ -69,15 +450,25 @@ def global_parser() -> argparse.ArgumentParser:
         type=int,
         nargs=1,
     )
-    return parser
 
 
 def main(argv: None | Sequence[str] = None) -> None:
-    parser = global_parser()
-    args = parser.parse_args(argv)
+    if argv is None:
+        argv = sys.argv[1:]
+
+    command, argv = split_command(argv)
+    if command == "merge":
+        args = merge_parser().parse_args(argv)
+        run = merge
+    elif command == "serve":
+        args = serve_parser().parse_args(argv)
+        run = serve
+    else:
+        args = global_parser().parse_args(argv)
+        run = workflow
 
     try:
-        workflow(args)
+        run(args)
     except Exception as e:
         gc_log.exception("Exception: %s", e, exc_info=True)
         if args.debug:
@@ -0,0 +1,170 @@
+"""
+Evaluate groups of connectivity matrices in parallel without exceeding a memory limit.
+
+The working set of each group is estimated from the number of regions and
+connectivity matrices before anything is loaded. Groups are started in order
+as long as the estimated working sets of all running groups fit into the limit.
+A group whose working set alone exceeds the limit is evaluated in batches of
+connectivity matrices (see `QCFCAccumulator`), so that only one batch needs to
+be in memory at a time.
+"""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, Iterator, Mapping, Sequence, TypeVar
+
+import numpy as np
+
+from .base import ConnectivityMatrix
+from .logger import gc_log
+
+Key = TypeVar("Key", bound=Hashable)
+Result = TypeVar("Result")
+
+itemsize = np.dtype(np.float64).itemsize
+
+# The number of rows that `residualize` processes at a time
+residualize_block_size = 2**14
+
+# The number of covariate columns in the model "age + gender"
+covariate_count = 3
+
+
+def estimate_working_set(region_count: int, matrix_count: int, metric_count: int) -> int:
+    """
+    Estimate the peak number of bytes needed to evaluate a group in memory.
+
+    This includes the loaded connectivity array, the temporary arrays of `residualize`,
+    and the QC-FC values and distances for each edge.
+    """
+    edge_count = region_count * (region_count - 1) // 2
+    block_count = min(edge_count, residualize_block_size)
+    return itemsize * (edge_count * matrix_count + 2 * block_count * matrix_count + edge_count * (metric_count + 4))
+
+
+def estimate_blocked_working_set(region_count: int, batch_size: int, metric_count: int) -> int:
+    """
+    Estimate the peak number of bytes needed to evaluate a group in batches of `batch_size` connectivity matrices.
+
+    This includes the sums of products of a `QCFCAccumulator` and of one batch, the connectivity
+    array of one batch, and the QC-FC values and distances for each edge.
+    """
+    edge_count = region_count * (region_count - 1) // 2
+    product_count = covariate_count + metric_count + 1
+    return itemsize * (edge_count * batch_size + 2 * edge_count * product_count + edge_count * (metric_count + 4))
+
+
+@dataclass
+class GroupPlan(Generic[Key]):
+    """
+    How a group is evaluated.
+
+    Attributes:
+        key (Key): The group.
+        connectivity_matrices (Sequence[ConnectivityMatrix]): The connectivity matrices that need to be loaded.
+        working_set (int): The estimated peak number of bytes.
+        batch_size (int | None): The number of connectivity matrices to load at a time,
+            or None to load all of them at once.
+    """
+
+    key: Key
+    connectivity_matrices: Sequence[ConnectivityMatrix]
+    working_set: int
+    batch_size: int | None = None
+
+
+def plan_groups(
+    groups: Mapping[Key, Sequence[ConnectivityMatrix]],
+    memory_limit: int,
+    metric_count: int,
+    allow_batches: bool = True,
+) -> list[GroupPlan[Key]]:
+    """
+    Decide how to evaluate each group, so that no group exceeds the memory limit on its own.
+
+    Parameters:
+        groups (Mapping[Key, Sequence[ConnectivityMatrix]]): The connectivity matrices that need to be loaded for each group.
+        memory_limit (int): The maximum number of bytes for all groups that are evaluated at the same time.
+        metric_count (int): The number of motion metrics.
+        allow_batches (bool, optional): Whether groups can be evaluated in batches. Defaults to True.
+
+    Returns:
+        list[GroupPlan]: The plan for each group, in the order of `groups`.
+    """
+    plans: list[GroupPlan[Key]] = list()
+    for key, connectivity_matrices in groups.items():
+        region_count = connectivity_matrices[0].region_count if connectivity_matrices else 0
+        working_set = estimate_working_set(region_count, len(connectivity_matrices), metric_count)
+        if working_set <= memory_limit or not allow_batches:
+            if working_set > memory_limit:
+                gc_log.warning(f"Group {key} needs about {working_set / 2**30:.1f} GiB, which exceeds the memory limit")
+            plans.append(GroupPlan(key, connectivity_matrices, working_set))
+            continue
+
+        edge_count = region_count * (region_count - 1) // 2
+        fixed_size = estimate_blocked_working_set(region_count, 0, metric_count)
+        batch_size = min(len(connectivity_matrices), max(1, (memory_limit - fixed_size) // (itemsize * edge_count)))
+        if fixed_size >= memory_limit:
+            gc_log.warning(f"Group {key} needs about {fixed_size / 2**30:.1f} GiB even in batches, which exceeds the memory limit")
+        gc_log.info(f"Group {key} does not fit into the memory limit and will be evaluated in batches of {batch_size} connectivity matrices")
+        working_set = estimate_blocked_working_set(region_count, batch_size, metric_count)
+        plans.append(GroupPlan(key, connectivity_matrices, working_set, batch_size))
+    return plans
+
+
+class Scheduler(Generic[Key]):
+    """
+    Run a function for each group plan on a pool of threads.
+
+    The groups are started in order. A group is only started when its estimated
+    working set fits into the memory limit together with the groups that are still
+    running or whose results have not been returned yet. The first group that is
+    waiting is always started if nothing else is running.
+
+    Attributes:
+        plans (Sequence[GroupPlan[Key]]): The groups to evaluate, as returned by `plan_groups`.
+        memory_limit (int): The maximum number of bytes for all groups that are evaluated at the same time.
+        thread_count (int): The maximum number of groups that are evaluated at the same time.
+    """
+
+    def __init__(self, plans: Sequence[GroupPlan[Key]], memory_limit: int, thread_count: int | None = None) -> None:
+        self.plans = plans
+        self.memory_limit = memory_limit
+        if thread_count is None:
+            thread_count = min(4, os.cpu_count() or 1)
+        self.thread_count = thread_count
+
+    def __len__(self) -> int:
+        return len(self.plans)
+
+    def run(self, function: Callable[[GroupPlan[Key]], Result]) -> Iterator[tuple[Key, Result]]:
+        """
+        Yields:
+            tuple[Key, Result]: The group and the result of `function`, in the order of the plans.
+        """
+        running: dict[int, Future[Result]] = dict()
+        reserved = 0
+        next_index = 0
+
+        with ThreadPoolExecutor(max_workers=self.thread_count, thread_name_prefix="scheduler") as executor:
+            try:
+                for k, plan in enumerate(self.plans):
+                    # Start as many of the following groups as fit into the memory limit
+                    while next_index < len(self.plans) and len(running) < self.thread_count:
+                        next_plan = self.plans[next_index]
+                        if running and reserved + next_plan.working_set > self.memory_limit:
+                            break
+                        gc_log.debug(f"Starting group {next_plan.key}")
+                        running[next_index] = executor.submit(function, next_plan)
+                        reserved += next_plan.working_set
+                        next_index += 1
+
+                    result = running.pop(k).result()
+                    reserved -= plan.working_set
+                    yield plan.key, result
+            finally:
+                for future in running.values():
+                    future.cancel()
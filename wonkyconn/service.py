@@ -0,0 +1,323 @@
+"""
+Serve evaluation jobs from a long-running process.
+
+Starting `wonkyconn` for every small evaluation repeats the interpreter startup,
+the compilation of the numerical code, the crawl of the BIDS directory and the
+calculation of the atlas centroids. The service keeps the file indexes, the
+phenotypes, the atlases with their distance vectors, and the loaded connectivity
+matrices in memory between jobs. Each of them is created by the first job that
+needs it, while the jobs that need something else continue.
+
+Jobs are sent as JSON to `POST /evaluate` over HTTP on localhost or on a Unix
+socket. Each job has the keys
+
+- "bids_dir": The BIDS directory with the connectivity matrices.
+- "phenotypes": The phenotypes file.
+- "seg_to_atlas": A list of pairs of a "seg" value and the path to the atlas image.
+- "group_by" (optional): The tags to group the connectivity matrices by. Defaults to ["seg"].
+- "motion_metrics" (optional): The motion metrics. Defaults to ["MeanFramewiseDisplacement"].
+- "region_distance" (optional): The distance between atlas regions, "centroid" or "minimum". Defaults to "centroid".
+- "refresh" (optional): Whether to crawl the whole BIDS directory again. Defaults to false.
+
+Each job checks the size and modification time of the files in the BIDS directory,
+as `--watch` does, and the index is updated for the files that were added, changed or
+removed since the previous job. The groups of a job are evaluated in parallel as
+long as they fit into the memory limit (see `wonkyconn.scheduler`).
+
+The response contains "group_by" and "records", with one record for each group
+as in `metrics.tsv`. Requests are handled concurrently.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import socketserver
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Hashable, Sequence, TypeVar
+
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+
+from .atlas import Atlas, region_distances
+from .base import ConnectivityMatrix, get_group_region_count, is_sparse_group, split_hdf5_path
+from .file_index.bids import BIDSIndex
+from .logger import gc_log, set_verbosity
+from .records import replace_non_finite
+from .scheduler import GroupPlan, Scheduler, plan_groups
+from .validation import ValidationError, validate_groups
+from .watch import Snapshot, get_changes, take_snapshot
+from .workflow import load_data_frame, make_groups, make_record
+
+Key = TypeVar("Key", bound=Hashable)
+Value = TypeVar("Value")
+
+
+class MatrixCache:
+    """
+    Keep the lower triangles of recently used connectivity matrices in memory.
+
+    Matrices are identified by their path and modification time, so a file that
+    is changed on disk is loaded again. The least recently used matrices are
+    removed when the cache would exceed its memory budget.
+
+    Attributes:
+        memory_budget (int): The maximum number of bytes to keep in memory.
+    """
+
+    def __init__(self, memory_budget: int) -> None:
+        self.memory_budget = memory_budget
+        self.size = 0
+        self.lower_triangles: OrderedDict[tuple[str, int], npt.NDArray[np.float64]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_lower_triangle(self, connectivity_matrix: ConnectivityMatrix) -> npt.NDArray[np.float64]:
+        hdf5_path = split_hdf5_path(connectivity_matrix.path)
+        file_path = hdf5_path[0] if hdf5_path is not None else connectivity_matrix.path
+        key = (str(connectivity_matrix.path), file_path.stat().st_mtime_ns)
+
+        with self.lock:
+            lower_triangle = self.lower_triangles.get(key)
+            if lower_triangle is not None:
+                self.lower_triangles.move_to_end(key)
+                return lower_triangle
+
+        lower_triangle = connectivity_matrix.load_lower_triangle()
+        lower_triangle.setflags(write=False)
+        with self.lock:
+            if key not in self.lower_triangles and lower_triangle.nbytes <= self.memory_budget:
+                self.lower_triangles[key] = lower_triangle
+                self.size += lower_triangle.nbytes
+                while self.size > self.memory_budget:
+                    _, removed = self.lower_triangles.popitem(last=False)
+                    self.size -= removed.nbytes
+        return lower_triangle
+
+    def load_connectivity_array(self, connectivity_matrices: Sequence[ConnectivityMatrix]) -> npt.NDArray[np.float64]:
+        """
+        Load the lower triangles of connectivity matrices into a new array (see `load_connectivity_array`).
+        """
+        n = get_group_region_count(connectivity_matrices)
+        connectivity_array = np.empty((n * (n - 1) // 2, len(connectivity_matrices)))
+        for k, connectivity_matrix in enumerate(connectivity_matrices):
+            connectivity_array[:, k] = self.get_lower_triangle(connectivity_matrix)
+        return connectivity_array
+
+
+class EvaluationService:
+    """
+    Evaluate jobs with the file indexes, phenotypes, atlases and connectivity matrices cached between jobs.
+
+    Attributes:
+        matrix_cache (MatrixCache): The cache for the connectivity matrices.
+        memory_limit (int): The maximum number of bytes for the groups of a job that are evaluated at the same time.
+    """
+
+    def __init__(self, cache_memory: int, memory_limit: int = 2**32) -> None:
+        self.matrix_cache = MatrixCache(cache_memory)
+        self.memory_limit = memory_limit
+        self.indexes: dict[Path, tuple[Snapshot, BIDSIndex]] = dict()
+        self.data_frames: dict[tuple[Path, int], pd.DataFrame] = dict()
+        self.atlases: dict[tuple[str, Path, str], Atlas] = dict()
+        self.lock = threading.Lock()
+        self.key_locks: dict[tuple[int, Hashable], threading.Lock] = dict()
+
+    def get_key_lock(self, cache: dict[Key, Value], key: Key) -> threading.Lock:
+        """
+        Get the lock for a key of one of the caches, so that jobs that need other values do not wait for it.
+        """
+        with self.lock:
+            return self.key_locks.setdefault((id(cache), key), threading.Lock())
+
+    def get_cached(self, cache: dict[Key, Value], key: Key, create: Callable[[], Value], refresh: bool = False) -> Value:
+        """
+        Get a value from one of the caches, or create it. The value is created while holding a lock
+        for its key only, so that jobs that need other values do not wait for it.
+        """
+        with self.get_key_lock(cache, key):
+            if refresh or key not in cache:
+                value = create()
+                with self.lock:
+                    cache[key] = value
+            return cache[key]
+
+    def get_index(self, bids_dir: Path, refresh: bool = False) -> BIDSIndex:
+        """
+        Get the index of a BIDS directory, updated for the files that were added, changed or removed since it was
+        created. Jobs that are still running keep the previous index, so it is copied before it is updated.
+        """
+        with self.get_key_lock(self.indexes, bids_dir):
+            # Take the snapshot before indexing, so that files that land in the meantime are picked up by the next job
+            snapshot = take_snapshot(bids_dir)
+            cached = self.indexes.get(bids_dir)
+            if cached is not None and not refresh:
+                previous_snapshot, index = cached
+                if snapshot == previous_snapshot:
+                    return index
+                changed_paths, removed_paths = get_changes(previous_snapshot, snapshot)
+                gc_log.info(f'Updating the index of "{bids_dir}" for {len(changed_paths)} added or changed and {len(removed_paths)} removed files')
+                index = index.copy()
+                index.update(changed_paths, removed_paths)
+            else:
+                gc_log.info(f'Indexing "{bids_dir}"')
+                index = BIDSIndex()
+                index.put(bids_dir)
+            with self.lock:
+                self.indexes[bids_dir] = (snapshot, index)
+            return index
+
+    def get_data_frame(self, phenotypes: Path) -> pd.DataFrame:
+        key = (phenotypes, phenotypes.stat().st_mtime_ns)
+        return self.get_cached(self.data_frames, key, lambda: load_data_frame(phenotypes))
+
+    def get_atlas(self, seg: str, atlas_path: Path, region_distance: str = "centroid") -> Atlas:
+        if region_distance not in region_distances:
+            raise ValueError(f'Unknown region distance "{region_distance}"')
+        key = (seg, atlas_path, region_distance)
+        return self.get_cached(self.atlases, key, lambda: Atlas.create(seg, atlas_path, region_distances[region_distance]()))
+
+    def evaluate(self, job: dict[str, Any]) -> dict[str, Any]:
+        """
+        Evaluate a job. See the module documentation for the keys of the job and the result.
+        """
+        for key in ["bids_dir", "phenotypes", "seg_to_atlas"]:
+            if key not in job:
+                raise ValueError(f'The job is missing the key "{key}"')
+        group_by: list[str] = list(job.get("group_by", ["seg"]))
+        motion_metrics: list[str] = list(job.get("motion_metrics", ["MeanFramewiseDisplacement"]))
+
+        index = self.get_index(Path(job["bids_dir"]), refresh=bool(job.get("refresh", False)))
+        data_frame = self.get_data_frame(Path(job["phenotypes"]))
+        region_distance = str(job.get("region_distance", "centroid"))
+        seg_to_atlas = {seg: self.get_atlas(seg, Path(atlas_path_str), region_distance) for seg, atlas_path_str in job["seg_to_atlas"]}
+        if not seg_to_atlas:
+            raise ValueError('The job needs at least one atlas in "seg_to_atlas"')
+        specified_atlas = list(seg_to_atlas.keys())[0]
+
+        grouped_connectivity_matrix = make_groups(index, group_by, specified_atlas)
+        problems = validate_groups(index, data_frame, seg_to_atlas, grouped_connectivity_matrix, motion_metrics)
+        if problems:
+            raise ValidationError(problems)
+
+        # Sparse connectivity matrices are loaded by `make_record`, so they are not counted by the scheduler
+        groups_to_load = {
+            group: [] if is_sparse_group(connectivity_matrices) else connectivity_matrices
+            for group, connectivity_matrices in grouped_connectivity_matrix.items()
+        }
+
+        def evaluate_group(plan: GroupPlan[tuple[str, ...]]) -> dict[str, Any]:
+            connectivity_matrices = grouped_connectivity_matrix[plan.key]
+            connectivity_array = None
+            if plan.connectivity_matrices and plan.batch_size is None:
+                connectivity_array = self.matrix_cache.load_connectivity_array(connectivity_matrices)
+            record, _, _ = make_record(
+                index, data_frame, seg_to_atlas, connectivity_matrices, motion_metrics, connectivity_array, batch_size=plan.batch_size
+            )
+            return record
+
+        scheduler = Scheduler(plan_groups(groups_to_load, self.memory_limit, len(motion_metrics)), self.memory_limit)
+        records: list[dict[str, Any]] = []
+        for group, record in scheduler.run(evaluate_group):
+            record.update(dict(zip(group_by, group)))
+            records.append(record)
+        return dict(group_by=group_by, records=records)
+
+
+class EvaluationRequestHandler(BaseHTTPRequestHandler):
+    server: EvaluationServer | UnixEvaluationServer
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self.send_json(200, dict(status="ok"))
+        else:
+            self.send_json(404, dict(error=f"Unknown path {self.path}"))
+
+    def do_POST(self) -> None:
+        if self.path != "/evaluate":
+            self.send_json(404, dict(error=f"Unknown path {self.path}"))
+            return
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(content_length))
+            if not isinstance(job, dict):
+                raise ValueError("The job needs to be a JSON object")
+        except ValueError as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+        try:
+            result = self.server.service.evaluate(job)
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+        except Exception as e:
+            gc_log.exception("Exception: %s", e)
+            self.send_json(500, dict(error=str(e)))
+            return
+        self.send_json(200, result)
+
+    def send_json(self, status: int, content: dict[str, Any]) -> None:
+        body = json.dumps(replace_non_finite(content), allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # The client address is empty for Unix sockets
+        gc_log.debug(format % args)
+
+
+class EvaluationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: EvaluationService) -> None:
+        super().__init__(address, EvaluationRequestHandler)
+        self.service = service
+
+
+class UnixEvaluationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, service: EvaluationService) -> None:
+        if socket_path.is_socket():
+            socket_path.unlink()  # Left over from a previous run
+        super().__init__(str(socket_path), EvaluationRequestHandler)
+        self.service = service
+        self.socket_path = socket_path
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.socket_path.unlink(missing_ok=True)
+
+
+def make_server(args: argparse.Namespace) -> EvaluationServer | UnixEvaluationServer:
+    service = EvaluationService(args.cache_memory, args.memory_limit)
+    if args.socket is not None:
+        return UnixEvaluationServer(args.socket, service)
+    return EvaluationServer((args.host, args.port), service)
+
+
+def serve(args: argparse.Namespace) -> None:
+    """
+    Run the evaluation service until it is interrupted.
+    """
+    set_verbosity(args.verbosity)
+    gc_log.info(vars(args))
+
+    server = make_server(args)
+    if isinstance(server, UnixEvaluationServer):
+        gc_log.info(f'Serving on Unix socket "{server.socket_path}"')
+    else:
+        host, port = server.server_address[:2]
+        gc_log.info(f"Serving on http://{host!s}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from pkg_resources import resource_filename
+
+from wonkyconn.tests.utils import copy_file
+
+seg = "Schaefer20187Networks100Parcels"
+
+
+@pytest.fixture(scope="session")
+def data_path() -> Path:
+    return Path(resource_filename("wonkyconn", "data/test_data/connectome_Schaefer20187Networks_dev"))
+
+
+@pytest.fixture(scope="session")
+def small_bids_dir(tmp_path_factory: pytest.TempPathFactory, data_path: Path) -> Path:
+    """A copy of the test data with six subjects and only the 100 parcels atlas."""
+    bids_dir = tmp_path_factory.mktemp("bids")
+
+    subjects = [f"sub-{i}" for i in ["2", "3", "4", "5", "6", "7"]]
+    for path in data_path.glob("sub-1/**/*"):
+        if not path.is_file():
+            continue
+        if "seg-" in path.name and f"seg-{seg}_" not in path.name:
+            continue
+        for sub in subjects:
+            copy_file(path, bids_dir / path.relative_to(data_path), sub)
+
+    phenotypes = pd.DataFrame(
+        dict(
+            participant_id=subjects,
+            age=np.random.uniform(18, 80, len(subjects)),
+            gender=["m", "f"] * (len(subjects) // 2),
+        )
+    )
+    phenotypes.to_csv(bids_dir / "participants.tsv", sep="\t", index=False)
+
+    return bids_dir
+
+
+@pytest.fixture
+def small_argv(small_bids_dir: Path, data_path: Path, tmp_path: Path) -> list[str]:
+    dseg_path = data_path / "atlases" / "sub-1" / "func" / f"sub-1_seg-{seg}_dseg.nii.gz"
+    return [
+        "--phenotypes",
+        str(small_bids_dir / "participants.tsv"),
+        "--seg-to-atlas",
+        seg,
+        str(dseg_path),
+        str(small_bids_dir),
+        str(tmp_path / "output"),
+        "group",
+    ]
@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from wonkyconn.accumulator import QCFCAccumulator
+from wonkyconn.features.quality_control_connectivity import calculate_qcfc_for_metrics
+from wonkyconn.tests.utils import make_connectivity_matrices
+
+
+@pytest.mark.parametrize("numeric_gender", [False, True])
+def test_accumulator(tmp_path: Path, numeric_gender: bool) -> None:
+    n = 10
+    m = 40
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+    data_frame["gender"] = ["m"] * 10 + ["f", "m"] * 15
+    if numeric_gender:
+        data_frame["gender"] = (data_frame["gender"] == "f").astype(int)
+    for connectivity_matrix in connectivity_matrices:
+        connectivity_matrix.metadata["MaxFramewiseDisplacement"] = np.random.uniform(0, 3)
+    metric_keys = ["MeanFramewiseDisplacement", "MaxFramewiseDisplacement"]
+    expected = calculate_qcfc_for_metrics(data_frame, connectivity_matrices, metric_keys)
+
+    # The first batch only contains one level of "gender"
+    accumulator = QCFCAccumulator.empty(n, metric_keys)
+    accumulator.add(data_frame.iloc[:10], connectivity_matrices[:10])
+    accumulator.save(tmp_path / "accumulator.npz")
+    accumulator = QCFCAccumulator.load(tmp_path / "accumulator.npz")
+    assert accumulator.get_new(connectivity_matrices) == connectivity_matrices[10:]
+
+    # Matrices that were added before are skipped
+    accumulator.add(data_frame.iloc[:25], connectivity_matrices[:25])
+    other = QCFCAccumulator.empty(n, metric_keys)
+    other.add(data_frame.iloc[25:], connectivity_matrices[25:])
+    accumulator.merge(other)
+    assert accumulator.sample_count == m
+
+    with pytest.raises(ValueError):
+        accumulator.merge(other)
+
+    results = accumulator.get_results()
+    for metric_key in metric_keys:
+        assert results[metric_key].sample_count == m
+        assert np.allclose(results[metric_key].correlation, expected[metric_key].correlation)
@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import scipy
+
+from wonkyconn import evaluate
+from wonkyconn.base import load_connectivity_array
+from wonkyconn.features.quality_control_connectivity import calculate_qcfc
+from wonkyconn.tests.utils import make_connectivity_matrices
+
+
+def test_evaluate(tmp_path: Path) -> None:
+    n = 15
+    m = 30
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+    expected = calculate_qcfc(data_frame, connectivity_matrices)
+
+    connectomes = np.stack([connectivity_matrix.load() for connectivity_matrix in connectivity_matrices])
+    motion = np.asarray([connectivity_matrix.metadata["MeanFramewiseDisplacement"] for connectivity_matrix in connectivity_matrices])
+    distance_matrix = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(np.random.normal(size=(n, 3))))
+    metadata = [dict(ConfoundRegressors=["a", "b"]) for _ in range(m)]
+
+    evaluation = evaluate(connectomes, motion, data_frame, atlas=distance_matrix, metadata=metadata, leave_one_out=True)
+    (qcfc,) = evaluation.qcfc.values()
+    assert np.allclose(qcfc.correlation, expected.correlation)
+    assert np.isclose(evaluation.record["median_absolute_qcfc"], np.median(np.abs(expected.correlation)))
+    assert 0 <= evaluation.record["distance_dependence"] <= 1
+    assert np.isclose(evaluation.record["confound_regression_percentage"], 100 * 2 / n)
+    assert evaluation.influence is not None
+    assert list(evaluation.influence.index) == list(data_frame.index)
+
+    # The edge array is only overwritten when requested
+    connectivity_array = load_connectivity_array(connectivity_matrices)
+    original = connectivity_array.copy()
+    evaluation = evaluate(connectivity_array, dict(MeanFramewiseDisplacement=motion), data_frame)
+    assert np.array_equal(connectivity_array, original)
+    assert "distance_dependence" not in evaluation.record
+    evaluate(connectivity_array, motion, data_frame, overwrite=True)
+    assert not np.array_equal(connectivity_array, original)
+
+    with pytest.raises(ValueError):
+        evaluate(connectomes[:-1], motion, data_frame)
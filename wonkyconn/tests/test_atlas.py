@@ -1,13 +1,19 @@
 from pathlib import Path
 
+import nibabel as nib
 import numpy as np
 import pandas as pd
 from pkg_resources import resource_filename
+import pytest
 import scipy
+import scipy.stats
 from nilearn.plotting import find_probabilistic_atlas_cut_coords
 from templateflow.api import get as get_template
 
-from wonkyconn.atlas import Atlas
+from wonkyconn.atlas import Atlas, CentroidDistance, DsegAtlas, MinimumDistance
+from wonkyconn.features.distance_dependence import calculate_distance_dependence
+from wonkyconn.features.quality_control_connectivity import QCFCResult
+from wonkyconn.quick import calculate_bounds
 
 
 def test_dseg_atlas() -> None:
@@ -78,3 +84,86 @@ def test_probseg_atlas() -> None:
 
     distance_matrix = atlas.get_distance_matrix()
     assert np.abs(_distance_matrix - distance_matrix).mean() < 50  # mm
+
+
+def _make_dseg_atlas(distance=None) -> DsegAtlas:
+    array = np.zeros((12, 10, 8), dtype=np.int16)
+    array[0:3, 0:3, 0:3] = 1
+    array[5:9, 0:2, 1:4] = 2
+    array[0:2, 6:10, 5:8] = 3
+    array[9:12, 6:9, 0:2] = 4
+    array[3:5, 3:6, 3:6] = 5  # Touches region 1
+    affine = np.diag([2.0, 2.0, 2.5, 1.0])
+    image = nib.nifti1.Nifti1Image(array, affine)
+    if distance is None:
+        return DsegAtlas("test", image)
+    return DsegAtlas("test", image, distance=distance)
+
+
+def test_distance_vector() -> None:
+    atlas = _make_dseg_atlas(CentroidDistance(block_size=7))
+    centroids = atlas.get_centroids()
+    i, j = np.tril_indices(len(centroids), k=-1)
+    expected = np.sqrt(np.square(centroids[i] - centroids[j]).sum(axis=1))
+    assert np.allclose(atlas.get_distance_vector(), expected)
+    assert np.allclose(atlas.get_distance_matrix(), scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(centroids)))
+
+
+def test_minimum_distance() -> None:
+    atlas = _make_dseg_atlas(MinimumDistance())
+    array = atlas.get_array()
+    points = [nib.affines.apply_affine(atlas.image.affine, np.argwhere(array == label)) for label in range(1, 6)]
+    i, j = np.tril_indices(5, k=-1)
+    expected = [scipy.spatial.distance.cdist(points[a], points[b]).min() for a, b in zip(i, j)]
+    assert np.allclose(atlas.get_distance_vector(), expected)
+
+    # The voxels are looked up in blocks of whole regions
+    assert np.allclose(_make_dseg_atlas(MinimumDistance(block_size=7)).get_distance_vector(), expected)
+
+
+def test_minimum_distance_many_regions() -> None:
+    # Random regions of irregular shape, so that the voxels that are looked up are pruned in different ways
+    rng = np.random.default_rng(0)
+    grid = np.argwhere(np.ones((24, 20, 16), dtype=bool))
+    seeds = rng.uniform(0, 20, size=(200, 3))
+    _, labels = scipy.spatial.cKDTree(seeds).query(grid * [1, 1.2, 1.5])
+    array = np.zeros((24, 20, 16), dtype=np.int16)
+    array[tuple(grid.T)] = labels + 1
+    rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    affine = np.eye(4)
+    affine[:3, :3] = rotation * [2.0, 2.0, 2.5]
+    atlas = DsegAtlas("test", nib.nifti1.Nifti1Image(array, affine), distance=MinimumDistance(block_size=500))
+
+    points = [nib.affines.apply_affine(affine, region_points) for region_points in atlas.get_surface_points()]
+    i, j = np.tril_indices(len(points), k=-1)
+    expected = [scipy.spatial.distance.cdist(points[a], points[b]).min() for a, b in zip(i, j)]
+    assert np.allclose(atlas.get_distance_vector(), expected)
+
+
+def test_minimum_distance_empty_region() -> None:
+    atlas = _make_dseg_atlas(MinimumDistance(block_size=5))
+    array = atlas.get_array().astype(np.int16)
+    array[array == 3] = 0
+    atlas = DsegAtlas("test", nib.nifti1.Nifti1Image(array, atlas.image.affine), distance=MinimumDistance(block_size=5))
+    distance_matrix = np.zeros((5, 5))
+    distance_matrix[np.tril_indices(5, k=-1)] = atlas.get_distance_vector()
+    distance_matrix += distance_matrix.T
+    assert np.isnan(distance_matrix[2, [0, 1, 3, 4]]).all()
+    assert np.isfinite(distance_matrix[[0, 1, 3, 4]][:, [0, 1, 3, 4]]).all()
+
+
+def test_distance_dependence_empty_region() -> None:
+    atlas = _make_dseg_atlas(MinimumDistance(block_size=5))
+    array = atlas.get_array().astype(np.int16)
+    array[array == 3] = 0
+    atlas = DsegAtlas("test", nib.nifti1.Nifti1Image(array, atlas.image.affine), distance=MinimumDistance(block_size=5))
+    distance_vector = atlas.get_distance_vector()
+    correlation = np.random.default_rng(0).uniform(-0.5, 0.5, distance_vector.size)
+    qcfc = QCFCResult(region_count=5, correlation=correlation, sample_count=20)
+
+    # The edges of the empty region are left out
+    valid = ~np.isnan(distance_vector)
+    expected = np.abs(scipy.stats.spearmanr(distance_vector[valid], correlation[valid])[0])
+    assert calculate_distance_dependence(qcfc, atlas) == pytest.approx(expected)
+    assert np.isfinite(calculate_distance_dependence(qcfc, atlas))
+    assert np.isfinite(list(calculate_bounds(dict(MeanFramewiseDisplacement=qcfc), atlas).values())).all()
@@ -0,0 +1,173 @@
+import random
+import timeit
+from pathlib import Path
+from typing import MutableSequence
+
+import pytest
+
+from wonkyconn.file_index.bids import BIDSIndex, FilenameParser, parse, split_ext
+
+
+def _legacy_parse(path: Path) -> dict[str, str] | None:
+    """The parser before `FilenameParser`, to check that the results are the same."""
+    if path.is_dir():
+        return None  # Skip directories
+
+    stem, extension = split_ext(path)
+    if stem.startswith("."):
+        return None  # Skip hidden files
+
+    tokens = stem.split("_")
+
+    # Parse tokens
+    keys: MutableSequence[str | None] = list()
+    values: MutableSequence[str] = list()
+    for token in tokens:
+        if "-" in token:  # A bids tag
+            key: str | None = token.split("-")[0]
+            if key is None:
+                continue
+            keys.append(key)
+            values.append(token[len(key) + 1 :])
+
+        else:  # A suffix
+            keys.append(None)
+            values.append(token)
+
+    # Extract bids suffixes
+    suffixes: list[str] = list()
+    while keys and keys[-1] is None:
+        keys.pop(-1)
+        suffixes.insert(0, values.pop(-1))
+
+    # Merge other suffixes with their preceding tag value
+    for i, (key, value) in enumerate(zip(keys, values, strict=False)):
+        if i < 1:
+            continue
+        if key is None:
+            values[i - 1] += f"_{value}"
+
+    # Build tags
+    tags = dict(
+        suffix="_".join(suffixes),
+    )
+    if extension:
+        tags["extension"] = extension
+    parent_name = Path(str(path.parent)).name
+    if parent_name in ("anat", "func", "fmap"):
+        tags["datatype"] = parent_name
+    for key, value in zip(keys, values, strict=False):
+        if key is not None:
+            tags[key] = value
+    return tags
+
+
+names = [
+    "sub-1_ses-timepoint1_task-rest_run-01_seg-Schaefer20187Networks100Parcels_meas-PearsonCorrelation_desc-denoiseSimple_relmat.tsv",
+    "sub-1_ses-1_desc-simple_timeseries.json",
+    "sub-1_desc-a_extra_more_relmat_b.nii.gz",
+    "sub-1_desc-a-b-c_bold.nii.xz",
+    "sub-1_desc-x_relmat.tar.xz.gz",
+    "dataset_description.json",
+    "participants.tsv",
+    "README",
+    "noextension_",
+    "_leading_underscore.tsv",
+    "trailing_underscore_.tsv",
+    "double__underscore.tsv",
+    "-leading-dash.tsv",
+    "sub-1_-x_y.tsv",
+    "sub-1_sub-2_relmat.tsv",
+    "suffix-a_extension-b_datatype-c_bold.tsv",
+    "a..b",
+    "a.",
+    ".gz",
+    ".hidden_relmat.tsv",
+    "..",
+    "sub-1_relmat.h5",
+]
+
+
+def test_parse_name() -> None:
+    parser = FilenameParser()
+    for parent_name in ["func", "anat", "other", ""]:
+        for name in names:
+            assert parser.parse_name(name, parent_name) == _legacy_parse(Path(parent_name) / name), name
+
+
+def test_parse_name_random() -> None:
+    random.seed(0)
+    parser = FilenameParser()
+    alphabet = ["sub", "ses", "desc", "a", "1", "-", "-", "_", "_", ".", ".gz", ".xz", ".tsv"]
+    for _ in range(10000):
+        name = "".join(random.choices(alphabet, k=random.randint(1, 12)))
+        if name in (".", ".."):
+            continue
+        assert parser.parse_name(name, "func") == _legacy_parse(Path("func") / name), name
+
+
+def test_interning() -> None:
+    parser = FilenameParser()
+    first = parser.parse_name("sub-1_task-" + "rest_relmat.tsv", "func")
+    second = parser.parse_name("sub-2_task-" + "rest_relmat.tsv", "func")
+    assert first is not None and second is not None
+    assert first["task"] is second["task"]
+    assert first["suffix"] is second["suffix"]
+
+    # Separate calls to `parse` share the memo of one parser
+    first = parse(Path("func") / ("sub-1_task-" + "rest_relmat.tsv"))
+    second = parse(Path("func") / ("sub-2_task-" + "rest_relmat.tsv"))
+    assert first is not None and second is not None
+    assert first["task"] is second["task"]
+
+
+def test_max_size() -> None:
+    parser = FilenameParser(max_size=16)
+    for k in range(100):
+        name = f"sub-{k}_task-{k % 7}_relmat.tsv"
+        assert parser.parse_name(name, "func") == _legacy_parse(Path("func") / name), name
+        # The memo is cleared before a name is parsed, so it grows by at most one name past the limit
+        assert len(parser.tokens) + len(parser.strings) <= 16 + 8
+
+
+def test_put(tmp_path: Path, data_path: Path) -> None:
+    (tmp_path / "func").mkdir()
+    for name in names:
+        if name != ".." and not name.endswith(".h5"):
+            (tmp_path / "func" / name).write_text("")
+    (tmp_path / ".hidden").mkdir()
+    (tmp_path / ".hidden" / "sub-1_relmat.tsv").write_text("")
+    (tmp_path / "link").symlink_to(tmp_path / "func")
+
+    for root in [tmp_path, data_path]:
+        index = BIDSIndex()
+        index.put(root)
+        expected = dict()
+        for path in root.glob("**/*"):
+            tags = _legacy_parse(path)
+            if tags is not None and tags.get("extension") not in (".h5", ".hdf5"):
+                expected[path] = tags
+        assert dict(index.tags_by_paths) == expected
+
+
+@pytest.mark.benchmark
+def test_parse_benchmark() -> None:
+    paths = [
+        Path(f"sub-{s}/ses-{t}/func") / f"sub-{s}_ses-{t}_task-rest_run-0{r}_seg-{seg}_meas-PearsonCorrelation_desc-denoise{d}_relmat.tsv"
+        for s in range(1000)
+        for t in ("1", "2")
+        for r in (1, 2)
+        for seg in ("Schaefer20187Networks100Parcels", "Schaefer20187Networks200Parcels")
+        for d in ("Simple", "Scrubbing5")
+    ]
+    parser = FilenameParser()
+    assert [parser.parse_name(path.name, path.parent.name) for path in paths[:1000]] == [_legacy_parse(path) for path in paths[:1000]]
+
+    def parse_all() -> None:
+        parser = FilenameParser()  # Start with an empty memo
+        for path in paths:
+            parser.parse_name(path.name, path.parent.name)
+
+    legacy_time = min(timeit.repeat(lambda: [_legacy_parse(path) for path in paths], number=1, repeat=3))
+    parser_time = min(timeit.repeat(parse_all, number=1, repeat=3))
+    print(f"Parsed {len(paths)} file names in {legacy_time:.3f}s with the legacy parser and in {parser_time:.3f}s with `FilenameParser`")
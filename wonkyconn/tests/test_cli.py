@@ -4,20 +4,19 @@ Simple code to smoke test the functionality.
 
 from pathlib import Path
 
-import json
-import re
-from shutil import copyfile
+import os
+import shutil
 import numpy as np
 import pytest
 from pkg_resources import resource_filename
 
 import pandas as pd
-import scipy
 from tqdm.auto import tqdm
 
 from wonkyconn import __version__
-from wonkyconn.run import global_parser, main
-from wonkyconn.workflow import workflow
+from wonkyconn.run import get_argument_problems, global_parser, main, split_command
+from wonkyconn.tests.utils import copy_file
+from wonkyconn.workflow import get_subjects, load_data_frame, make_groups, make_record, workflow
 
 
 def test_version(capsys):
@@ -38,31 +37,6 @@ def test_help(capsys):
     assert "Evaluating the residual motion in fMRI connectome and visualize reports" in captured.out
 
 
-def _copy_file(path: Path, new_path: Path, sub: str) -> None:
-    new_path = Path(re.sub(r"sub-\d+", f"sub-{sub}", str(new_path)))
-    new_path.parent.mkdir(parents=True, exist_ok=True)
-
-    if "relmat" in path.name and path.suffix == ".tsv":
-        relmat = pd.read_csv(path, sep="\t")
-        (n,) = set(relmat.shape)
-
-        array = scipy.spatial.distance.squareform(relmat.to_numpy() - np.eye(n))
-        np.random.shuffle(array)
-
-        new_array = scipy.spatial.distance.squareform(array) + np.eye(n)
-
-        new_relmat = pd.DataFrame(new_array, columns=relmat.columns)
-        new_relmat.to_csv(new_path, sep="\t", index=False)
-    elif "timeseries" in path.name and path.suffix == ".json":
-        with open(path, "r") as f:
-            content = json.load(f)
-            content["MeanFramewiseDisplacement"] += np.random.uniform(0, 1)
-        with open(new_path, "w") as f:
-            json.dump(content, f)
-    else:
-        copyfile(path, new_path)
-
-
 # hi test
 @pytest.mark.smoke
 def test_smoke(tmp_path: Path):
@@ -80,7 +54,7 @@ def test_smoke(tmp_path: Path):
         if not path.is_file():
             continue
         for sub in subjects:
-            _copy_file(path, bids_dir / path.relative_to(data_path), str(sub))
+            copy_file(path, bids_dir / path.relative_to(data_path), str(sub))
 
     phenotypes = pd.DataFrame(
         dict(
@@ -117,3 +91,316 @@ def test_smoke(tmp_path: Path):
 
     assert (output_dir / "metrics.tsv").is_file()
     assert (output_dir / "metrics.png").is_file()
+
+
+def test_export_edges(small_argv: list[str], tmp_path: Path):
+    from wonkyconn.export import find_qcfc_edges
+
+    parser = global_parser()
+    args = parser.parse_args(["--export-edges", "--group-by", "seg", "desc", *small_argv])
+    workflow(args)
+
+    metrics = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    edges = find_qcfc_edges(tmp_path / "output" / "edges")
+    assert len(edges) == len(metrics)
+    for group, qcfc in edges:
+        assert isinstance(qcfc.correlation, np.memmap)
+        assert qcfc.correlation.shape == (qcfc.region_count * (qcfc.region_count - 1) // 2,)
+        record = metrics.loc[(group["seg"], group["desc"])]
+        assert np.isclose(record.median_absolute_qcfc, np.median(np.abs(qcfc.correlation)))
+
+
+def test_motion_metrics(small_argv: list[str], tmp_path: Path):
+    parser = global_parser()
+    args = parser.parse_args(["--motion-metrics", "MeanFramewiseDisplacement", "NumberOfVolumesDiscardedByNonsteadyStatesDetector", *small_argv])
+    workflow(args)
+
+    metrics = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=0)
+    for column in ["median_absolute_qcfc", "percentage_significant_qcfc", "distance_dependence"]:
+        assert column in metrics.columns
+        assert f"{column}_NumberOfVolumesDiscardedByNonsteadyStatesDetector" in metrics.columns
+
+
+def test_shard_and_merge(small_argv: list[str], tmp_path: Path):
+    parser = global_parser()
+    output_dir = tmp_path / "output"
+    for shard in ["1/2", "2/2"]:
+        workflow(parser.parse_args(["--shard", shard, "--group-by", "seg", "task", *small_argv]))
+    assert not (output_dir / "metrics.tsv").is_file()
+    assert len(list((output_dir / "shards").glob("*.json"))) == 2
+
+    main(["--merge", str(output_dir)])
+    merged = pd.read_csv(output_dir / "metrics.tsv", sep="\t", index_col=[0, 1])
+    assert (output_dir / "metrics.png").is_file()
+
+    full_argv = [*small_argv[:-2], str(tmp_path / "full"), "group"]
+    workflow(parser.parse_args(["--group-by", "seg", "task", *full_argv]))
+    full = pd.read_csv(tmp_path / "full" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    assert len(full) == 2
+    pd.testing.assert_frame_equal(merged, full)
+
+
+def test_bids_dir_named_like_command(small_bids_dir: Path, small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    # The commands are selected with an option, so a BIDS directory can have the name of a command
+    os.symlink(small_bids_dir, tmp_path / "merge")
+    monkeypatch.chdir(tmp_path)
+    main(["merge", "output", "group", *small_argv[:-3]])
+    assert (tmp_path / "output" / "metrics.tsv").is_file()
+
+
+def test_option_value_named_like_command(small_bids_dir: Path, small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    # Only a leading `--merge` selects the command, so an option value can be `--merge`
+    shutil.copyfile(small_bids_dir / "participants.tsv", tmp_path / "--merge")
+    monkeypatch.chdir(tmp_path)
+    assert split_command(["--phenotypes", "--merge", *small_argv[2:]]) == (None, ["--phenotypes", "--merge", *small_argv[2:]])
+    main(["--phenotypes=--merge", *small_argv[2:]])
+    assert (tmp_path / "output" / "metrics.tsv").is_file()
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--watch", "--shard", "1/2"],
+        ["--compare", "--shard", "1/2"],
+        ["--deduplicate", "--accumulator-dir", "accumulators"],
+        ["--leave-one-out", "--accumulator-dir", "accumulators"],
+        ["--quick", "--accumulator-dir", "accumulators"],
+        ["--quick", "--leave-one-out"],
+        ["--quick", "--resume"],
+        ["--group-by", "seg", "--group-by", "task", "--compare"],
+    ],
+)
+def test_conflicting_options(small_argv: list[str], options: list[str], capsys: pytest.CaptureFixture[str]):
+    with pytest.raises(SystemExit):
+        global_parser().parse_args([*options, *small_argv])
+    assert "cannot be combined" in capsys.readouterr().err
+
+
+def test_compatible_options(small_argv: list[str]):
+    args = global_parser().parse_args(["--group-by", "seg", "--group-by", "seg", "--shard", "1/2", "--quick", "--deduplicate", *small_argv])
+    assert get_argument_problems(args) == []
+
+
+def test_make_record_strategies(small_bids_dir: Path, small_argv: list[str]):
+    from wonkyconn.accumulator import QCFCAccumulator
+    from wonkyconn.atlas import Atlas, region_distances
+    from wonkyconn.base import load_connectivity_array
+    from wonkyconn.file_index.bids import BIDSIndex
+
+    index = BIDSIndex()
+    index.put(small_bids_dir)
+    data_frame = load_data_frame(small_argv[small_argv.index("--phenotypes") + 1])
+    seg, atlas_path = small_argv[small_argv.index("--seg-to-atlas") + 1 : small_argv.index("--seg-to-atlas") + 3]
+    seg_to_atlas = {seg: Atlas.create(seg, Path(atlas_path), region_distances["centroid"]())}
+    connectivity_matrices = next(iter(make_groups(index, ["seg"], seg).values()))
+    metric_keys = ["MeanFramewiseDisplacement"]
+    region_count = connectivity_matrices[0].region_count
+
+    # A partly filled accumulator only needs the connectivity matrices that it does not contain yet
+    accumulator = QCFCAccumulator.empty(region_count, metric_keys)
+    accumulator.add(data_frame.loc[get_subjects(index, connectivity_matrices[:5])], connectivity_matrices[:5])
+    records = [
+        make_record(index, data_frame, seg_to_atlas, connectivity_matrices, metric_keys)[0],
+        make_record(index, data_frame, seg_to_atlas, connectivity_matrices, metric_keys, load_connectivity_array(connectivity_matrices))[0],
+        make_record(index, data_frame, seg_to_atlas, connectivity_matrices, metric_keys, batch_size=4)[0],
+        make_record(
+            index,
+            data_frame,
+            seg_to_atlas,
+            connectivity_matrices,
+            metric_keys,
+            load_connectivity_array(connectivity_matrices[5:]),
+            accumulator=accumulator,
+            batch_size=3,
+        )[0],
+    ]
+    for record in records[1:]:
+        assert record.keys() == records[0].keys()
+        for key, value in records[0].items():
+            assert record[key] == pytest.approx(value, rel=1e-9, nan_ok=True)
+
+
+def test_leave_one_out(small_argv: list[str], tmp_path: Path):
+    parser = global_parser()
+    args = parser.parse_args(["--leave-one-out", *small_argv])
+    workflow(args)
+
+    metrics = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=0)
+    (influence_path,) = (tmp_path / "output" / "influence").glob("*_influence.tsv")
+    assert influence_path.name == f"seg-{metrics.index[0]}_influence.tsv"
+    influence = pd.read_csv(influence_path, sep="\t", index_col="participant_id")
+    assert len(influence) == 6
+    assert np.allclose(
+        influence.median_absolute_qcfc + influence.median_absolute_qcfc_influence,
+        metrics.median_absolute_qcfc.iloc[0],
+    )
+
+
+def test_accumulator_dir(small_argv: list[str], tmp_path: Path):
+    from wonkyconn.accumulator import QCFCAccumulator
+
+    parser = global_parser()
+    accumulator_dir = tmp_path / "accumulators"
+    workflow(parser.parse_args(["--accumulator-dir", str(accumulator_dir), *small_argv]))
+    (accumulator_path,) = accumulator_dir.glob("*_accumulator.npz")
+    sample_count = QCFCAccumulator.load(accumulator_path).sample_count
+    assert sample_count > 0
+    first = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=0)
+
+    # The second run does not add any connectivity matrices
+    workflow(parser.parse_args(["--accumulator-dir", str(accumulator_dir), *small_argv]))
+    assert QCFCAccumulator.load(accumulator_path).sample_count == sample_count
+    second = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=0)
+    pd.testing.assert_frame_equal(first, second)
+
+    full_argv = [*small_argv[:-2], str(tmp_path / "full"), "group"]
+    workflow(parser.parse_args(full_argv))
+    full = pd.read_csv(tmp_path / "full" / "metrics.tsv", sep="\t", index_col=0)
+    pd.testing.assert_frame_equal(first, full)
+
+
+def test_accumulator_dir_removed(small_bids_dir: Path, small_argv: list[str], tmp_path: Path):
+    parser = global_parser()
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_bids_dir, bids_dir)
+    argv = [*small_argv[:-3], str(bids_dir), *small_argv[-2:]]
+    accumulator_dir = tmp_path / "accumulators"
+    workflow(parser.parse_args(["--accumulator-dir", str(accumulator_dir), *argv]))
+
+    # The sums are calculated again without the connectivity matrices of the removed subject
+    for path in bids_dir.glob("sub-sub-7/**/*_relmat.tsv"):
+        path.unlink()
+    workflow(parser.parse_args(["--accumulator-dir", str(accumulator_dir), *argv]))
+    accumulated = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=0)
+
+    full_argv = [*argv[:-2], str(tmp_path / "full"), "group"]
+    workflow(parser.parse_args(full_argv))
+    full = pd.read_csv(tmp_path / "full" / "metrics.tsv", sep="\t", index_col=0)
+    pd.testing.assert_frame_equal(accumulated, full)
+
+
+def test_accumulator_dir_phenotypes(small_bids_dir: Path, small_argv: list[str], tmp_path: Path):
+    from wonkyconn.validation import ValidationError
+
+    parser = global_parser()
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_bids_dir, bids_dir)
+    new_dir = tmp_path / "new"
+    shutil.move(bids_dir / "sub-sub-7", new_dir)
+    phenotypes_path = Path(small_argv[small_argv.index("--phenotypes") + 1])
+    argv = [*small_argv[:-3], str(bids_dir), *small_argv[-2:]]
+    accumulator_dir = tmp_path / "accumulators"
+    workflow(parser.parse_args(["--accumulator-dir", str(accumulator_dir), *argv]))
+
+    # Subjects that were added before can be left out of the phenotypes file, but new subjects cannot
+    shutil.move(new_dir, bids_dir / "sub-sub-7")
+    phenotypes = pd.read_csv(phenotypes_path, sep="\t")
+    reduced_path = tmp_path / "reduced.tsv"
+    phenotypes[phenotypes["participant_id"] != "sub-7"].to_csv(reduced_path, sep="\t", index=False)
+    reduced_argv = ["--accumulator-dir", str(accumulator_dir), *argv]
+    reduced_argv[reduced_argv.index("--phenotypes") + 1] = str(reduced_path)
+    with pytest.raises(ValidationError, match="sub-7"):
+        workflow(parser.parse_args(reduced_argv))
+
+    phenotypes[phenotypes["participant_id"] != "sub-2"].to_csv(reduced_path, sep="\t", index=False)
+    workflow(parser.parse_args(reduced_argv))
+    accumulated = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=0)
+
+    full_argv = [*argv[:-2], str(tmp_path / "full"), "group"]
+    workflow(parser.parse_args(full_argv))
+    full = pd.read_csv(tmp_path / "full" / "metrics.tsv", sep="\t", index_col=0)
+    pd.testing.assert_frame_equal(accumulated, full)
+
+
+def test_network_blocks(small_argv: list[str], tmp_path: Path):
+    networks = ["Vis", "SomMot", "DorsAttn", "SalVentAttn", "Limbic", "Cont", "Default"]
+    label_path = tmp_path / "labels.tsv"
+    names = [f"7Networks_LH_{networks[k % len(networks)]}_{k}" for k in range(100)]
+    pd.DataFrame(dict(index=np.arange(1, 101), name=names)).to_csv(label_path, sep="\t", index=False)
+
+    parser = global_parser()
+    seg = small_argv[small_argv.index("--seg-to-atlas") + 1]
+    args = parser.parse_args(["--network-blocks", "--seg-to-labels", seg, str(label_path), *small_argv])
+    workflow(args)
+
+    (network_path,) = (tmp_path / "output" / "network_blocks").glob("*_networks.tsv")
+    network_frame = pd.read_csv(network_path, sep="\t", index_col=[0, 1])
+    assert network_frame.shape == (2 * len(networks), len(networks))
+    median = network_frame.loc["median_absolute_qcfc"]
+    assert np.allclose(median, median.T)
+
+
+def test_memory_limit(small_argv: list[str], tmp_path: Path):
+    parser = global_parser()
+    # Small enough that each group is evaluated in batches
+    workflow(parser.parse_args(["--memory-limit", "1M", "--group-by", "seg", "task", *small_argv]))
+    limited = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=[0, 1])
+
+    full_argv = [*small_argv[:-2], str(tmp_path / "full"), "group"]
+    workflow(parser.parse_args(["--group-by", "seg", "task", *full_argv]))
+    full = pd.read_csv(tmp_path / "full" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    pd.testing.assert_frame_equal(limited, full)
+
+
+def test_resume(small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    import wonkyconn.workflow
+
+    parser = global_parser()
+    argv = ["--group-by", "seg", "task", *small_argv]
+    make_record = wonkyconn.workflow.make_record
+    calls: list[int] = []
+
+    def fail_after_first_group(*args, **kwargs):
+        calls.append(len(calls))
+        if len(calls) > 1:
+            raise RuntimeError("Simulated failure")
+        return make_record(*args, **kwargs)
+
+    monkeypatch.setattr(wonkyconn.workflow, "make_record", fail_after_first_group)
+    with pytest.raises(RuntimeError):
+        workflow(parser.parse_args(["--prefetch-memory", "0", *argv]))
+    assert not (tmp_path / "output" / "metrics.tsv").is_file()
+    assert len(list((tmp_path / "output" / "records").glob("*.json"))) == 1
+
+    # Only the second group is evaluated when resuming
+    calls.clear()
+    workflow(parser.parse_args(["--resume", *argv]))
+    assert len(calls) == 1
+    resumed = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=[0, 1])
+
+    monkeypatch.setattr(wonkyconn.workflow, "make_record", make_record)
+    full_argv = [*small_argv[:-2], str(tmp_path / "full"), "group"]
+    workflow(parser.parse_args(["--group-by", "seg", "task", *full_argv]))
+    full = pd.read_csv(tmp_path / "full" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    pd.testing.assert_frame_equal(resumed, full, check_exact=True)
+
+
+def test_multiple_group_by(small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    from wonkyconn.base import ConnectivityMatrix
+
+    parser = global_parser()
+    load_lower_triangle = ConnectivityMatrix.load_lower_triangle
+    paths: list[Path] = []
+
+    def record_path(self):
+        paths.append(self.path)
+        return load_lower_triangle(self)
+
+    monkeypatch.setattr(ConnectivityMatrix, "load_lower_triangle", record_path)
+    workflow(parser.parse_args(["--group-by", "seg", "--group-by", "seg", "task", *small_argv]))
+    # Each connectivity matrix is only loaded once for both groupings
+    assert len(paths) == len(set(paths))
+    monkeypatch.setattr(ConnectivityMatrix, "load_lower_triangle", load_lower_triangle)
+
+    for group_by in [["seg"], ["seg", "task"]]:
+        name = f"metrics_{'_'.join(group_by)}"
+        assert (tmp_path / "output" / f"{name}.png").is_file()
+        metrics = pd.read_csv(tmp_path / "output" / f"{name}.tsv", sep="\t", index_col=list(range(len(group_by))))
+
+        separate_argv = [*small_argv[:-2], str(tmp_path / name), "group"]
+        workflow(parser.parse_args(["--group-by", *group_by, *separate_argv]))
+        separate = pd.read_csv(tmp_path / name / "metrics.tsv", sep="\t", index_col=list(range(len(group_by))))
+        pd.testing.assert_frame_equal(metrics, separate)
+
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--group-by", "seg", "--group-by", "task", "--shard", "1/2", *small_argv])
@@ -1,9 +1,13 @@
 import numpy as np
 import scipy
+from statsmodels.stats.multitest import multipletests
 
 from wonkyconn.correlation import (
+    benjamini_hochberg,
     correlation_p_value,
+    correlation_significant,
     partial_correlation,
+    partial_correlation_matrix,
 )
 
 
@@ -25,3 +29,40 @@ def test_correlation() -> None:
         r, p_val = scipy.stats.pearsonr(resid_x, resid_y)
         assert np.isclose(correlation[i], r)
         assert np.isclose(p_value[i], p_val)
+
+
+def test_partial_correlation_matrix() -> None:
+    n = 100
+    m = 50
+    x = np.random.normal(size=(n, m))
+    y = np.random.normal(size=(3, m))
+    cov = np.column_stack([np.ones(m), np.random.normal(size=(m, 2))])
+
+    expected = np.column_stack([partial_correlation(x, y[k], cov) for k in range(3)])
+    correlation = partial_correlation_matrix(x.copy(), y, cov)
+
+    assert correlation.shape == (n, 3)
+    assert np.allclose(correlation, expected)
+
+
+def test_correlation_significant() -> None:
+    r = np.random.uniform(-0.6, 0.6, size=1000)
+    m = 30
+    p_value = correlation_p_value(r, m)
+    assert np.array_equal(correlation_significant(r, m), p_value < 0.05)
+    assert np.array_equal(correlation_significant(r, m, alpha=0.01), p_value < 0.01)
+
+    ms = np.random.choice([10, 20, 40], size=r.size)
+    assert np.array_equal(correlation_significant(r, ms), correlation_p_value(r, ms) < 0.05)
+
+
+def test_benjamini_hochberg() -> None:
+    p_value = np.concatenate([np.random.uniform(0, 0.001, 50), np.random.uniform(0, 1, 950)])
+    expected, _, _, _ = multipletests(p_value, alpha=0.05, method="fdr_bh")
+    assert np.array_equal(benjamini_hochberg(p_value, alpha=0.05), expected)
+
+    p_value[:10] = np.nan
+    expected, _, _, _ = multipletests(p_value[10:], alpha=0.05, method="fdr_bh")
+    reject = benjamini_hochberg(p_value, alpha=0.05)
+    assert not reject[:10].any()
+    assert np.array_equal(reject[10:], expected)
@@ -0,0 +1,116 @@
+import shutil
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from wonkyconn.base import ConnectivityMatrix, EdgeStore
+from wonkyconn.deduplicate import get_file_fingerprint, get_fingerprint
+from wonkyconn.run import global_parser
+from wonkyconn.workflow import workflow
+
+
+def test_fingerprint(tmp_path: Path) -> None:
+    content = np.random.bytes(2**20)
+    (tmp_path / "a.tsv").write_bytes(content)
+    (tmp_path / "b.tsv").write_bytes(content)
+    (tmp_path / "c.tsv").symlink_to(tmp_path / "a.tsv")
+    (tmp_path / "d.tsv").write_bytes(content[:-1] + bytes([content[-1] ^ 1]))
+    (tmp_path / "e.tsv").write_bytes(content + b"\n")
+    fingerprints = [get_file_fingerprint(tmp_path / f"{name}.tsv") for name in "abcde"]
+    assert fingerprints[0] == fingerprints[1] == fingerprints[2]
+    assert len(set(fingerprints[2:])) == 3
+
+    array = np.random.uniform(size=(50, 50))
+    with h5py.File(tmp_path / "sub-1.h5", "w") as file:
+        file["a"] = array
+        file["b"] = array
+        file["c"] = array.T
+    a, b, c = [get_fingerprint(ConnectivityMatrix(tmp_path / "sub-1.h5" / name, dict())) for name in "abc"]
+    assert a == b != c
+
+
+def _copy_strategy(bids_dir: Path, desc: str, changed_subjects: set[str] = set()) -> None:
+    """
+    Add a strategy that is a copy of the first one, with symlinked connectivity matrices. The connectivity
+    matrices of the changed subjects have a different content.
+    """
+    for path in list(bids_dir.glob("**/*desc-denoiseSimple*")):
+        copy_path = path.with_name(path.name.replace("denoiseSimple", desc))
+        if "relmat" not in path.name:
+            shutil.copyfile(path, copy_path)
+        elif path.name.split("_")[0] in changed_subjects:
+            (pd.read_csv(path, sep="\t") * 0.5).to_csv(copy_path, sep="\t", index=False)
+        else:
+            copy_path.symlink_to(path)
+
+
+def test_deduplicate(small_bids_dir: Path, small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_bids_dir, bids_dir)
+    _copy_strategy(bids_dir, "denoiseCopy")
+    argv = [*small_argv[:-3], str(bids_dir), *small_argv[-2:]]
+
+    load_lower_triangle = ConnectivityMatrix.load_lower_triangle
+    paths: list[Path] = []
+
+    def record_path(self: ConnectivityMatrix) -> np.ndarray:
+        paths.append(self.path)
+        return load_lower_triangle(self)
+
+    monkeypatch.setattr(ConnectivityMatrix, "load_lower_triangle", record_path)
+    workflow(global_parser().parse_args(["--deduplicate", "--group-by", "seg", "desc", *argv]))
+    # Only the connectivity matrices of one strategy are loaded
+    assert len(paths) == len(set(paths)) == len(list(bids_dir.glob("**/*desc-denoiseSimple*_relmat.tsv")))
+
+    output_dir = tmp_path / "output"
+    metrics = pd.read_csv(output_dir / "metrics.tsv", sep="\t", index_col=[0, 1])
+    simple, copy = (metrics.xs(desc, level="desc") for desc in ["denoiseSimple", "denoiseCopy"])
+    pd.testing.assert_frame_equal(simple, copy)
+
+    duplicates = pd.read_csv(output_dir / "duplicates.tsv", sep="\t")
+    assert (duplicates["kind"] == "matrix").sum() == len(paths)
+    (group_duplicate,) = duplicates.loc[duplicates["kind"] == "group"].itertuples()
+    assert {group_duplicate.duplicate, group_duplicate.original} == {
+        "seg-Schaefer20187Networks100Parcels_desc-denoiseSimple",
+        "seg-Schaefer20187Networks100Parcels_desc-denoiseCopy",
+    }
+
+    # The duplicates of the groups that were completed by a previous run are kept
+    checkpoint_path = next((output_dir / "records").glob("*denoiseCopy*.json"))
+    checkpoint_path.unlink()
+    workflow(global_parser().parse_args(["--deduplicate", "--resume", "--group-by", "seg", "desc", *argv]))
+    pd.testing.assert_frame_equal(pd.read_csv(output_dir / "duplicates.tsv", sep="\t"), duplicates)
+
+    # Shards only see their own groups
+    (output_dir / "duplicates.tsv").unlink()
+    workflow(global_parser().parse_args(["--deduplicate", "--shard", "1/2", "--group-by", "seg", "desc", *argv]))
+    assert not (output_dir / "duplicates.tsv").exists()
+
+
+def test_deduplicate_shared(small_bids_dir: Path, small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # A second strategy that shares the connectivity matrices of some subjects with the first
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_bids_dir, bids_dir)
+    _copy_strategy(bids_dir, "denoisePartial", {"sub-sub-5", "sub-sub-6", "sub-sub-7"})
+    argv = [*small_argv[:-3], str(bids_dir), *small_argv[-2:]]
+    workflow(global_parser().parse_args(["--group-by", "seg", "desc", *argv]))
+    expected = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=[0, 1])
+
+    load = EdgeStore.load
+    stored_counts: list[int] = []
+
+    def record_load(connectivity_matrices: list[ConnectivityMatrix], keys: dict[Path, str] | None = None) -> EdgeStore:
+        edge_store = load(connectivity_matrices, keys)
+        stored_counts.append(sum(array.shape[1] for array in edge_store.connectivity_arrays.values()))
+        return edge_store
+
+    monkeypatch.setattr(EdgeStore, "load", record_load)
+    workflow(global_parser().parse_args(["--deduplicate", "--group-by", "seg", "desc", *argv]))
+    # Only the connectivity matrices that both strategies share are kept in memory
+    shared_paths = [path for path in bids_dir.glob("**/*desc-denoisePartial*_relmat.tsv") if path.is_symlink()]
+    assert stored_counts == [len(shared_paths)] != [0]
+    metrics = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    pd.testing.assert_frame_equal(metrics, expected)
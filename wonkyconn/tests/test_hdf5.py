@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from wonkyconn.base import ConnectivityMatrix
+from wonkyconn.file_index.bids import BIDSIndex
+
+h5py = pytest.importorskip("h5py")
+
+
+def _make_relmat(n: int) -> np.ndarray:
+    array = np.random.uniform(-1, 1, size=(n, n))
+    array = (array + array.T) / 2
+    np.fill_diagonal(array, 1)
+    return array
+
+
+def test_hdf5(tmp_path: Path) -> None:
+    n = 37
+    dense = _make_relmat(n)
+    i, j = np.tril_indices(n, k=-1)
+
+    hdf5_path = tmp_path / "sub-1" / "func" / "sub-1_seg-Schaefer20187Networks100Parcels_desc-simple.h5"
+    hdf5_path.parent.mkdir(parents=True)
+    with h5py.File(hdf5_path, "w") as file:
+        file.attrs["number_of_volumes_discarded_by_nonsteady_states_detector"] = 5
+        group = file.create_group("func")
+        name = "sub-1_task-rest_seg-Schaefer20187Networks100Parcels_desc-simple"
+        timeseries = group.create_dataset(f"{name}_timeseries", data=np.zeros((10, n)))
+        timeseries.attrs["mean_framewise_displacement"] = 0.3
+        timeseries.attrs["confound_regressors"] = np.array([b"csf", b"white_matter"])
+        group.create_dataset(f"{name}_relmat", data=dense, chunks=(4, n))
+        group.create_dataset(f"{name}_meas-lower_connectome", data=dense[i, j])
+
+    index = BIDSIndex()
+    index.put(tmp_path)
+
+    (timeseries_path,) = index.get(suffix="timeseries", extension=".h5")
+    assert index.get_tag_value(timeseries_path, "datatype") == "func"
+    metadata = index.get_metadata(timeseries_path)
+    assert metadata == dict(
+        NumberOfVolumesDiscardedByNonsteadyStatesDetector=5,
+        MeanFramewiseDisplacement=0.3,
+        ConfoundRegressors=["csf", "white_matter"],
+    )
+
+    relmat_paths = index.get(suffix="relmat", extension=".h5", task="rest")
+    assert len(relmat_paths) == 2
+    for relmat_path in relmat_paths:
+        connectivity_matrix = ConnectivityMatrix(relmat_path, metadata)
+        assert connectivity_matrix.region_count == n
+        assert np.allclose(connectivity_matrix.load_lower_triangle(), dense[i, j])
+        assert np.allclose(connectivity_matrix.load(), dense)
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import numpy as np
+from patsy.highlevel import dmatrix
+
+from wonkyconn.base import load_connectivity_array
+from wonkyconn.correlation import correlation_significant, partial_correlation_matrix
+from wonkyconn.features.influence import calculate_leave_one_out_influence
+from wonkyconn.features.quality_control_connectivity import fit_qcfc_model
+
+from wonkyconn.tests.utils import make_connectivity_matrices
+
+
+def test_calculate_leave_one_out_influence(tmp_path: Path) -> None:
+    n = 12
+    m = 24
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+    for connectivity_matrix in connectivity_matrices:
+        connectivity_matrix.metadata["MaxFramewiseDisplacement"] = np.random.uniform(0, 3)
+    # Two sessions per subject
+    subjects = [f"sub-{k // 2}" for k in range(m)]
+    data_frame.index = data_frame.index.map(lambda s: f"sub-{int(s.removeprefix('sub-')) // 2}")
+
+    metric_keys = ["MeanFramewiseDisplacement", "MaxFramewiseDisplacement"]
+    connectivity_array = load_connectivity_array(connectivity_matrices)
+    model = fit_qcfc_model(data_frame, connectivity_matrices, metric_keys, connectivity_array.copy())
+    influence_frame = calculate_leave_one_out_influence(model, subjects)
+    assert list(influence_frame.index) == list(dict.fromkeys(subjects))
+    assert (influence_frame.matrix_count == 2).all()
+
+    metrics = np.asarray([[c.metadata[key] for c in connectivity_matrices] for key in metric_keys])
+    covariates = np.asarray(dmatrix("age + gender", data_frame))
+    full_correlation = model.edges @ model.metrics.T
+    for subject in ["sub-0", "sub-5", "sub-11"]:
+        keep = np.asarray(subjects) != subject
+        correlation = partial_correlation_matrix(connectivity_array[:, keep].copy(), metrics[:, keep], covariates[keep])
+
+        record = influence_frame.loc[subject]
+        median_absolute = np.median(np.abs(correlation), axis=0)
+        assert np.allclose(record[["median_absolute_qcfc", "median_absolute_qcfc_MaxFramewiseDisplacement"]], median_absolute)
+        assert np.isclose(
+            record.median_absolute_qcfc_influence,
+            np.median(np.abs(full_correlation[:, 0])) - median_absolute[0],
+        )
+        percentage = 100 * correlation_significant(correlation, int(keep.sum())).mean(axis=0)
+        assert np.allclose(record[["percentage_significant_qcfc", "percentage_significant_qcfc_MaxFramewiseDisplacement"]], percentage)
@@ -0,0 +1,39 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from wonkyconn.correlation import correlation_significant
+from wonkyconn.features.network_blocks import NetworkBlocks, load_region_networks
+from wonkyconn.features.quality_control_connectivity import QCFCResult
+
+
+def test_network_blocks(tmp_path: Path) -> None:
+    n = 40
+    networks = np.random.choice(["Vis", "SomMot", "Default"], n)
+    names = [f"7Networks_{'LH' if k % 2 else 'RH'}_{network}_{k}" for k, network in enumerate(networks)]
+    label_path = tmp_path / "dseg.tsv"
+    pd.DataFrame(dict(index=np.arange(n + 1), name=["Background", *names])).to_csv(label_path, sep="\t", index=False)
+    region_networks = load_region_networks(label_path)
+    assert region_networks == list(networks)
+
+    correlation = np.random.uniform(-0.6, 0.6, n * (n - 1) // 2)
+    correlation[::11] = np.nan
+    qcfc = QCFCResult(region_count=n, correlation=correlation, sample_count=25)
+    network_frame = NetworkBlocks.from_region_networks(region_networks).calculate(qcfc)
+
+    # Compare with pandas
+    i, j = qcfc.get_indices()
+    edge_frame = pd.DataFrame(
+        dict(
+            a=np.where(networks[i] < networks[j], networks[i], networks[j]),
+            b=np.where(networks[i] < networks[j], networks[j], networks[i]),
+            absolute=np.abs(correlation),
+            significant=correlation_significant(correlation, 25),
+        )
+    )
+    expected = edge_frame.groupby(["a", "b"]).agg(median=("absolute", "median"), percentage=("significant", "mean"))
+    for (a, b), row in expected.iterrows():
+        for x, y in [(a, b), (b, a)]:
+            assert np.isclose(network_frame.loc[("median_absolute_qcfc", x), y], row["median"])
+            assert np.isclose(network_frame.loc[("percentage_significant_qcfc", x), y], 100 * row["percentage"])
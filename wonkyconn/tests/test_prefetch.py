@@ -0,0 +1,28 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from wonkyconn.base import load_connectivity_array
+from wonkyconn.prefetch import Prefetcher, estimate_connectivity_array_size
+from wonkyconn.tests.utils import make_connectivity_matrices
+
+
+@pytest.mark.parametrize("memory_budget", [0, 2**30])
+def test_prefetcher(tmp_path: Path, memory_budget: int) -> None:
+    groups = dict()
+    for k, n in enumerate([5, 12, 7]):
+        group_path = tmp_path / f"group-{k}"
+        group_path.mkdir()
+        _, groups[k] = make_connectivity_matrices(group_path, n, 4 + k)
+
+    prefetcher = Prefetcher(groups, memory_budget, thread_count=2)
+    assert len(prefetcher) == 3
+
+    keys = []
+    for key, connectivity_matrices, connectivity_array in prefetcher:
+        keys.append(key)
+        assert connectivity_matrices is groups[key]
+        assert connectivity_array.nbytes == estimate_connectivity_array_size(connectivity_matrices)
+        assert np.array_equal(connectivity_array, load_connectivity_array(connectivity_matrices))
+    assert keys == [0, 1, 2]
@@ -0,0 +1,66 @@
+import json
+import math
+import threading
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+from wonkyconn.progress import MetricsServer, Progress, format_status
+from wonkyconn.run import global_parser
+from wonkyconn.workflow import workflow
+
+
+def test_progress() -> None:
+    now = [0.0]
+    progress = Progress(clock=lambda: now[0])
+    progress.add_groups(4)
+    assert progress.get_status()["eta_seconds"] is None
+
+    now[0] = 10.0
+    progress.add_matrix(1000)
+    progress.add_matrix(500)
+    progress.finish_group()
+    status = progress.get_status()
+    assert status["groups_done"] == 1
+    assert status["groups_pending"] == 3
+    assert status["bytes_read"] == 1500
+    assert status["matrices_per_second"] == pytest.approx(0.2)
+    assert status["eta_seconds"] == pytest.approx(30.0)
+
+    metrics = progress.format_metrics()
+    assert "wonkyconn_groups_pending 3\n" in metrics
+    assert "wonkyconn_bytes_read_total 1500\n" in metrics
+    assert 'wonkyconn_stage{stage="starting"} 1\n' in metrics
+
+    server = MetricsServer(("127.0.0.1", 0), progress)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        host, port = server.server_address[:2]
+        with urllib.request.urlopen(f"http://{host!s}:{port}/metrics") as response:
+            assert response.read().decode() == progress.format_metrics()
+        with urllib.request.urlopen(f"http://{host!s}:{port}/status") as response:
+            assert json.loads(response.read())["groups_done"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_format_status() -> None:
+    # The status is strict JSON even if the clock misbehaves
+    text = format_status(Progress(clock=lambda: math.nan).get_status())
+    assert "NaN" not in text
+    assert json.loads(text)["elapsed_seconds"] is None
+
+
+def test_status_file(small_argv: list[str], tmp_path: Path) -> None:
+    status_file = tmp_path / "status.json"
+    workflow(global_parser().parse_args(["--status-file", str(status_file), "--group-by", "seg", "task", *small_argv]))
+
+    status = json.loads(status_file.read_text())
+    assert status["stage"] == "done"
+    assert status["groups_done"] == status["groups_total"] > 0
+    assert status["groups_pending"] == 0
+    assert status["matrices_loaded"] > 0
+    assert status["bytes_read"] > 0
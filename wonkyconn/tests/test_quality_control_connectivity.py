@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import numpy as np
+from patsy.highlevel import dmatrix
+
+from wonkyconn.correlation import partial_correlation
+from wonkyconn.features.quality_control_connectivity import (
+    QCFCResult,
+    calculate_median_absolute,
+    calculate_qcfc,
+    calculate_qcfc_for_metrics,
+    calculate_qcfc_percentage,
+)
+from wonkyconn.tests.utils import make_connectivity_matrices
+
+
+def test_calculate_qcfc(tmp_path: Path) -> None:
+    n = 20
+    m = 30
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+
+    qcfc = calculate_qcfc(data_frame, connectivity_matrices)
+    assert isinstance(qcfc, QCFCResult)
+    assert qcfc.correlation.shape == (n * (n - 1) // 2,)
+    assert qcfc.p_value.shape == qcfc.correlation.shape
+
+    qcfc_frame = qcfc.to_data_frame()
+    i, j = np.asarray(qcfc_frame.index.get_level_values("i")), np.asarray(qcfc_frame.index.get_level_values("j"))
+    assert np.all(i > j)
+    assert np.array_equal(qcfc_frame.correlation.to_numpy(), qcfc.correlation)
+
+    assert calculate_median_absolute(qcfc.correlation) == qcfc_frame.correlation.abs().median()
+    percentage = calculate_qcfc_percentage(qcfc)
+    assert 0 <= percentage <= 100
+    assert np.isclose(percentage, 100 * np.mean(qcfc.p_value < 0.05))
+    assert calculate_qcfc_percentage(qcfc, correction="fdr_bh") <= percentage
+
+
+def test_calculate_qcfc_for_metrics(tmp_path: Path) -> None:
+    n = 10
+    m = 25
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+    for connectivity_matrix in connectivity_matrices:
+        connectivity_matrix.metadata["MaxFramewiseDisplacement"] = np.random.uniform(0, 3)
+
+    metric_keys = ["MeanFramewiseDisplacement", "MaxFramewiseDisplacement"]
+    qcfc = calculate_qcfc_for_metrics(data_frame, connectivity_matrices, metric_keys)
+    assert list(qcfc.keys()) == metric_keys
+
+    covariates = np.asarray(dmatrix("age + gender", data_frame))
+    i, j = np.tril_indices(n, k=-1)
+    connectivity_array = np.stack([c.load()[i, j] for c in connectivity_matrices], axis=1)
+    for metric_key in metric_keys:
+        metrics = np.asarray([c.metadata[metric_key] for c in connectivity_matrices])
+        expected = partial_correlation(connectivity_array, metrics, covariates)
+        assert np.allclose(qcfc[metric_key].correlation, expected)
+        assert np.allclose(calculate_qcfc(data_frame, connectivity_matrices, metric_key).correlation, expected)
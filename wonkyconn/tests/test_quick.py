@@ -0,0 +1,51 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wonkyconn.quick import sample_edges, sample_subjects
+from wonkyconn.run import global_parser
+from wonkyconn.workflow import workflow
+
+metric_names = ["median_absolute_qcfc", "percentage_significant_qcfc", "distance_dependence"]
+
+
+def test_sample() -> None:
+    edge_indices = sample_edges(100, 1000)
+    assert edge_indices.size == np.unique(edge_indices).size == 1000
+    assert np.array_equal(edge_indices, sample_edges(100, 1000))
+    assert np.array_equal(sample_edges(4, 1000), np.arange(6))
+
+    subjects = ["sub-1", "sub-1", "sub-2", "sub-3", "sub-3"]
+    sample = sample_subjects(subjects, 2)
+    assert len({subjects[k] for k in sample}) == 2
+    # All connectivity matrices of the sampled subjects are kept
+    assert all(subjects[k] != subject or k in sample for k in range(5) for subject in {subjects[k] for k in sample})
+
+
+def test_quick(small_argv: list[str], tmp_path: Path) -> None:
+    parser = global_parser()
+    workflow(parser.parse_args(["--group-by", "seg", "task", *small_argv]))
+    full = pd.read_csv(tmp_path / "output" / "metrics.tsv", sep="\t", index_col=[0, 1])
+
+    # With all edges, the quick mode gives the same metrics
+    all_argv = [*small_argv[:-2], str(tmp_path / "all"), "group"]
+    workflow(parser.parse_args(["--quick", "--quick-edge-count", "5000", "--group-by", "seg", "task", *all_argv]))
+    quick = pd.read_csv(tmp_path / "all" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    pd.testing.assert_frame_equal(quick[full.columns], full)
+    assert not (tmp_path / "all" / "records").exists()
+
+    sample_argv = [*small_argv[:-2], str(tmp_path / "sample"), "group"]
+    workflow(parser.parse_args(["--quick", "--quick-edge-count", "1000", "--group-by", "seg", "task", *sample_argv]))
+    quick = pd.read_csv(tmp_path / "sample" / "metrics.tsv", sep="\t", index_col=[0, 1])
+    assert (quick["quick_edge_count"] == 1000).all()
+    for name in metric_names:
+        assert (quick[f"{name}_lower"] <= quick[name]).all()
+        assert (quick[name] <= quick[f"{name}_upper"]).all()
+    # The full metrics are within the bounds
+    assert (quick["median_absolute_qcfc_lower"] <= full["median_absolute_qcfc"]).all()
+    assert (full["median_absolute_qcfc"] <= quick["median_absolute_qcfc_upper"]).all()
+
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--quick", "--leave-one-out", *sample_argv])
@@ -0,0 +1,69 @@
+import io
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+from PIL import Image
+
+from wonkyconn.features.quality_control_connectivity import QCFCResult
+from wonkyconn.run import global_parser
+from wonkyconn.visualization.report import EdgeHistograms, encode_png
+from wonkyconn.workflow import workflow
+
+
+def test_edge_histograms(tmp_path: Path) -> None:
+    n = 50
+    edge_count = n * (n - 1) // 2
+    correlation = np.random.uniform(-0.5, 0.5, edge_count)
+    correlation[3] = np.nan
+    qcfc = QCFCResult(region_count=n, correlation=correlation, sample_count=20)
+    distance_vector = np.random.uniform(0, 150, edge_count)
+
+    histograms = EdgeHistograms.calculate(qcfc, distance_vector, correlation_bin_count=20, distance_bin_count=10)
+    expected, _ = np.histogram(correlation[~np.isnan(correlation)], bins=histograms.correlation_edges)
+    assert np.array_equal(histograms.correlation_counts, expected)
+    expected_2d, _, _ = np.histogram2d(
+        distance_vector[~np.isnan(correlation)],
+        correlation[~np.isnan(correlation)],
+        bins=[histograms.distance_edges, histograms.correlation_edges],
+    )
+    assert np.array_equal(histograms.distance_counts, expected_2d)
+
+    histograms.save(tmp_path / "histograms.npz")
+    loaded = EdgeHistograms.load(tmp_path / "histograms.npz")
+    assert np.array_equal(loaded.distance_counts, histograms.distance_counts)
+
+    # Sparse results only have the distances of their edges
+    edge_indices = np.arange(0, edge_count, 3)
+    sparse_qcfc = QCFCResult(region_count=n, correlation=correlation[edge_indices], sample_count=20, edge_indices=edge_indices)
+    sparse_histograms = EdgeHistograms.calculate(sparse_qcfc, distance_vector)
+    assert sparse_histograms.distance_counts.sum() == np.count_nonzero(~np.isnan(correlation[edge_indices]))
+
+    # Edges to regions without voxels have no distance and are left out of the distance histogram
+    distance_vector[:5] = np.nan
+    nan_histograms = EdgeHistograms.calculate(qcfc, distance_vector, correlation_bin_count=20, distance_bin_count=10)
+    assert np.array_equal(nan_histograms.correlation_counts, histograms.correlation_counts)
+    assert nan_histograms.distance_counts.sum() == histograms.distance_counts.sum() - 4
+
+
+def test_encode_png() -> None:
+    rgba = np.random.randint(0, 256, size=(7, 5, 4), dtype=np.uint8)
+    image = Image.open(io.BytesIO(encode_png(rgba)))
+    assert np.array_equal(np.asarray(image.convert("RGBA")), rgba)
+
+
+def test_report(small_argv: list[str], tmp_path: Path) -> None:
+    workflow(global_parser().parse_args(["--report", "--group-by", "seg", "task", *small_argv]))
+
+    output_dir = tmp_path / "output"
+    metrics = pd.read_csv(output_dir / "metrics.tsv", sep="\t")
+    report = (output_dir / "metrics.html").read_text()
+    assert len(re.findall("<section", report)) == len(metrics)
+    assert report.count("data:image/png;base64,") == len(metrics)
+    assert len(list((output_dir / "histograms").glob("*_histograms.npz"))) == len(metrics)
+    assert (output_dir / "metrics.html").stat().st_size < 50000 * len(metrics)
+
+    # The metrics plot closes its figure after saving it
+    assert not plt.get_fignums()
@@ -0,0 +1,48 @@
+import threading
+import time
+from pathlib import Path
+
+from wonkyconn.scheduler import GroupPlan, Scheduler, estimate_working_set, plan_groups
+from wonkyconn.tests.utils import make_connectivity_matrices
+
+
+def test_plan_groups(tmp_path: Path) -> None:
+    groups = dict()
+    for k, (n, m) in enumerate([(5, 4), (30, 20)]):
+        group_path = tmp_path / f"group-{k}"
+        group_path.mkdir()
+        _, groups[k] = make_connectivity_matrices(group_path, n, m)
+
+    memory_limit = estimate_working_set(30, 4, 1)
+    small, large = plan_groups(groups, memory_limit, 1)
+    assert small.batch_size is None
+    assert small.working_set == estimate_working_set(5, 4, 1)
+    assert large.batch_size is not None and large.batch_size < 20
+    assert large.working_set <= memory_limit
+
+    (large,) = plan_groups({1: groups[1]}, memory_limit, 1, allow_batches=False)
+    assert large.batch_size is None
+
+
+def test_scheduler() -> None:
+    working_sets = [4, 1, 2, 6, 3, 3, 1]
+    plans = [GroupPlan(k, [], working_set) for k, working_set in enumerate(working_sets)]
+    memory_limit = 6
+
+    lock = threading.Lock()
+    running: set[int] = set()
+    maximum_reserved = 0
+
+    def function(plan: GroupPlan[int]) -> int:
+        nonlocal maximum_reserved
+        with lock:
+            running.add(plan.key)
+            maximum_reserved = max(maximum_reserved, sum(working_sets[k] for k in running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(plan.key)
+        return plan.key * 2
+
+    results = list(Scheduler(plans, memory_limit, thread_count=3).run(function))
+    assert results == [(k, k * 2) for k in range(len(plans))]
+    assert maximum_reserved <= memory_limit
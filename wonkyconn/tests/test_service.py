@@ -0,0 +1,156 @@
+import http.client
+import json
+import shutil
+import socket
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wonkyconn.run import serve_parser
+from wonkyconn.file_index.bids import BIDSIndex
+from wonkyconn.service import EvaluationServer, EvaluationService, UnixEvaluationServer, make_server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: Path) -> None:
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(self.socket_path))
+
+
+def _request(connection: http.client.HTTPConnection, method: str, path: str, content: dict | None = None) -> tuple[int, dict]:
+    body = None if content is None else json.dumps(content)
+    connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read(), parse_constant=_reject_constant)
+
+
+def _reject_constant(constant: str) -> None:
+    raise ValueError(f"The response is not strict JSON because it contains {constant}")
+
+
+@pytest.mark.parametrize("use_socket", [False, True])
+def test_service(small_argv: list[str], tmp_path: Path, use_socket: bool) -> None:
+    if use_socket:
+        argv = ["--socket", str(tmp_path / "wonkyconn.sock")]
+    else:
+        argv = ["--port", "0"]
+    server = make_server(serve_parser().parse_args(argv))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def connect() -> http.client.HTTPConnection:
+        if isinstance(server, UnixEvaluationServer):
+            return UnixHTTPConnection(tmp_path / "wonkyconn.sock")
+        assert isinstance(server, EvaluationServer)
+        host, port = server.server_address[:2]
+        return http.client.HTTPConnection(str(host), port)
+
+    try:
+        assert _request(connect(), "GET", "/health") == (200, dict(status="ok"))
+
+        phenotypes = small_argv[small_argv.index("--phenotypes") + 1]
+        seg, atlas_path = small_argv[small_argv.index("--seg-to-atlas") + 1 : small_argv.index("--seg-to-atlas") + 3]
+        job = dict(bids_dir=small_argv[-3], phenotypes=phenotypes, seg_to_atlas=[[seg, atlas_path]], group_by=["seg", "task"])
+
+        # Run several jobs at the same time
+        results: list[tuple[int, dict]] = []
+        threads = [threading.Thread(target=lambda: results.append(_request(connect(), "POST", "/evaluate", job))) for _ in range(3)]
+        for job_thread in threads:
+            job_thread.start()
+        for job_thread in threads:
+            job_thread.join()
+        assert [status for status, _ in results] == [200, 200, 200]
+        frames = [pd.DataFrame.from_records(result["records"], index=result["group_by"]).sort_index() for _, result in results]
+        assert len(frames[0]) == 2
+        for frame in frames[1:]:
+            pd.testing.assert_frame_equal(frame, frames[0])
+        assert len(server.service.indexes) == 1
+        assert len(server.service.atlases) == 1
+
+        status, result = _request(connect(), "POST", "/evaluate", dict(bids_dir=small_argv[-3]))
+        assert status == 400
+        assert "phenotypes" in result["error"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_service_non_finite(monkeypatch: pytest.MonkeyPatch) -> None:
+    server = make_server(serve_parser().parse_args(["--port", "0"]))
+    result = dict(group_by=["seg"], records=[dict(seg="a", median_dof=np.nan, qcfc_mean=np.float64(np.inf), total=3)])
+    monkeypatch.setattr(server.service, "evaluate", lambda job: result)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        host, port = server.server_address[:2]
+        status, content = _request(http.client.HTTPConnection(str(host), port), "POST", "/evaluate", dict())
+        assert status == 200
+        assert content["records"] == [dict(seg="a", median_dof=None, qcfc_mean=None, total=3)]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_service_lock(small_argv: list[str], monkeypatch: pytest.MonkeyPatch) -> None:
+    service = EvaluationService(cache_memory=0)
+    indexing = threading.Event()
+    released = threading.Event()
+    put = BIDSIndex.put
+
+    def slow_put(index: BIDSIndex, root: Path) -> None:
+        indexing.set()
+        released.wait(timeout=10)
+        put(index, root)
+
+    monkeypatch.setattr(BIDSIndex, "put", slow_put)
+    thread = threading.Thread(target=service.get_index, args=(Path(small_argv[-3]),))
+    thread.start()
+    try:
+        assert indexing.wait(timeout=10)
+        # Loading the phenotypes does not wait for the index of another job
+        phenotypes = Path(small_argv[small_argv.index("--phenotypes") + 1])
+        assert len(service.get_data_frame(phenotypes)) > 0
+        assert thread.is_alive()
+    finally:
+        released.set()
+        thread.join()
+    assert len(service.indexes) == 1
+
+
+def test_service_update(small_argv: list[str], tmp_path: Path) -> None:
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_argv[-3], bids_dir)
+    phenotypes = small_argv[small_argv.index("--phenotypes") + 1]
+    seg, atlas_path = small_argv[small_argv.index("--seg-to-atlas") + 1 : small_argv.index("--seg-to-atlas") + 3]
+    job = dict(bids_dir=str(bids_dir), phenotypes=phenotypes, seg_to_atlas=[[seg, atlas_path]], group_by=["seg", "task"])
+
+    # A small memory limit evaluates the groups in batches of connectivity matrices
+    service = EvaluationService(cache_memory=0, memory_limit=2**20)
+    result = service.evaluate(job)
+    assert len(result["records"]) == 2
+    index = service.get_index(bids_dir)
+    assert service.get_index(bids_dir) is index
+
+    # Files of a new task are picked up by the next job without a refresh
+    new_paths = [
+        path.with_name(path.name.replace("task-selectivestopsignaltask", "task-other"))
+        for path in bids_dir.glob("**/*task-selectivestopsignaltask*")
+    ]
+    for path in new_paths:
+        shutil.copyfile(path.with_name(path.name.replace("task-other", "task-selectivestopsignaltask")), path)
+    result = service.evaluate(job)
+    assert sorted(record["task"] for record in result["records"]) == ["other", "probabilisticclassification", "selectivestopsignaltask"]
+    # The previous index is not changed for jobs that may still use it
+    assert "other" not in index.get_tag_values("task")
+
+    for path in new_paths:
+        path.unlink()
+    result = service.evaluate(job)
+    assert len(result["records"]) == 2
@@ -0,0 +1,123 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy
+
+from wonkyconn import evaluate
+from wonkyconn.base import ConnectivityMatrix, SparseConnectivityArray, get_edge_indices, load_connectivity_array, load_sparse_connectivity_array
+from wonkyconn.export import find_qcfc_edges
+from wonkyconn.features.quality_control_connectivity import QCFCModel, calculate_sparse_qcfc
+from wonkyconn.run import global_parser
+from wonkyconn.tests.utils import make_connectivity_matrices
+from wonkyconn.workflow import workflow
+
+
+def _save_sparse(path: Path, array: np.ndarray, present: np.ndarray) -> None:
+    i, j = np.nonzero(np.tril(present, k=-1))
+    matrix = scipy.sparse.coo_matrix((array[i, j], (i, j)), shape=array.shape)
+    scipy.sparse.save_npz(path, matrix)
+
+
+def test_load_edges(tmp_path: Path) -> None:
+    path = tmp_path / "sub-1_relmat.npz"
+    # Symmetric storage, an explicit zero, a diagonal entry and a missing value
+    row = np.asarray([1, 0, 3, 2, 3, 2])
+    col = np.asarray([0, 1, 1, 2, 0, 0])
+    data = np.asarray([0.5, 0.5, 0.0, 1.0, np.nan, 0.25])
+    scipy.sparse.save_npz(path, scipy.sparse.coo_matrix((data, (row, col)), shape=(4, 4)))
+
+    connectivity_matrix = ConnectivityMatrix(path, dict())
+    assert connectivity_matrix.is_sparse
+    assert connectivity_matrix.region_count == 4
+    edge_indices, values = connectivity_matrix.load_edges()
+    assert np.array_equal(edge_indices, get_edge_indices([1, 2, 3], [0, 0, 1]))
+    assert np.array_equal(values, [0.5, 0.25, 0.0])
+
+    lower_triangle = connectivity_matrix.load_lower_triangle()
+    assert np.array_equal(np.isnan(lower_triangle), [False, False, True, True, False, True])
+    array = connectivity_matrix.load()
+    assert array[0, 1] == array[1, 0] == 0.5
+    assert np.isnan(array[3, 0])
+
+
+def test_sparse_qcfc_dense(tmp_path: Path) -> None:
+    n = 12
+    m = 25
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+    metrics = dict(MeanFramewiseDisplacement=[c.metadata["MeanFramewiseDisplacement"] for c in connectivity_matrices])
+    connectivity_array = load_connectivity_array(connectivity_matrices)
+
+    edges = [(np.arange(connectivity_array.shape[0]), connectivity_array[:, k]) for k in range(m)]
+    sparse_array = SparseConnectivityArray.from_edges(n, edges)
+    (qcfc,) = calculate_sparse_qcfc(data_frame, sparse_array, metrics, block_size=7).values()
+    (expected,) = QCFCModel.fit(data_frame, connectivity_array, metrics).get_results().values()
+
+    assert np.allclose(qcfc.correlation, expected.correlation)
+    assert np.array_equal(qcfc.sample_count, np.full(n * (n - 1) // 2, m))
+    assert all(np.array_equal(a, b) for a, b in zip(qcfc.get_indices(), expected.get_indices()))
+
+
+def test_sparse_qcfc_missing(tmp_path: Path) -> None:
+    n = 10
+    m = 40
+    data_frame, connectivity_matrices = make_connectivity_matrices(tmp_path, n, m)
+    metrics = dict(MeanFramewiseDisplacement=[c.metadata["MeanFramewiseDisplacement"] for c in connectivity_matrices])
+    connectivity_array = load_connectivity_array(connectivity_matrices)
+
+    # Drop random edges, one edge from all but three matrices, and one edge from all matrices
+    present = np.random.uniform(size=connectivity_array.shape) > 0.3
+    present[0, 3:] = False
+    present[1] = False
+    edges = [(np.flatnonzero(present[:, k]), connectivity_array[present[:, k], k]) for k in range(m)]
+    sparse_array = SparseConnectivityArray.from_edges(n, edges)
+    assert 1 not in sparse_array.edge_indices
+
+    (qcfc,) = evaluate(sparse_array, metrics, data_frame).qcfc.values()
+    assert qcfc.edge_indices is not None
+    assert np.isnan(qcfc.correlation[0])
+    assert np.array_equal(qcfc.sample_count, present[sparse_array.edge_indices].sum(axis=1))
+
+    # Each edge matches the dense calculation for the connectivity matrices that contain it
+    for k, edge_index in enumerate(sparse_array.edge_indices[1:6], start=1):
+        mask = present[edge_index]
+        subset = connectivity_array[[edge_index]][:, mask].copy()
+        model = QCFCModel.fit(data_frame.loc[mask], subset, dict(MeanFramewiseDisplacement=np.asarray(metrics["MeanFramewiseDisplacement"])[mask]))
+        (expected,) = model.get_results().values()
+        assert np.isclose(qcfc.correlation[k], expected.correlation[0])
+
+    with pytest.raises(ValueError):
+        evaluate(sparse_array, metrics, data_frame, leave_one_out=True)
+
+
+def test_sparse_workflow(small_bids_dir: Path, small_argv: list[str], tmp_path: Path) -> None:
+    bids_dir = tmp_path / "bids"
+    for path in small_bids_dir.glob("**/*"):
+        if not path.is_file():
+            continue
+        new_path = bids_dir / path.relative_to(small_bids_dir)
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        if path.name.endswith("_relmat.tsv"):
+            array = pd.read_csv(path, sep="\t").to_numpy()
+            present = np.random.uniform(size=array.shape) > 0.2
+            _save_sparse(new_path.with_suffix(".npz"), array, present)
+        else:
+            new_path.write_bytes(path.read_bytes())
+
+    argv = [str(bids_dir / "participants.tsv") if value == str(small_bids_dir / "participants.tsv") else value for value in small_argv]
+    argv[-3] = str(bids_dir)
+    workflow(global_parser().parse_args(["--export-edges", *argv]))
+
+    output_dir = tmp_path / "output"
+    metrics = pd.read_csv(output_dir / "metrics.tsv", sep="\t")
+    assert len(metrics) == 1
+    assert np.isfinite(metrics[["median_absolute_qcfc", "percentage_significant_qcfc", "distance_dependence"]].to_numpy()).all()
+
+    ((_, qcfc),) = find_qcfc_edges(output_dir / "edges")
+    assert qcfc.edge_indices is not None
+    assert qcfc.correlation.shape == qcfc.edge_indices.shape == np.shape(qcfc.sample_count)
+
+    # The same edges are found when loading the connectivity matrices directly
+    sparse_array = load_sparse_connectivity_array([ConnectivityMatrix(path, dict()) for path in sorted(bids_dir.glob("**/*_relmat.npz"))])
+    assert np.array_equal(qcfc.edge_indices, sparse_array.edge_indices)
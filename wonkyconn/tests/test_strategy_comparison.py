@@ -0,0 +1,96 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from wonkyconn.features.quality_control_connectivity import QCFCModel, calculate_median_absolute
+from wonkyconn.features.strategy_comparison import compare_strategies
+from wonkyconn.run import global_parser
+from wonkyconn.workflow import workflow
+
+
+def test_compare_strategies() -> None:
+    rng = np.random.default_rng(1)
+    edge_count = 300
+    sample_count = 40
+    data_frame = pd.DataFrame(dict(age=rng.uniform(18, 80, sample_count), gender=["m", "f"] * (sample_count // 2)))
+    motion = rng.gamma(2, 0.1, sample_count)
+
+    clean = rng.normal(size=(edge_count, sample_count))
+    # The first strategy leaves motion in the edges, the other two are equally clean
+    connectivity_arrays = np.stack(
+        [
+            clean + 20 * motion * rng.uniform(0.5, 1, (edge_count, 1)),
+            clean + rng.normal(scale=0.1, size=clean.shape),
+            clean + rng.normal(scale=0.1, size=clean.shape),
+        ]
+    )
+    comparison = compare_strategies(
+        ["noisy", "clean", "other"], data_frame, connectivity_arrays, np.tile(motion, (3, 1)), permutation_count=200, memory_limit=2**20
+    )
+
+    for k in range(3):
+        (qcfc,) = QCFCModel.fit(data_frame, connectivity_arrays[k].copy(), dict(motion=motion)).get_results().values()
+        assert np.isclose(comparison.median_absolute_qcfc[k], calculate_median_absolute(qcfc.correlation))
+
+    assert np.allclose(comparison.difference, -comparison.difference.T)
+    assert comparison.difference[0, 1] > 0
+    assert comparison.p_value[0, 1] == comparison.p_value[1, 0] < 0.05
+    assert comparison.corrected_p_value[0, 2] < 0.05
+    assert comparison.p_value[1, 2] > 0.05
+    assert (comparison.corrected_p_value >= comparison.p_value).all()
+
+    # The paired differences are significant at most edges of the noisy strategy
+    assert comparison.percentage_different_edges[0, 1] == comparison.percentage_different_edges[1, 0] > 50
+    assert comparison.percentage_different_edges[1, 2] < 5
+    mean = np.abs([QCFCModel.fit(data_frame, a.copy(), dict(motion=motion)).get_results()["motion"].correlation for a in connectivity_arrays]).mean(axis=1)
+    assert np.isclose(comparison.difference[0, 2], mean[0] - mean[2])
+
+    # A smaller memory limit evaluates the edges in blocks with the same permutations
+    blocked = compare_strategies(
+        ["noisy", "clean", "other"], data_frame, list(connectivity_arrays), np.tile(motion, (3, 1)), permutation_count=200, memory_limit=2**16
+    )
+    assert np.allclose(blocked.difference, comparison.difference)
+    assert np.array_equal(blocked.p_value, comparison.p_value)
+    assert np.array_equal(blocked.percentage_different_edges, comparison.percentage_different_edges)
+
+    frames = comparison.to_data_frames()
+    assert list(frames["p_value"].columns) == ["noisy", "clean", "other"]
+
+
+def test_compare(small_argv: list[str], tmp_path: Path) -> None:
+    workflow(global_parser().parse_args(["--compare", "--compare-permutations", "20", "--group-by", "seg", "task", *small_argv]))
+
+    output_dir = tmp_path / "output"
+    metrics = pd.read_csv(output_dir / "metrics.tsv", sep="\t")
+    for name in ["difference", "p_value", "corrected_p_value", "percentage_different_edges"]:
+        comparison_frame = pd.read_csv(output_dir / f"comparison_{name}.tsv", sep="\t", index_col=0)
+        assert comparison_frame.shape == (len(metrics), len(metrics))
+
+
+def test_compare_memory_limit(small_argv: list[str], tmp_path: Path) -> None:
+    argv = ["--compare", "--compare-permutations", "20", "--group-by", "seg", "task", *small_argv]
+    workflow(global_parser().parse_args(argv))
+    output_dir = tmp_path / "output"
+    expected = pd.read_csv(output_dir / "comparison_p_value.tsv", sep="\t", index_col=0)
+
+    # The connectivity matrices do not fit, so they are saved to temporary files and compared in blocks of edges
+    workflow(global_parser().parse_args(["--memory-limit", "64K", *argv]))
+    pd.testing.assert_frame_equal(pd.read_csv(output_dir / "comparison_p_value.tsv", sep="\t", index_col=0), expected)
+    assert not [path for path in output_dir.iterdir() if path.is_dir() and path.name.startswith("tmp")]
+
+
+def test_compare_resume(small_argv: list[str], tmp_path: Path) -> None:
+    argv = ["--group-by", "seg", "task", *small_argv]
+    workflow(global_parser().parse_args(argv))
+
+    # Only some groups are left to evaluate, but all of them are compared
+    output_dir = tmp_path / "output"
+    checkpoint_paths = sorted((output_dir / "records").glob("*.json"))
+    assert len(checkpoint_paths) > 1
+    checkpoint_paths[0].unlink()
+    workflow(global_parser().parse_args(["--resume", "--compare", "--compare-permutations", "20", *argv]))
+
+    metrics = pd.read_csv(output_dir / "metrics.tsv", sep="\t")
+    comparison_frame = pd.read_csv(output_dir / "comparison_difference.tsv", sep="\t", index_col=0)
+    assert comparison_frame.shape == (len(metrics), len(metrics))
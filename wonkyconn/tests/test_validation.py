@@ -0,0 +1,48 @@
+import json
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from wonkyconn.base import ConnectivityMatrix
+from wonkyconn.run import global_parser
+from wonkyconn.validation import ValidationError
+from wonkyconn.workflow import workflow
+
+
+def test_validation(small_bids_dir: Path, small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_bids_dir, bids_dir)
+    argv = [str(bids_dir / "participants.tsv") if value == str(small_bids_dir / "participants.tsv") else value for value in small_argv]
+    argv[-3] = str(bids_dir)
+
+    # A subject without phenotypes
+    phenotypes = pd.read_csv(bids_dir / "participants.tsv", sep="\t")
+    phenotypes[phenotypes["participant_id"] != "sub-2"].to_csv(bids_dir / "participants.tsv", sep="\t", index=False)
+
+    # A sidecar without the motion metric and with an invalid value
+    sidecar_path = sorted(bids_dir.glob("sub-sub-3/*/func/*_timeseries.json"))[0]
+    metadata = json.loads(sidecar_path.read_text())
+    del metadata["MeanFramewiseDisplacement"]
+    metadata["NumberOfVolumesDiscardedByMotionScrubbing"] = "many"
+    sidecar_path.write_text(json.dumps(metadata))
+
+    # A connectivity matrix that does not match the atlas
+    relmat_path = sorted(bids_dir.glob("sub-sub-4/**/*_relmat.tsv"))[0]
+    relmat = pd.read_csv(relmat_path, sep="\t")
+    relmat.iloc[:-1, :-1].to_csv(relmat_path, sep="\t", index=False)
+
+    def fail(self):
+        raise AssertionError("No connectivity matrix should be loaded")
+
+    monkeypatch.setattr(ConnectivityMatrix, "load_lower_triangle", fail)
+
+    with pytest.raises(ValidationError) as exc_info:
+        workflow(global_parser().parse_args(argv))
+    problems = exc_info.value.problems
+    assert any("not in the phenotypes file: sub-2" in problem for problem in problems)
+    assert any('without "MeanFramewiseDisplacement"' in problem for problem in problems)
+    assert any('invalid "NumberOfVolumesDiscardedByMotionScrubbing"' in problem for problem in problems)
+    assert any("different numbers of regions: 100, 99" in problem for problem in problems)
+    assert any("with 99 regions, but the atlas" in problem for problem in problems)
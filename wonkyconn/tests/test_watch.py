@@ -0,0 +1,136 @@
+import json
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+import pytest
+
+from wonkyconn.file_index.bids import BIDSIndex
+from wonkyconn.run import global_parser
+from wonkyconn.watch import DirectoryWatcher, get_changes, take_snapshot
+from wonkyconn.workflow import workflow
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.05)
+
+
+def test_snapshot(tmp_path: Path) -> None:
+    (tmp_path / "func").mkdir()
+    (tmp_path / "func" / "sub-1_relmat.tsv").write_text("a")
+    (tmp_path / "func" / "sub-1_timeseries.json").write_text("{}")
+    (tmp_path / "func" / "sub-1_desc-sparse_relmat.npz").write_bytes(b"a")
+    (tmp_path / "func" / ".sub-1_relmat.tsv.tmp").write_text("a")
+    (tmp_path / "func" / "sub-1_bold.nii.gz").write_text("a")
+
+    previous = take_snapshot(tmp_path)
+    assert set(previous) == {
+        tmp_path / "func" / "sub-1_relmat.tsv",
+        tmp_path / "func" / "sub-1_timeseries.json",
+        tmp_path / "func" / "sub-1_desc-sparse_relmat.npz",
+    }
+
+    (tmp_path / "func" / "sub-1_relmat.tsv").write_text("ab")
+    (tmp_path / "func" / "sub-1_timeseries.json").unlink()
+    (tmp_path / "func" / "sub-2_relmat.tsv").write_text("a")
+    changed_paths, removed_paths = get_changes(previous, take_snapshot(tmp_path))
+    assert changed_paths == {tmp_path / "func" / "sub-1_relmat.tsv", tmp_path / "func" / "sub-2_relmat.tsv"}
+    assert removed_paths == {tmp_path / "func" / "sub-1_timeseries.json"}
+
+
+def test_directory_watcher(tmp_path: Path) -> None:
+    directory_watcher = DirectoryWatcher(tmp_path, interval=0.01, debounce=0.1)
+
+    stop = threading.Event()
+    stop.set()
+    assert directory_watcher.wait(stop) is None
+
+    path = tmp_path / "sub-1_relmat.tsv"
+    path.write_text("a")
+    assert directory_watcher.wait() == ({path}, set())
+
+    path.unlink()
+    assert directory_watcher.wait() == (set(), {path})
+
+
+def test_index_update(tmp_path: Path) -> None:
+    first_path = tmp_path / "sub-1_desc-a_relmat.tsv"
+    second_path = tmp_path / "sub-2_desc-b_relmat.tsv"
+    first_path.write_text("a")
+
+    index = BIDSIndex()
+    index.put(tmp_path)
+    assert index.get(suffix="relmat") == {first_path}
+
+    second_path.write_text("a")
+    first_path.unlink()
+    index.update([second_path], [first_path])
+    assert index.get(suffix="relmat") == {second_path}
+    assert index.get_tag_values("desc") == {"b"}
+    assert first_path not in index.tags_by_paths
+
+
+def test_watch(small_bids_dir: Path, small_argv: list[str], tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import wonkyconn.workflow
+
+    bids_dir = tmp_path / "bids"
+    shutil.copytree(small_bids_dir, bids_dir)
+    argv = [str(bids_dir / "participants.tsv") if value == str(small_bids_dir / "participants.tsv") else value for value in small_argv]
+    argv[-3] = str(bids_dir)
+    output_dir = tmp_path / "output"
+    args = global_parser().parse_args(["--group-by", "ses", "--watch", "--watch-interval", "0.05", "--watch-debounce", "0.5", *argv])
+
+    make_record = wonkyconn.workflow.make_record
+    sessions: list[str] = []
+
+    def record_session(*args, **kwargs):
+        (session,) = {connectivity_matrix.path.parent.parent.name for connectivity_matrix in args[3]}
+        sessions.append(session)
+        return make_record(*args, **kwargs)
+
+    monkeypatch.setattr(wonkyconn.workflow, "make_record", record_session)
+
+    stop = threading.Event()
+    errors: list[BaseException] = []
+
+    def run() -> None:
+        try:
+            workflow(args, stop)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        _wait_for(lambda: (output_dir / "metrics.tsv").is_file() or bool(errors))
+        assert not errors
+        assert sorted(sessions) == ["ses-timepoint1", "ses-timepoint2"]
+        metrics_mtime = (output_dir / "metrics.tsv").stat().st_mtime_ns
+
+        # Changing a sidecar only evaluates the affected group again
+        sidecar_path = sorted(bids_dir.glob("*/ses-timepoint2/func/*_timeseries.json"))[0]
+        content = json.loads(sidecar_path.read_text())
+        content["MeanFramewiseDisplacement"] += 1
+        sidecar_path.write_text(json.dumps(content))
+        _wait_for(lambda: (output_dir / "metrics.tsv").stat().st_mtime_ns != metrics_mtime or bool(errors))
+        assert not errors
+        assert sessions[2:] == ["ses-timepoint2"]
+
+        # Removing all files of a group removes it from the results
+        for path in bids_dir.glob("sub-*/ses-timepoint1"):
+            shutil.rmtree(path)
+        _wait_for(lambda: len(pd.read_csv(output_dir / "metrics.tsv", sep="\t")) == 1 or bool(errors))
+        assert not errors
+        assert sessions[2:] == ["ses-timepoint2"]
+        assert [path.name for path in (output_dir / "records").glob("*.json")] == ["ses-timepoint2.json"]
+    finally:
+        stop.set()
+        thread.join()
+    assert not errors
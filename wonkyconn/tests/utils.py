@@ -0,0 +1,60 @@
+"""
+Helpers that create test data for several test modules.
+"""
+
+import json
+import re
+from pathlib import Path
+from shutil import copyfile
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from wonkyconn.base import ConnectivityMatrix
+
+
+def copy_file(path: Path, new_path: Path, sub: str) -> None:
+    new_path = Path(re.sub(r"sub-\d+", f"sub-{sub}", str(new_path)))
+    new_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if "relmat" in path.name and path.suffix == ".tsv":
+        relmat = pd.read_csv(path, sep="\t")
+        (n,) = set(relmat.shape)
+
+        array = scipy.spatial.distance.squareform(relmat.to_numpy() - np.eye(n))
+        np.random.shuffle(array)
+
+        new_array = scipy.spatial.distance.squareform(array) + np.eye(n)
+
+        new_relmat = pd.DataFrame(new_array, columns=relmat.columns)
+        new_relmat.to_csv(new_path, sep="\t", index=False)
+    elif "timeseries" in path.name and path.suffix == ".json":
+        with open(path, "r") as f:
+            content = json.load(f)
+            content["MeanFramewiseDisplacement"] += np.random.uniform(0, 1)
+        with open(new_path, "w") as f:
+            json.dump(content, f)
+    else:
+        copyfile(path, new_path)
+
+
+def make_connectivity_matrices(path: Path, n: int, m: int) -> tuple[pd.DataFrame, list[ConnectivityMatrix]]:
+    subjects = [f"sub-{k}" for k in range(m)]
+    data_frame = pd.DataFrame(
+        dict(
+            age=np.random.uniform(18, 80, m),
+            gender=np.random.choice(["m", "f"], m),
+        ),
+        index=pd.Index(subjects, name="participant_id"),
+    )
+
+    connectivity_matrices: list[ConnectivityMatrix] = []
+    for subject in subjects:
+        array = scipy.spatial.distance.squareform(np.random.uniform(-1, 1, n * (n - 1) // 2)) + np.eye(n)
+        relmat_path = path / f"{subject}_relmat.tsv"
+        pd.DataFrame(array).to_csv(relmat_path, sep="\t", index=False)
+        metadata = dict(MeanFramewiseDisplacement=np.random.uniform(0, 1))
+        connectivity_matrices.append(ConnectivityMatrix(relmat_path, metadata))
+
+    return data_frame, connectivity_matrices
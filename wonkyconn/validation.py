@@ -0,0 +1,158 @@
+"""
+Check that the groups can be evaluated before any connectivity matrix is loaded.
+
+Problems such as subjects that are missing from the phenotypes, connectivity
+matrices that do not match their atlas, or incomplete sidecar metadata would
+otherwise only be found when a group is evaluated, which can be after hours of
+loading other groups. The checks here only use the file index, the sidecar
+metadata, the headers of the connectivity matrices and the atlas images, and
+all problems are reported at once.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Any, Iterable, Mapping, Sequence
+
+import pandas as pd
+
+from .atlas import Atlas
+from .base import ConnectivityMatrix
+from .file_index.bids import BIDSIndex
+
+# The metadata keys that `calculate_degrees_of_freedom_loss` reads, with their expected types.
+# Each key needs to be either present in all or in none of the sidecars of a group.
+degrees_of_freedom_keys: dict[str, type] = {
+    "ConfoundRegressors": list,
+    "NumberOfVolumesDiscardedByMotionScrubbing": int,
+    "NumberOfVolumesDiscardedByNonsteadyStatesDetector": int,
+}
+
+
+class ValidationError(ValueError):
+    """
+    Raised when the groups cannot be evaluated.
+
+    Attributes:
+        problems (list[str]): A description of each problem.
+    """
+
+    def __init__(self, problems: Sequence[str]) -> None:
+        self.problems = list(problems)
+        lines = [f"Found {len(self.problems)} problems with the inputs:", *(f"- {problem}" for problem in self.problems)]
+        super().__init__("\n".join(lines))
+
+
+def format_values(values: Iterable[Any], limit: int = 5) -> str:
+    """
+    Format values for a problem description, listing only the first few.
+
+    >>> format_values(["sub-1", "sub-2"])
+    'sub-1, sub-2'
+    >>> format_values(range(8), limit=3)
+    '0, 1, 2 and 5 more'
+    """
+    values = sorted(set(map(str, values)))
+    text = ", ".join(values[:limit])
+    if len(values) > limit:
+        text += f" and {len(values) - limit} more"
+    return text
+
+
+def get_subject(index: BIDSIndex, connectivity_matrix: ConnectivityMatrix) -> str:
+    """
+    Get the participant ID of a connectivity matrix, as used in the phenotypes file (see `get_subjects`).
+    """
+    # The "sub" tag value is "2" for "sub-2", but the phenotypes file may already use the prefix
+    subject = str(index.get_tag_value(connectivity_matrix.path, "sub"))
+    if not subject.startswith("sub-"):
+        subject = f"sub-{subject}"
+    return subject
+
+
+def validate_groups(
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: Mapping[str, Atlas],
+    grouped_connectivity_matrix: Mapping[tuple[str, ...], Sequence[ConnectivityMatrix]],
+    metric_keys: Sequence[str],
+    phenotype_groups: Mapping[tuple[str, ...], Sequence[ConnectivityMatrix]] | None = None,
+) -> list[str]:
+    """
+    Find the problems that would prevent the groups from being evaluated.
+
+    Parameters:
+        index (BIDSIndex): The index of the BIDS directory.
+        data_frame (pd.DataFrame): The phenotypes, indexed by participant ID.
+        seg_to_atlas (Mapping[str, Atlas]): The atlas for each "seg" value.
+        grouped_connectivity_matrix (Mapping): The connectivity matrices by group, as returned by `make_groups`.
+        metric_keys (Sequence[str]): The motion metrics that need to be in the metadata of each connectivity matrix.
+        phenotype_groups (Mapping | None, optional): The connectivity matrices of each group whose subjects need to be
+            in the phenotypes file. Defaults to None, which checks the subjects of all connectivity matrices.
+
+    Returns:
+        list[str]: A description of each problem, or an empty list if the groups can be evaluated.
+    """
+    problems: list[str] = []
+
+    atlas_region_counts: dict[str, int] = dict()
+    for seg, atlas in seg_to_atlas.items():
+        try:
+            atlas_region_counts[seg] = atlas.get_region_count()
+        except Exception as e:
+            problems.append(f'Cannot read the atlas for "{seg}": {e}')
+
+    phenotype_subjects = set(data_frame.index)
+    incomplete_subjects = set(data_frame.index[data_frame[["age", "gender"]].isna().any(axis=1)])
+
+    for group, connectivity_matrices in grouped_connectivity_matrix.items():
+        label = f"Group {'/'.join(group)}"
+
+        segs = {index.get_tag_value(c.path, "seg") for c in connectivity_matrices}
+        if len(segs) != 1:
+            problems.append(f"{label} mixes connectivity matrices of several atlases: {format_values(segs)}")
+        missing_segs = {seg for seg in segs if seg not in seg_to_atlas}
+        if missing_segs:
+            problems.append(f"{label} has connectivity matrices for atlases that are not in `--seg-to-atlas`: {format_values(missing_segs)}")
+
+        phenotype_connectivity_matrices = connectivity_matrices if phenotype_groups is None else phenotype_groups.get(group, [])
+        subjects = [get_subject(index, c) for c in phenotype_connectivity_matrices]
+        missing_subjects = set(subjects) - phenotype_subjects
+        if missing_subjects:
+            problems.append(f"{label} has subjects that are not in the phenotypes file: {format_values(missing_subjects)}")
+        if set(subjects) & incomplete_subjects:
+            problems.append(f'{label} has subjects without "age" or "gender": {format_values(set(subjects) & incomplete_subjects)}')
+
+        region_counts: defaultdict[int, list[ConnectivityMatrix]] = defaultdict(list)
+        unreadable: list[str] = []
+        for connectivity_matrix in connectivity_matrices:
+            try:
+                region_counts[connectivity_matrix.region_count].append(connectivity_matrix)
+            except Exception as e:
+                unreadable.append(f"{connectivity_matrix.path} ({e})")
+        if unreadable:
+            problems.append(f"{label} has connectivity matrices that cannot be read: {format_values(unreadable)}")
+        if len(region_counts) > 1:
+            problems.append(f"{label} has connectivity matrices with different numbers of regions: {format_values(region_counts.keys())}")
+        for region_count, matching in region_counts.items():
+            for matrix_seg in {index.get_tag_value(c.path, "seg") for c in matching}:
+                atlas_region_count = atlas_region_counts.get(str(matrix_seg))
+                if atlas_region_count is not None and region_count != atlas_region_count:
+                    problems.append(
+                        f'{label} has connectivity matrices with {region_count} regions, but the atlas for "{matrix_seg}" has '
+                        f"{atlas_region_count} regions: {format_values(c.path for c in matching)}"
+                    )
+
+        for metric_key in metric_keys:
+            missing = [c.path for c in connectivity_matrices if metric_key not in c.metadata]
+            if missing:
+                problems.append(f'{label} has connectivity matrices without "{metric_key}" in their metadata: {format_values(missing)}')
+        for key, expected_type in degrees_of_freedom_keys.items():
+            values = [c.metadata.get(key) for c in connectivity_matrices]
+            if all(value is None for value in values):
+                continue
+            invalid = [c.path for c, value in zip(connectivity_matrices, values) if not isinstance(value, expected_type)]
+            if invalid:
+                problems.append(f'{label} has connectivity matrices with a missing or invalid "{key}" in their metadata: {format_values(invalid)}')
+
+    return problems
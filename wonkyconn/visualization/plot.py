@@ -8,7 +8,6 @@ import pandas as pd
 import seaborn as sns
 from matplotlib import pyplot as plt
 
-
 sns.set_palette("colorblind")
 palette = sns.color_palette(n_colors=6)
 
@@ -16,16 +15,18 @@ matplotlib.rcParams["font.family"] = "DejaVu Sans"
 
 
 # seann: added type for series
-def _make_group_label(group_by: list[str], values: "pd.Series[str]") -> str:
+def _make_group_label(group_by: list[str], values: "pd.Series[str] | tuple[str, ...] | str") -> str:
+    # The index is not a multi-index when grouping by a single tag
+    group_values = values if isinstance(values, tuple) else (values,)
     label: str = ""
-    for a, b in zip(group_by, values, strict=True):
+    for a, b in zip(group_by, group_values, strict=True):
         if label:
             label += "\n"
         label += f"{a}-{b}"
     return label
 
 
-def plot(result_frame: pd.DataFrame, group_by: list[str], output_dir: Path) -> None:
+def plot(result_frame: pd.DataFrame, group_by: list[str], output_dir: Path, name: str = "metrics") -> None:
     """
     Plot all three metrics based on the given result data frame.
 
@@ -35,7 +36,8 @@ def plot(result_frame: pd.DataFrame, group_by: list[str], output_dir: Path) -> N
             "motion_scrubbing_percentage", and "nonsteady_states_detector_percentage", and the
             columns in the `group_by` variable.
         group_by (list[str]): The list of columns that the results are grouped by.
-        output_dir (Path): The directory to save the plot image into as "metrics.png".
+        output_dir (Path): The directory to save the plot image into.
+        name (str, optional): The name of the plot image without extension. Defaults to "metrics".
 
     Returns:
         None
@@ -84,7 +86,8 @@ def plot(result_frame: pd.DataFrame, group_by: list[str], output_dir: Path) -> N
 
     plot_degrees_of_freedom_loss(data_frame, group_labels, degrees_of_freedom_loss_axes, legend_axes)
 
-    figure.savefig(output_dir / "metrics.png")
+    figure.savefig(output_dir / f"{name}.png")
+    plt.close(figure)
 
 
 def plot_degrees_of_freedom_loss(
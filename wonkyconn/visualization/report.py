@@ -0,0 +1,252 @@
+"""
+Create a self-contained HTML report with the metrics and the edge-level QC-FC of each group.
+
+Plotting hundreds of thousands of edges per group as individual points is slow and
+produces large files. Instead, the QC-FC values of each group are binned with NumPy
+right after the group is evaluated (see `EdgeHistograms`), and the report only draws
+the bins. The histogram of QC-FC values is drawn as an SVG path, and the histogram of
+distance against QC-FC is embedded as a small PNG image with one pixel per bin, so
+the report stays small and opens instantly. The figures of different groups are
+rendered in parallel.
+"""
+
+from __future__ import annotations
+
+import base64
+import html
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Mapping
+
+import matplotlib
+import numpy as np
+import pandas as pd
+from numpy import typing as npt
+
+from ..features.quality_control_connectivity import QCFCResult
+
+correlation_range = (-1.0, 1.0)
+
+
+@dataclass
+class EdgeHistograms:
+    """
+    The binned edge-level QC-FC values of a group.
+
+    Attributes:
+        correlation_edges (ndarray): The edges of the QC-FC bins.
+        correlation_counts (ndarray): The number of edges in each QC-FC bin.
+        distance_edges (ndarray): The edges of the distance bins, or an empty array if the distances are not known.
+        distance_counts (ndarray): The number of edges in each distance bin (rows) and QC-FC bin (columns).
+    """
+
+    correlation_edges: npt.NDArray[np.float64]
+    correlation_counts: npt.NDArray[np.int64]
+    distance_edges: npt.NDArray[np.float64]
+    distance_counts: npt.NDArray[np.int64]
+
+    @classmethod
+    def calculate(
+        cls,
+        qcfc: QCFCResult,
+        distance_vector: npt.NDArray[np.float64] | None = None,
+        correlation_bin_count: int = 80,
+        distance_bin_count: int = 40,
+    ) -> "EdgeHistograms":
+        """
+        Bin the QC-FC values of a group.
+
+        Parameters:
+            qcfc (QCFCResult): The QC-FC values.
+            distance_vector (ndarray | None, optional): The distances between the regions of all edges
+                (see `Atlas.get_distance_vector`). Defaults to None, which skips the distance histogram.
+            correlation_bin_count (int, optional): The number of QC-FC bins. Defaults to 80.
+            distance_bin_count (int, optional): The number of distance bins. Defaults to 40.
+
+        Returns:
+            EdgeHistograms: The histograms.
+        """
+        correlation_edges = np.linspace(*correlation_range, correlation_bin_count + 1)
+        valid = np.isfinite(qcfc.correlation)
+        correlation = qcfc.correlation[valid]
+        correlation_bins = get_bins(correlation, correlation_edges)
+        correlation_counts = np.bincount(correlation_bins, minlength=correlation_bin_count)
+
+        distance_edges = np.empty(0)
+        distance_counts = np.empty((0, correlation_bin_count), dtype=np.int64)
+        if distance_vector is not None:
+            if qcfc.edge_indices is not None:
+                distance_vector = distance_vector[qcfc.edge_indices]
+            # The distance to a region without voxels is not known, so those edges are left out
+            finite = np.isfinite(distance_vector)
+            max_distance = float(np.max(distance_vector, where=finite, initial=0.0))
+            distance_edges = np.linspace(0, max_distance or 1.0, distance_bin_count + 1)
+            has_distance = finite[valid]
+            distance_bins = get_bins(distance_vector[valid][has_distance], distance_edges)
+            distance_counts = np.bincount(
+                distance_bins * correlation_bin_count + correlation_bins[has_distance],
+                minlength=distance_bin_count * correlation_bin_count,
+            ).reshape(distance_bin_count, correlation_bin_count)
+
+        return cls(correlation_edges, correlation_counts, distance_edges, distance_counts)
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(
+            path,
+            correlation_edges=self.correlation_edges,
+            correlation_counts=self.correlation_counts,
+            distance_edges=self.distance_edges,
+            distance_counts=self.distance_counts,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "EdgeHistograms":
+        with np.load(path) as arrays:
+            return cls(
+                correlation_edges=arrays["correlation_edges"],
+                correlation_counts=arrays["correlation_counts"],
+                distance_edges=arrays["distance_edges"],
+                distance_counts=arrays["distance_counts"],
+            )
+
+
+def get_bins(x: npt.NDArray[np.float64], edges: npt.NDArray[np.float64]) -> npt.NDArray[np.int64]:
+    """
+    Get the bin of each value for equally spaced bins. Values outside of the bins are put into the first or last bin.
+    The values need to be finite.
+
+    >>> get_bins(np.asarray([-1.0, 0.0, 0.5, 1.0]), np.linspace(-1, 1, 5))
+    array([0, 2, 3, 3])
+    """
+    bin_count = edges.size - 1
+    bins = np.floor((x - edges[0]) / (edges[-1] - edges[0]) * bin_count).astype(np.int64)
+    return np.clip(bins, 0, bin_count - 1)
+
+
+def encode_png(rgba: npt.NDArray[np.uint8]) -> bytes:
+    """
+    Encode an image with the shape (height, width, 4) as a PNG file.
+    """
+    height, width, _ = rgba.shape
+    # Each row starts with the filter type zero
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1).tobytes()
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 9)) + chunk(b"IEND", b"")
+
+
+def render_correlation_histogram(histograms: EdgeHistograms, width: int = 320, height: int = 180) -> str:
+    """
+    Draw the histogram of QC-FC values as an SVG image.
+    """
+    margin = 24
+    counts = histograms.correlation_counts
+    scale = (height - 2 * margin) / max(int(counts.max(initial=0)), 1)
+    x = margin + (histograms.correlation_edges - correlation_range[0]) / np.ptp(correlation_range) * (width - 2 * margin)
+    y = height - margin - counts * scale
+    # A step line along the top of the bars
+    steps = " ".join(f"H{a:.1f}V{b:.1f}" for a, b in zip(x[:-1], y)) + f"H{x[-1]:.1f}V{height - margin}"
+    path = f"M{x[0]:.1f} {height - margin}{steps}Z"
+    zero = margin + (0 - correlation_range[0]) / np.ptp(correlation_range) * (width - 2 * margin)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+        f"<title>QC-FC histogram of {int(counts.sum())} edges</title>"
+        f'<path d="{path}" fill="#0173b2" fill-opacity="0.6" stroke="#0173b2"/>'
+        f'<line x1="{zero:.1f}" x2="{zero:.1f}" y1="{margin}" y2="{height - margin}" stroke="#555" stroke-dasharray="3"/>'
+        f'<text x="{margin}" y="{height - 6}" font-size="11">{correlation_range[0]:g}</text>'
+        f'<text x="{width - margin}" y="{height - 6}" font-size="11" text-anchor="end">{correlation_range[1]:g}</text>'
+        f'<text x="{width / 2}" y="{height - 6}" font-size="11" text-anchor="middle">QC-FC</text>'
+        f'<text x="{margin}" y="{margin - 8}" font-size="11">Edges</text>'
+        "</svg>"
+    )
+
+
+def render_distance_histogram(histograms: EdgeHistograms, width: int = 320, height: int = 180) -> str:
+    """
+    Draw the histogram of distance against QC-FC values as an SVG image with an embedded PNG image.
+    """
+    if histograms.distance_edges.size == 0:
+        return ""
+    margin = 24
+    # Distance on the horizontal axis, and QC-FC increasing upwards
+    counts = histograms.distance_counts.T[::-1]
+    values = np.log1p(counts) / max(float(np.log1p(counts.max(initial=0))), 1.0)
+    rgba = np.asarray(matplotlib.colormaps["viridis"](values, bytes=True), dtype=np.uint8)
+    rgba[counts == 0] = (255, 255, 255, 0)
+    image = base64.b64encode(encode_png(rgba)).decode("ascii")
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+        "<title>Distance against QC-FC</title>"
+        f'<image x="{margin}" y="{margin}" width="{width - 2 * margin}" height="{height - 2 * margin}" '
+        f'preserveAspectRatio="none" style="image-rendering:pixelated" href="data:image/png;base64,{image}"/>'
+        f'<rect x="{margin}" y="{margin}" width="{width - 2 * margin}" height="{height - 2 * margin}" fill="none" stroke="#555"/>'
+        f'<text x="{margin}" y="{height - 6}" font-size="11">0</text>'
+        f'<text x="{width - margin}" y="{height - 6}" font-size="11" text-anchor="end">{histograms.distance_edges[-1]:.0f} mm</text>'
+        f'<text x="{width / 2}" y="{height - 6}" font-size="11" text-anchor="middle">Distance</text>'
+        f'<text x="{margin}" y="{margin - 8}" font-size="11">QC-FC from {correlation_range[0]:g} to {correlation_range[1]:g}</text>'
+        "</svg>"
+    )
+
+
+def render_group(label: str, histograms: EdgeHistograms) -> str:
+    return (
+        f'<section data-label="{html.escape(label)}"><h2>{html.escape(label)}</h2>'
+        f'<div class="figures">{render_correlation_histogram(histograms)}{render_distance_histogram(histograms)}</div></section>'
+    )
+
+
+style = """
+body { font-family: "DejaVu Sans", sans-serif; margin: 2em; }
+table { border-collapse: collapse; font-size: 12px; }
+th, td { border: 1px solid #ccc; padding: 2px 6px; text-align: right; }
+section { display: inline-block; vertical-align: top; margin: 0 1em 1em 0; }
+h2 { font-size: 13px; font-weight: normal; margin: 0; }
+.figures svg { margin-right: 4px; }
+"""
+
+script = """
+document.getElementById("filter").addEventListener("input", function (event) {
+    for (const section of document.querySelectorAll("section")) {
+        section.style.display = section.dataset.label.includes(event.target.value) ? "" : "none";
+    }
+});
+"""
+
+
+def save_report(
+    path: Path,
+    result_frame: pd.DataFrame,
+    histograms_by_label: Mapping[str, EdgeHistograms],
+    max_workers: int | None = None,
+) -> None:
+    """
+    Save the metrics and the edge-level figures of each group as a self-contained HTML file.
+
+    Parameters:
+        path (Path): The path of the HTML file.
+        result_frame (pd.DataFrame): The metrics of each group, as in `metrics.tsv`.
+        histograms_by_label (Mapping[str, EdgeHistograms]): The histograms of each group by its label.
+        max_workers (int | None, optional): The number of threads that render figures. Defaults to None,
+            which uses the default of `ThreadPoolExecutor`.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sections = list(executor.map(render_group, histograms_by_label.keys(), histograms_by_label.values()))
+
+    table = result_frame.to_html(float_format=lambda value: f"{value:.3f}", na_rep="")
+    document = (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>wonkyconn report</title>'
+        f"<style>{style}</style></head><body>"
+        "<h1>wonkyconn report</h1>"
+        f"{table}"
+        '<p><label>Filter groups <input id="filter" type="search"></label></p>'
+        f"{''.join(sections)}"
+        f"<script>{script}</script></body></html>"
+    )
+    path.write_text(document, encoding="utf-8")
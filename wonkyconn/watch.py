@@ -0,0 +1,122 @@
+"""
+Watch a BIDS directory for connectivity matrices and sidecar files that are
+added, changed or removed while upstream processing is still running.
+
+The directory is polled by comparing the size and modification time of each
+file, so that no additional dependencies or file system notifications are
+needed, and network file systems are supported. Changes are reported once the
+directory has been quiet for a while, so that a batch of files that lands
+together is only processed once.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from pathlib import Path
+
+from .base import hdf5_extensions, sparse_extensions
+from .file_index.bids import split_ext
+
+# The files that can change the groups or their metrics
+watched_extensions: tuple[str, ...] = (".tsv", ".json", *hdf5_extensions, *sparse_extensions)
+
+Snapshot = dict[Path, tuple[int, int]]
+
+
+def take_snapshot(root: Path) -> Snapshot:
+    """
+    Get the size and modification time of each watched file below a directory.
+
+    Hidden files and directories are skipped, as they are often temporary files
+    that are renamed when they are complete.
+    """
+    snapshot: Snapshot = dict()
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue  # Removed while we were scanning
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_dir():
+                    directories.append(directory / entry.name)
+                elif split_ext(entry.name)[1] in watched_extensions:
+                    stat = entry.stat()
+                    snapshot[directory / entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                continue
+    return snapshot
+
+
+def get_changes(previous: Snapshot, current: Snapshot) -> tuple[set[Path], set[Path]]:
+    """
+    Returns:
+        tuple[set[Path], set[Path]]: The files that were added or changed, and the files that were removed.
+    """
+    changed_paths = {path for path, stat in current.items() if previous.get(path) != stat}
+    removed_paths = previous.keys() - current.keys()
+    return changed_paths, removed_paths
+
+
+class DirectoryWatcher:
+    """
+    Poll a directory and report the files that changed since the last report.
+
+    Attributes:
+        root (Path): The directory to watch.
+        interval (float): The number of seconds between polls.
+        debounce (float): The number of seconds without further changes before the changes are reported.
+        max_delay (float): The maximum number of seconds that changes are held back while files keep changing.
+        snapshot (Snapshot): The state of the directory at the last report.
+    """
+
+    def __init__(self, root: Path, interval: float, debounce: float, max_delay: float | None = None) -> None:
+        self.root = root
+        self.interval = interval
+        self.debounce = debounce
+        if max_delay is None:
+            max_delay = 10 * max(debounce, interval)
+        self.max_delay = max_delay
+        self.snapshot = take_snapshot(root)
+
+    def wait(self, stop: threading.Event | None = None) -> tuple[set[Path], set[Path]] | None:
+        """
+        Block until there are changes and the directory has been quiet for `debounce` seconds,
+        or until changes have been pending for `max_delay` seconds.
+
+        Parameters:
+            stop (threading.Event | None, optional): Return early when this event is set. Defaults to None.
+
+        Returns:
+            tuple[set[Path], set[Path]] | None: The files that were added or changed and the files that were
+                removed since the last report, or None if `stop` was set.
+        """
+        if stop is None:
+            stop = threading.Event()
+
+        current = self.snapshot
+        first_change: float | None = None
+        last_change: float | None = None
+        while not stop.wait(self.interval):
+            snapshot = take_snapshot(self.root)
+            now = time.monotonic()
+            if snapshot != current:
+                current = snapshot
+                last_change = now
+                if first_change is None:
+                    first_change = now
+            if first_change is None or last_change is None:
+                continue
+            if now - last_change >= self.debounce or now - first_change >= self.max_delay:
+                changes = get_changes(self.snapshot, current)
+                self.snapshot = current
+                if changes[0] or changes[1]:
+                    return changes
+                first_change = last_change = None  # Files were changed back
+        return None
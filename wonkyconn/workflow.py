@@ -3,35 +3,78 @@ Process fMRIPrep outputs to timeseries based on denoising strategy.
 """
 
 import argparse
-from collections import defaultdict
+import json
+import threading
+from collections import Counter, defaultdict
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Any
+from tempfile import TemporaryDirectory
+from typing import Any, Iterator, Sequence
 
+import numpy as np
 import pandas as pd
+from numpy import typing as npt
 from tqdm.auto import tqdm
 
-from .atlas import Atlas
-from .base import ConnectivityMatrix
+from .accumulator import QCFCAccumulator
+from .api import evaluate, summarize_qcfc
+from .atlas import Atlas, region_distances
+from .base import (
+    ConnectivityMatrix,
+    EdgeStore,
+    get_group_region_count,
+    hdf5_extensions,
+    is_sparse_group,
+    load_connectivity_array,
+    load_sparse_connectivity_array,
+    map_connectivity_array,
+    sparse_extensions,
+    split_hdf5_path,
+)
+from .deduplicate import find_duplicate_groups, find_duplicate_matrices, get_fingerprints, make_duplicates_frame
+from .export import make_file_label, save_qcfc_edges
 from .features.calculate_degrees_of_freedom import (
     calculate_degrees_of_freedom_loss,
 )
-from .features.distance_dependence import calculate_distance_dependence
-from .features.quality_control_connectivity import (
-    calculate_median_absolute,
-    calculate_qcfc,
-    calculate_qcfc_percentage,
-)
+from .features.network_blocks import NetworkBlocks, get_label_path, load_region_networks
+from .features.quality_control_connectivity import QCFCResult
+from .features.strategy_comparison import compare_strategies
 from .file_index.bids import BIDSIndex
 from .logger import gc_log, set_verbosity
+from .prefetch import Prefetcher
+from .progress import progress, report_progress
+from .records import load_records, make_result_frame, save_records
+from .quick import calculate_bounds, load_edge_sample, sample_edges, sample_subjects
+from .scheduler import Scheduler, plan_groups
+from .validation import ValidationError, get_subject, validate_groups
 from .visualization.plot import plot
+from .visualization.report import EdgeHistograms, save_report
+from .watch import DirectoryWatcher, Snapshot
 
 
-def workflow(args: argparse.Namespace) -> None:
+def workflow(args: argparse.Namespace, stop: threading.Event | None = None) -> None:
+    """
+    Evaluate all groups and save the results. With `--watch`, keep updating the results
+    for files that land in the BIDS directory until `stop` is set or the process is interrupted.
+    The progress is reported with `--status-file` and `--metrics-port` (see `wonkyconn.progress`).
+    """
     set_verbosity(args.verbosity)
     gc_log.info(vars(args))
 
+    with report_progress(args.status_file, args.metrics_port):
+        run_workflow(args, stop)
+
+
+def run_workflow(args: argparse.Namespace, stop: threading.Event | None = None) -> None:
+    # The combinations of options are checked when they are parsed (see `wonkyconn.run.get_argument_problems`)
+
     # Check BIDS path
     bids_dir = args.bids_dir
+    directory_watcher: DirectoryWatcher | None = None
+    if args.watch:
+        # Take the first snapshot before indexing, so that files that land in the meantime are picked up
+        directory_watcher = DirectoryWatcher(bids_dir, args.watch_interval, args.watch_debounce)
+    progress.set_stage("indexing")
     index = BIDSIndex()
     index.put(bids_dir)
 
@@ -40,23 +83,748 @@ def workflow(args: argparse.Namespace) -> None:
     output_dir.mkdir(parents=True, exist_ok=True)
 
     # Load data frame
-    data_frame = load_data_frame(args)
+    progress.set_stage("preparing")
+    data_frame = load_data_frame(args.phenotypes)
 
     # Load atlases
-    seg_to_atlas: dict[str, Atlas] = {seg: Atlas.create(seg, Path(atlas_path_str)) for seg, atlas_path_str in args.seg_to_atlas}
+    region_distance = region_distances[args.region_distance]()
+    seg_to_atlas: dict[str, Atlas] = {seg: Atlas.create(seg, Path(atlas_path_str), region_distance) for seg, atlas_path_str in args.seg_to_atlas}
+
+    seg_to_network_blocks: dict[str, NetworkBlocks] = dict()
+    if args.network_blocks:
+        seg_to_network_blocks = load_network_blocks(args)
 
     # Seann: Get the specified atlas passed to CLI
     specified_atlas = list(seg_to_atlas.keys())[0]
     gc_log.info(f"Will only process matrices for atlas: {specified_atlas}")
 
+    groupings = get_groupings(args)
+    if len(groupings) > 1:
+        evaluate_groupings(args, index, data_frame, seg_to_atlas, seg_to_network_blocks, groupings)
+        return
+
     # Seann: changed from using namedtuple to a dict to avoid type error
-    group_by = args.group_by
+    (group_by,) = groupings
+
+    progress.set_stage("validating")
+    grouped_connectivity_matrix = make_groups(index, group_by, specified_atlas)
+    phenotype_groups: dict[tuple[str, ...], list[ConnectivityMatrix]] | None = None
+    if args.accumulator_dir is not None and not args.compare:
+        phenotype_groups = get_new_connectivity_matrices(args.accumulator_dir, grouped_connectivity_matrix, group_by)
+    problems = validate_groups(index, data_frame, seg_to_atlas, grouped_connectivity_matrix, args.motion_metrics, phenotype_groups)
+    if problems:
+        raise ValidationError(problems)
+    all_groups = grouped_connectivity_matrix
+
+    if args.shard is not None:
+        shard_index, shard_count = args.shard
+        grouped_connectivity_matrix = select_shard(grouped_connectivity_matrix, shard_index, shard_count)
+        gc_log.info(f"Shard {shard_index} of {shard_count} has {len(grouped_connectivity_matrix)} groups")
+
+    records: list[dict[str, Any]] = []
+    if args.resume:
+        grouped_connectivity_matrix = resume_groups(output_dir, group_by, grouped_connectivity_matrix, records)
+
+    edge_store: EdgeStore | None = None
+    duplicate_groups: dict[tuple[str, ...], tuple[str, ...]] = dict()
+    if args.deduplicate:
+        progress.set_stage("deduplicating")
+        # `duplicates.tsv` covers all groups, including those that were completed by a previous run.
+        # Each shard only looks at its own groups, so the shards do not save it
+        if args.shard is None:
+            fingerprints, (duplicate_groups,) = find_duplicates(output_dir, index, [group_by], [all_groups])
+        else:
+            fingerprints, (duplicate_groups,) = find_duplicates(None, index, [group_by], [grouped_connectivity_matrix])
+        # Connectivity matrices that are shared between the groups that are evaluated are loaded once
+        evaluated_groups = {
+            group: connectivity_matrices
+            for group, connectivity_matrices in grouped_connectivity_matrix.items()
+            if not (group in duplicate_groups and duplicate_groups[group] in grouped_connectivity_matrix)
+        }
+        connectivity_matrices = get_shared_connectivity_matrices(evaluated_groups, fingerprints)
+        if connectivity_matrices and not args.quick:
+            progress.set_stage("loading")
+            edge_store = load_edge_store(connectivity_matrices, args.memory_limit, fingerprints)
+
+    progress.set_stage("evaluating")
+    progress.add_groups(len(grouped_connectivity_matrix))
+    records.extend(
+        evaluate_groups(
+            args, index, data_frame, seg_to_atlas, seg_to_network_blocks, grouped_connectivity_matrix, group_by, edge_store, duplicate_groups
+        )
+    )
+
+    if args.shard is not None:
+        # Partial records are combined by `wonkyconn --merge`
+        shard_index, shard_count = args.shard
+        save_records(get_shard_path(output_dir, shard_index, shard_count), group_by, records)
+        return
+
+    progress.set_stage("saving")
+    save_results(output_dir, group_by, records, report=args.report)
+
+    if args.compare:
+        progress.set_stage("comparing")
+        save_comparison(output_dir, index, data_frame, all_groups, group_by, args.motion_metrics[0], args.compare_permutations, args.memory_limit)
+
+    if directory_watcher is not None:
+        watch_groups(args, directory_watcher, index, data_frame, seg_to_atlas, seg_to_network_blocks, all_groups, group_by, records, stop)
+
+
+def get_groupings(args: argparse.Namespace) -> list[list[str]]:
+    """
+    Get the groupings given by `--group-by`, without duplicates. Defaults to grouping by "seg".
+    """
+    groupings: list[list[str]] = list()
+    for group_by in args.group_by or [["seg"]]:
+        if list(group_by) not in groupings:
+            groupings.append(list(group_by))
+    return groupings
+
+
+def evaluate_groupings(
+    args: argparse.Namespace,
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    seg_to_network_blocks: dict[str, NetworkBlocks],
+    groupings: list[list[str]],
+) -> None:
+    """
+    Evaluate several groupings of the same connectivity matrices, and save the results of each grouping
+    as `metrics_{tags}.tsv` and `metrics_{tags}.png`.
+
+    The connectivity matrices that are needed by any of the groupings are loaded once into an `EdgeStore`,
+    and the groups of each grouping use different subsets of its columns. If the store would exceed
+    `--memory-limit`, each grouping loads its own connectivity matrices instead.
+    """
+    output_dir = args.output_dir
+    specified_atlas = list(seg_to_atlas.keys())[0]
+
+    progress.set_stage("validating")
+    all_groups_by_grouping: list[dict[tuple[str, ...], list[ConnectivityMatrix]]] = list()
+    groups_by_grouping: list[dict[tuple[str, ...], list[ConnectivityMatrix]]] = list()
+    records_by_grouping: list[list[dict[str, Any]]] = list()
+    problems: list[str] = list()
+    for group_by in groupings:
+        grouped_connectivity_matrix = make_groups(index, group_by, specified_atlas)
+        problems.extend(validate_groups(index, data_frame, seg_to_atlas, grouped_connectivity_matrix, args.motion_metrics))
+        all_groups_by_grouping.append(grouped_connectivity_matrix)
+        records: list[dict[str, Any]] = []
+        if args.resume:
+            grouped_connectivity_matrix = resume_groups(output_dir, group_by, grouped_connectivity_matrix, records)
+        groups_by_grouping.append(grouped_connectivity_matrix)
+        records_by_grouping.append(records)
+
+    if problems:
+        raise ValidationError(problems)
+    progress.add_groups(sum(len(grouped_connectivity_matrix) for grouped_connectivity_matrix in groups_by_grouping))
+
+    fingerprints: dict[Path, str] | None = None
+    duplicate_groups_by_grouping: list[dict[tuple[str, ...], tuple[str, ...]]] = [dict() for _ in groupings]
+    if args.deduplicate:
+        progress.set_stage("deduplicating")
+        # `duplicates.tsv` covers all groups, including those that were completed by a previous run
+        fingerprints, duplicate_groups_by_grouping = find_duplicates(output_dir, index, groupings, all_groups_by_grouping)
+
+    connectivity_matrices = get_dense_connectivity_matrices(groups_by_grouping)
+    edge_store: EdgeStore | None = None
+    if connectivity_matrices and not args.quick:
+        progress.set_stage("loading")
+        edge_store = load_edge_store(connectivity_matrices, args.memory_limit, fingerprints)
+
+    for group_by, grouped_connectivity_matrix, records, duplicate_groups in zip(
+        groupings, groups_by_grouping, records_by_grouping, duplicate_groups_by_grouping
+    ):
+        gc_log.info(f"Evaluating {len(grouped_connectivity_matrix)} groups by {group_by}")
+        progress.set_stage("evaluating")
+        records.extend(
+            evaluate_groups(
+                args,
+                index,
+                data_frame,
+                seg_to_atlas,
+                seg_to_network_blocks,
+                grouped_connectivity_matrix,
+                group_by,
+                edge_store,
+                duplicate_groups,
+            )
+        )
+        progress.set_stage("saving")
+        save_results(output_dir, group_by, records, name=f"metrics_{'_'.join(group_by)}", report=args.report)
+
+
+def get_dense_connectivity_matrices(
+    groups_by_grouping: Sequence[dict[tuple[str, ...], list[ConnectivityMatrix]]],
+) -> list[ConnectivityMatrix]:
+    """
+    Get the connectivity matrices of the groups that are not sparse, which can be shared in an `EdgeStore`.
+    """
+    return [
+        connectivity_matrix
+        for grouped_connectivity_matrix in groups_by_grouping
+        for group_connectivity_matrices in grouped_connectivity_matrix.values()
+        if not is_sparse_group(group_connectivity_matrices)
+        for connectivity_matrix in group_connectivity_matrices
+    ]
+
+
+def get_shared_connectivity_matrices(
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    fingerprints: dict[Path, str],
+) -> list[ConnectivityMatrix]:
+    """
+    Get the dense connectivity matrices whose content appears in more than one group. Only these are worth
+    keeping in an `EdgeStore`, and the other connectivity matrices are loaded by their group.
+    """
+    group_counts: Counter[str] = Counter()
+    for connectivity_matrices in grouped_connectivity_matrix.values():
+        group_counts.update({fingerprints[connectivity_matrix.path] for connectivity_matrix in connectivity_matrices})
+    return [
+        connectivity_matrix
+        for connectivity_matrix in get_dense_connectivity_matrices([grouped_connectivity_matrix])
+        if group_counts[fingerprints[connectivity_matrix.path]] > 1
+    ]
+
+
+def load_edge_store(
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    memory_limit: int | None,
+    fingerprints: dict[Path, str] | None = None,
+) -> EdgeStore | None:
+    """
+    Load connectivity matrices that are shared by several groups into an `EdgeStore`, if they fit into the memory limit.
+
+    Parameters:
+        fingerprints (dict[Path, str] | None, optional): The fingerprint of each connectivity matrix, so that
+            connectivity matrices with the same content are only loaded once. Defaults to None.
+
+    Returns:
+        EdgeStore | None: The loaded connectivity matrices, or None if they do not fit.
+    """
+    paths = {connectivity_matrix.path for connectivity_matrix in connectivity_matrices}
+    if memory_limit is not None and EdgeStore.get_size(connectivity_matrices, fingerprints) > memory_limit:
+        gc_log.info(f"The {len(paths)} connectivity matrices do not fit into the memory limit, so each group loads them separately")
+        return None
+    gc_log.info(f"Loading {len(paths)} connectivity matrices once for all groups")
+    return EdgeStore.load(connectivity_matrices, fingerprints)
+
+
+def find_duplicates(
+    output_dir: Path | None,
+    index: BIDSIndex,
+    groupings: Sequence[list[str]],
+    groups_by_grouping: Sequence[dict[tuple[str, ...], list[ConnectivityMatrix]]],
+) -> tuple[dict[Path, str], list[dict[tuple[str, ...], tuple[str, ...]]]]:
+    """
+    Fingerprint the connectivity matrices of all groups, and find the duplicate connectivity matrices and the
+    duplicate groups of each grouping (see `wonkyconn.deduplicate`). The duplicates are saved as `duplicates.tsv`
+    in the output directory, unless it is None.
+
+    Returns:
+        tuple: The fingerprint of each connectivity matrix by path, and the duplicate groups of each grouping.
+    """
+    connectivity_matrices = [
+        connectivity_matrix
+        for grouped_connectivity_matrix in groups_by_grouping
+        for group_connectivity_matrices in grouped_connectivity_matrix.values()
+        for connectivity_matrix in group_connectivity_matrices
+    ]
+    fingerprints = get_fingerprints(connectivity_matrices)
+    duplicate_matrices = find_duplicate_matrices(fingerprints)
+    duplicate_groups_by_grouping = [
+        find_duplicate_groups(index, grouped_connectivity_matrix, fingerprints) for grouped_connectivity_matrix in groups_by_grouping
+    ]
+    duplicate_group_count = sum(len(duplicate_groups) for duplicate_groups in duplicate_groups_by_grouping)
+    gc_log.info(
+        f"Found {len(duplicate_matrices)} of {len(fingerprints)} connectivity matrices and "
+        f"{duplicate_group_count} groups with the same content as another one"
+    )
+    if output_dir is not None:
+        duplicates_frame = make_duplicates_frame(duplicate_matrices, list(zip(groupings, duplicate_groups_by_grouping)))
+        duplicates_frame.to_csv(output_dir / "duplicates.tsv", sep="\t", index=False)
+    return fingerprints, duplicate_groups_by_grouping
+
+
+def evaluate_groups(
+    args: argparse.Namespace,
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    seg_to_network_blocks: dict[str, NetworkBlocks],
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    group_by: list[str],
+    edge_store: EdgeStore | None = None,
+    duplicate_groups: dict[tuple[str, ...], tuple[str, ...]] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Calculate the records of groups and save their outputs and checkpoints, as selected by the command line options.
+
+    Parameters:
+        grouped_connectivity_matrix (dict): The connectivity matrices by group, as returned by `make_groups`.
+        group_by (list[str]): The tags that the groups are defined by.
+        edge_store (EdgeStore | None, optional): The loaded connectivity matrices, if they are shared with other
+            groups or groupings. Defaults to None, which loads the connectivity matrices of each group.
+        duplicate_groups (dict | None, optional): The groups that have the same content as another group, as
+            returned by `find_duplicate_groups`. They are not evaluated, and get a copy of the results of the
+            other group. Defaults to None.
+
+    Returns:
+        list[dict[str, Any]]: The record of each group, including the group tags.
+    """
+    output_dir = args.output_dir
+    specified_atlas = list(seg_to_atlas.keys())[0]
+
+    copies: dict[tuple[str, ...], list[tuple[str, ...]]] = defaultdict(list)
+    for duplicate, original in (duplicate_groups or dict()).items():
+        if duplicate in grouped_connectivity_matrix and original in grouped_connectivity_matrix:
+            copies[original].append(duplicate)
+    copy_count = sum(len(duplicates) for duplicates in copies.values())
+    if copy_count > 0:
+        duplicates = {duplicate for duplicates in copies.values() for duplicate in duplicates}
+        grouped_connectivity_matrix = {group: c for group, c in grouped_connectivity_matrix.items() if group not in duplicates}
+
+    records: list[dict[str, Any]] = []
+    accumulators: dict[tuple[str, ...], QCFCAccumulator] = dict()
+    groups_to_load = grouped_connectivity_matrix
+    # Sparse connectivity matrices are loaded by `make_record`, because the prefetcher and the scheduler
+    # estimate the memory use of dense connectivity arrays
+    sparse_groups = {group for group, connectivity_matrices in grouped_connectivity_matrix.items() if is_sparse_group(connectivity_matrices)}
+    if args.accumulator_dir is not None:
+        if sparse_groups:
+            raise ValueError("`--accumulator-dir` is not supported for sparse connectivity matrices")
+        # Only the connectivity matrices that have not been added before need to be loaded
+        for group, connectivity_matrices in grouped_connectivity_matrix.items():
+            accumulator_path = get_accumulator_path(args.accumulator_dir, dict(zip(group_by, group)))
+            if accumulator_path.is_file():
+                saved_accumulator = QCFCAccumulator.load(accumulator_path)
+                if saved_accumulator.metric_keys != args.motion_metrics:
+                    raise ValueError(f'"{accumulator_path}" was created for the motion metrics {saved_accumulator.metric_keys}')
+                removed_paths = saved_accumulator.get_removed(connectivity_matrices)
+                if not removed_paths:
+                    accumulators[group] = saved_accumulator
+                    continue
+                # The sums would mix the removed connectivity matrices with the current cohort
+                gc_log.warning(
+                    f'"{accumulator_path}" contains {len(removed_paths)} connectivity matrices that were removed, '
+                    f'such as "{removed_paths[0]}", so the sums of group {group} are calculated again from all connectivity matrices'
+                )
+            accumulators[group] = QCFCAccumulator.empty(connectivity_matrices[0].region_count, args.motion_metrics)
+        groups_to_load = {
+            group: accumulators[group].get_new(connectivity_matrices) for group, connectivity_matrices in grouped_connectivity_matrix.items()
+        }
+
+    groups_to_load = {group: [] if group in sparse_groups else connectivity_matrices for group, connectivity_matrices in groups_to_load.items()}
+
+    results: Iterator[tuple[tuple[str, ...], tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]]]
+    if args.quick:
+        results = (
+            (
+                group,
+                make_quick_record(
+                    index,
+                    data_frame,
+                    seg_to_atlas,
+                    connectivity_matrices,
+                    args.motion_metrics,
+                    args.quick_edge_count,
+                    args.quick_subject_count,
+                ),
+            )
+            for group, connectivity_matrices in grouped_connectivity_matrix.items()
+        )
+    elif edge_store is not None:
+        results = (
+            (
+                group,
+                make_record(
+                    index,
+                    data_frame,
+                    seg_to_atlas,
+                    connectivity_matrices,
+                    args.motion_metrics,
+                    None if group in sparse_groups else edge_store.get(connectivity_matrices),
+                    leave_one_out=args.leave_one_out,
+                ),
+            )
+            for group, connectivity_matrices in grouped_connectivity_matrix.items()
+        )
+    elif args.memory_limit is None:
+        prefetcher = Prefetcher(groups_to_load, args.prefetch_memory)
+        results = (
+            (
+                group,
+                make_record(
+                    index,
+                    data_frame,
+                    seg_to_atlas,
+                    grouped_connectivity_matrix[group],
+                    args.motion_metrics,
+                    None if group in sparse_groups else connectivity_array,
+                    leave_one_out=args.leave_one_out,
+                    accumulator=accumulators.get(group),
+                ),
+            )
+            for group, _, connectivity_array in prefetcher
+        )
+    else:
+        # Groups are loaded by the scheduler, which replaces the prefetcher
+        plans = plan_groups(groups_to_load, args.memory_limit, len(args.motion_metrics), allow_batches=not args.leave_one_out)
+        scheduler = Scheduler(plans, args.memory_limit)
+        results = scheduler.run(
+            lambda plan: make_record(
+                index,
+                data_frame,
+                seg_to_atlas,
+                grouped_connectivity_matrix[plan.key],
+                args.motion_metrics,
+                leave_one_out=args.leave_one_out,
+                accumulator=accumulators.get(plan.key),
+                batch_size=plan.batch_size,
+            )
+        )
+
+    if copy_count > 0:
+        results = copy_duplicate_results(results, copies)
+
+    for group, (record, qcfc_by_metric, influence_frame) in tqdm(results, total=len(groups_to_load) + copy_count, unit="groups"):
+        group_tags = dict(zip(group_by, group))
+        accumulator = accumulators.get(group)
+        if accumulator is not None:
+            accumulator.save(get_accumulator_path(args.accumulator_dir, group_tags))
+        record.update(group_tags)
+        records.append(record)
+
+        if args.export_edges:
+            for metric_key, qcfc in qcfc_by_metric.items():
+                if len(qcfc_by_metric) > 1:
+                    save_qcfc_edges(output_dir / "edges", dict(**group_tags, metric=metric_key), qcfc)
+                else:
+                    save_qcfc_edges(output_dir / "edges", group_tags, qcfc)
+
+        if args.network_blocks:
+            network_blocks = seg_to_network_blocks[specified_atlas]
+            network_blocks_dir = output_dir / "network_blocks"
+            network_blocks_dir.mkdir(parents=True, exist_ok=True)
+            for metric_key, qcfc in qcfc_by_metric.items():
+                network_tags = dict(**group_tags, metric=metric_key) if len(qcfc_by_metric) > 1 else group_tags
+                network_blocks.calculate(qcfc).to_csv(network_blocks_dir / f"{make_file_label(network_tags)}_networks.tsv", sep="\t")
+
+        if args.report:
+            # Only the bins are kept for the report, using the first motion metric
+            qcfc = next(iter(qcfc_by_metric.values()))
+            distance_vector = seg_to_atlas[specified_atlas].get_distance_vector()
+            EdgeHistograms.calculate(qcfc, distance_vector).save(get_histograms_path(output_dir, make_file_label(group_tags)))
+
+        if influence_frame is not None:
+            influence_dir = output_dir / "influence"
+            influence_dir.mkdir(parents=True, exist_ok=True)
+            influence_frame.to_csv(influence_dir / f"{make_file_label(group_tags)}_influence.tsv", sep="\t")
+
+        # The checkpoint is written last, so that it is only there if all outputs of the group are complete.
+        # Approximate records cannot be resumed
+        if not args.quick:
+            save_records(get_checkpoint_path(output_dir, group_tags), group_by, [record])
+        progress.finish_group()
+
+    return records
+
+
+def copy_duplicate_results(
+    results: Iterator[tuple[tuple[str, ...], tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]]],
+    copies: dict[tuple[str, ...], list[tuple[str, ...]]],
+) -> Iterator[tuple[tuple[str, ...], tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]]]:
+    """
+    Follow the results of each group by copies for the groups that have the same content.
+    """
+    for group, (record, qcfc_by_metric, influence_frame) in results:
+        copied_record = dict(record)
+        yield group, (record, qcfc_by_metric, influence_frame)
+        for duplicate in copies.get(group, []):
+            yield duplicate, (dict(copied_record), qcfc_by_metric, influence_frame)
+
+
+def save_results(
+    output_dir: Path,
+    group_by: list[str],
+    records: Sequence[dict[str, Any]],
+    name: str = "metrics",
+    report: bool = False,
+) -> None:
+    """
+    Save the records of all groups as `{name}.tsv` and `{name}.png`, and optionally as an HTML report
+    `{name}.html` with the edge-level histograms that were saved for each group.
+    """
+    result_frame = make_result_frame(records, group_by)
+    result_frame.to_csv(output_dir / f"{name}.tsv", sep="\t")
+
+    plot(result_frame, group_by, output_dir, name=name)
+
+    if report:
+        histograms_by_label: dict[str, EdgeHistograms] = dict()
+        for record in records:
+            label = make_file_label({key: str(record[key]) for key in group_by})
+            histograms_path = get_histograms_path(output_dir, label)
+            if not histograms_path.is_file():
+                gc_log.warning(f'Cannot find the histograms for group "{label}" at "{histograms_path}"')
+                continue
+            histograms_by_label[label] = EdgeHistograms.load(histograms_path)
+        save_report(output_dir / f"{name}.html", result_frame, histograms_by_label)
+
+
+def save_comparison(
+    output_dir: Path,
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    group_by: list[str],
+    metric_key: str,
+    permutation_count: int,
+    memory_limit: int | None = None,
+) -> None:
+    """
+    Compare the groups as denoising strategies on the connectivity matrices that all of them share, and
+    save the strategy by strategy matrices as `comparison_{name}.tsv` (see `compare_strategies`).
+
+    Connectivity matrices are matched between the groups by all their tags except the `group_by` tags.
+    If the connectivity arrays of all groups do not fit into half of the `memory_limit`, they are saved
+    one connectivity matrix at a time to memory-mapped files in the output directory, which are deleted
+    after the comparison, and the comparison reads them in blocks of edges.
+    """
+    connectivity_matrices_by_key: list[dict[tuple[tuple[str, str], ...], ConnectivityMatrix]] = []
+    for group, connectivity_matrices in grouped_connectivity_matrix.items():
+        if is_sparse_group(connectivity_matrices):
+            raise ValueError("`--compare` is not supported for sparse connectivity matrices")
+        by_key: dict[tuple[tuple[str, str], ...], ConnectivityMatrix] = dict()
+        for connectivity_matrix in connectivity_matrices:
+            tags = index.get_tags(connectivity_matrix.path)
+            key = tuple(sorted((tag, str(value)) for tag, value in tags.items() if tag not in group_by))
+            if key in by_key:
+                raise ValueError(f'Cannot match "{connectivity_matrix.path}" between the groups, because it has the same tags as "{by_key[key].path}"')
+            by_key[key] = connectivity_matrix
+        connectivity_matrices_by_key.append(by_key)
+
+    shared_keys = sorted(set.intersection(*(set(by_key.keys()) for by_key in connectivity_matrices_by_key)))
+    gc_log.info(f"Comparing {len(grouped_connectivity_matrix)} groups on {len(shared_keys)} shared connectivity matrices")
+    aligned = [[by_key[key] for key in shared_keys] for by_key in connectivity_matrices_by_key]
+
+    motion = np.asarray([[c.metadata.get(metric_key, np.nan) for c in connectivity_matrices] for connectivity_matrices in aligned], dtype=np.float64)
+    labels = [make_file_label(dict(zip(group_by, group))) for group in grouped_connectivity_matrix.keys()]
+    subjects = get_subjects(index, aligned[0]) if aligned else []
+
+    n = get_group_region_count([connectivity_matrix for connectivity_matrices in aligned for connectivity_matrix in connectivity_matrices])
+    edge_count = n * (n - 1) // 2
+    itemsize = np.dtype(np.float64).itemsize
+    array_size = itemsize * edge_count * len(shared_keys) * len(aligned)
+    # The observed QC-FC of all edges is kept by `compare_strategies` in addition to its blocks
+    comparison_memory_limit = 2**28
+    if memory_limit is not None:
+        comparison_memory_limit = max(1, memory_limit - itemsize * edge_count * len(aligned))
+
+    with ExitStack() as stack:
+        connectivity_arrays: list[npt.NDArray[np.float64]]
+        if memory_limit is None or array_size <= comparison_memory_limit // 2:
+            connectivity_arrays = [load_connectivity_array(connectivity_matrices) for connectivity_matrices in aligned]
+            if memory_limit is not None:
+                comparison_memory_limit -= array_size
+        else:
+            gc_log.info("The connectivity matrices of the groups do not fit into the memory limit, so they are compared in blocks of edges")
+            temporary_dir = Path(stack.enter_context(TemporaryDirectory(dir=output_dir)))
+            connectivity_arrays = [
+                map_connectivity_array(connectivity_matrices, temporary_dir / f"{label}.npy") for label, connectivity_matrices in zip(labels, aligned)
+            ]
+
+        comparison = compare_strategies(
+            labels, data_frame.loc[subjects], connectivity_arrays, motion, permutation_count, memory_limit=comparison_memory_limit
+        )
+        del connectivity_arrays  # Close the memory-mapped files before they are deleted
+
+    for name, comparison_frame in comparison.to_data_frames().items():
+        comparison_frame.to_csv(output_dir / f"comparison_{name}.tsv", sep="\t")
+
 
+def get_histograms_path(output_dir: Path, label: str) -> Path:
+    return output_dir / "histograms" / f"{label}_histograms.npz"
+
+
+def get_group_signature(connectivity_matrices: Sequence[ConnectivityMatrix], snapshot: Snapshot) -> frozenset[tuple[str, Any, str]]:
+    """
+    Summarize the files and metadata of a group, so that a group needs to be evaluated again
+    exactly when its signature changes.
+
+    Returns:
+        frozenset: The path, the size and modification time of the file, and the metadata of each connectivity matrix.
+    """
+    signature: set[tuple[str, Any, str]] = set()
+    for connectivity_matrix in connectivity_matrices:
+        hdf5_path = split_hdf5_path(connectivity_matrix.path)
+        file_path = hdf5_path[0] if hdf5_path is not None else connectivity_matrix.path
+        metadata = json.dumps(connectivity_matrix.metadata, sort_keys=True, default=str)
+        signature.add((str(connectivity_matrix.path), snapshot.get(file_path), metadata))
+    return frozenset(signature)
+
+
+def watch_groups(
+    args: argparse.Namespace,
+    directory_watcher: DirectoryWatcher,
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    seg_to_network_blocks: dict[str, NetworkBlocks],
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    group_by: list[str],
+    records: Sequence[dict[str, Any]],
+    stop: threading.Event | None = None,
+) -> None:
+    """
+    Update the results whenever connectivity matrices or sidecar files are added, changed or removed.
+
+    The index is updated for the changed files only. Groups are only evaluated again if their
+    connectivity matrices, files or metadata changed (see `get_group_signature`). `metrics.tsv` and
+    `metrics.png` are saved once for each batch of changes, as reported by the `directory_watcher`.
+    Groups that cannot be evaluated yet, for example because a file is still being written, are
+    tried again after the next change.
+
+    Parameters:
+        grouped_connectivity_matrix (dict): The groups that the `records` were calculated for.
+        group_by (list[str]): The tags that the groups are defined by.
+        records (Sequence[dict[str, Any]]): The records of all groups.
+        stop (threading.Event | None, optional): Stop watching when this event is set. Defaults to None,
+            which watches until the process is interrupted.
+    """
+    output_dir = args.output_dir
+    specified_atlas = list(seg_to_atlas.keys())[0]
+
+    records_by_group = {tuple(str(record[key]) for key in group_by): record for record in records}
+    signatures = {
+        group: get_group_signature(connectivity_matrices, directory_watcher.snapshot)
+        for group, connectivity_matrices in grouped_connectivity_matrix.items()
+    }
+    phenotypes_mtime = Path(args.phenotypes).stat().st_mtime_ns
+
+    gc_log.info(f'Watching "{directory_watcher.root}" for changes')
+    try:
+        progress.set_stage("watching")
+        while (changes := directory_watcher.wait(stop)) is not None:
+            changed_paths, removed_paths = changes
+            progress.set_stage("evaluating")
+            gc_log.info(f"Found {len(changed_paths)} added or changed and {len(removed_paths)} removed files")
+            index.update(changed_paths, removed_paths)
+
+            if Path(args.phenotypes).stat().st_mtime_ns != phenotypes_mtime:
+                gc_log.info("The phenotypes file changed, so all groups will be evaluated again")
+                phenotypes_mtime = Path(args.phenotypes).stat().st_mtime_ns
+                data_frame = load_data_frame(args.phenotypes)
+                if args.accumulator_dir is not None:
+                    for group in signatures:
+                        get_accumulator_path(args.accumulator_dir, dict(zip(group_by, group))).unlink(missing_ok=True)
+                signatures.clear()
+
+            try:
+                grouped_connectivity_matrix = make_groups(index, group_by, specified_atlas)
+            except ValueError:
+                grouped_connectivity_matrix = dict()
+
+            for group in signatures.keys() - grouped_connectivity_matrix.keys():
+                gc_log.info(f"Group {group} was removed")
+                del signatures[group]
+                records_by_group.pop(group, None)
+                get_checkpoint_path(output_dir, dict(zip(group_by, group))).unlink(missing_ok=True)
+
+            for group, connectivity_matrices in grouped_connectivity_matrix.items():
+                signature = get_group_signature(connectivity_matrices, directory_watcher.snapshot)
+                previous_signature = signatures.get(group)
+                if signature == previous_signature:
+                    continue
+                if args.accumulator_dir is not None and previous_signature is not None and previous_signature - signature:
+                    # Connectivity matrices that were changed or removed cannot be subtracted from the sums
+                    get_accumulator_path(args.accumulator_dir, dict(zip(group_by, group))).unlink(missing_ok=True)
+                progress.add_groups(1)
+                try:
+                    (record,) = evaluate_groups(args, index, data_frame, seg_to_atlas, seg_to_network_blocks, {group: connectivity_matrices}, group_by)
+                except Exception as e:
+                    gc_log.warning(f"Could not evaluate group {group}, will try again after the next change: {e}")
+                    progress.add_groups(-1)
+                    continue
+                records_by_group[group] = record
+                signatures[group] = signature
+
+            if records_by_group:
+                progress.set_stage("saving")
+                save_results(output_dir, group_by, list(records_by_group.values()), report=args.report)
+            progress.set_stage("watching")
+    except KeyboardInterrupt:
+        pass
+
+
+def merge(args: argparse.Namespace) -> None:
+    """
+    Combine the partial records written by sharded runs into `metrics.tsv` and `metrics.png`.
+    """
+    set_verbosity(args.verbosity)
+    gc_log.info(vars(args))
+
+    output_dir = args.output_dir
+    shard_paths = sorted((output_dir / "shards").glob("shard-*-of-*.json"))
+    if not shard_paths:
+        raise ValueError(f'No shards found in "{output_dir / "shards"}"')
+
+    shard_counts: set[int] = set()
+    shard_indices: set[int] = set()
+    group_bys: set[tuple[str, ...]] = set()
+    records: list[dict[str, Any]] = []
+    for shard_path in shard_paths:
+        _, shard_index_str, _, shard_count_str = shard_path.stem.split("-")
+        shard_indices.add(int(shard_index_str))
+        shard_counts.add(int(shard_count_str))
+
+        group_by, shard_records = load_records(shard_path)
+        group_bys.add(tuple(group_by))
+        records.extend(shard_records)
+
+    if len(shard_counts) != 1:
+        raise ValueError(f"Shards from runs with different shard counts cannot be merged: {sorted(shard_counts)}")
+    (shard_count,) = shard_counts
+    missing_shards = set(range(1, shard_count + 1)) - shard_indices
+    if missing_shards:
+        raise ValueError(f"Missing shards {sorted(missing_shards)} of {shard_count}")
+    if len(group_bys) != 1:
+        raise ValueError(f"Shards from runs with different `--group-by` values cannot be merged: {sorted(group_bys)}")
+    (group_by_tuple,) = group_bys
+    group_by = list(group_by_tuple)
+
+    result_frame = make_result_frame(records, group_by)
+    result_frame.to_csv(output_dir / "metrics.tsv", sep="\t")
+
+    plot(result_frame, group_by, output_dir)
+
+
+def make_groups(
+    index: BIDSIndex,
+    group_by: list[str],
+    specified_atlas: str,
+) -> dict[tuple[str, ...], list[ConnectivityMatrix]]:
+    """
+    Find the connectivity matrices in the index and group them by the values of the `group_by` tags.
+
+    The groups and the connectivity matrices in each group are sorted, so that
+    the result does not depend on the order in which the files were found.
+    """
     grouped_connectivity_matrix: defaultdict[tuple[str, ...], list[ConnectivityMatrix]] = defaultdict(list)
 
-    for timeseries_path in index.get(suffix="timeseries", extension=".tsv"):
+    timeseries_paths: set[Path] = set()
+    for extension in (".tsv", *hdf5_extensions):
+        timeseries_paths |= index.get(suffix="timeseries", extension=extension)
+
+    for timeseries_path in timeseries_paths:
         query = dict(**index.get_tags(timeseries_path))
         del query["suffix"]
+        relmat_paths = index.get(suffix="relmat", **query)
+        if query["extension"] == ".tsv":
+            # Sparse connectivity matrices are stored next to the time series
+            for extension in sparse_extensions:
+                relmat_paths |= index.get(suffix="relmat", **(query | dict(extension=extension)))
 
         metadata = index.get_metadata(timeseries_path)
         if not metadata:
@@ -64,7 +832,7 @@ def workflow(args: argparse.Namespace) -> None:
             continue
 
         # Seann: Filter connectivity matrices by atlas type
-        for relmat_path in index.get(suffix="relmat", **query):
+        for relmat_path in relmat_paths:
             # Filter matrices by atlas type
             matrix_seg = index.get_tag_value(relmat_path, "seg")
             if matrix_seg != specified_atlas:
@@ -80,55 +848,292 @@ def workflow(args: argparse.Namespace) -> None:
     if not grouped_connectivity_matrix:
         raise ValueError("No groups found")
 
-    records: list[dict[str, Any]] = []
-    for group, connectivity_matrices in tqdm(grouped_connectivity_matrix.items(), unit="groups"):
-        record = make_record(index, data_frame, seg_to_atlas, connectivity_matrices)
-        record.update(dict(zip(group_by, group)))
-        records.append(record)
+    return {
+        group: sorted(connectivity_matrices, key=lambda connectivity_matrix: str(connectivity_matrix.path))
+        for group, connectivity_matrices in sorted(grouped_connectivity_matrix.items())
+    }
 
-    result_frame = pd.DataFrame.from_records(records, index=group_by)
-    result_frame.to_csv(output_dir / "metrics.tsv", sep="\t")
 
-    plot(result_frame, group_by, output_dir)
+def select_shard(
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    shard_index: int,
+    shard_count: int,
+) -> dict[tuple[str, ...], list[ConnectivityMatrix]]:
+    """
+    Select the groups that belong to a shard. Groups are assigned to the shards in turn,
+    so the partition only depends on the sorted group keys.
+
+    Parameters:
+        grouped_connectivity_matrix (dict): The connectivity matrices by group, as returned by `make_groups`.
+        shard_index (int): The shard to select, starting at one.
+        shard_count (int): The total number of shards.
+    """
+    return {
+        group: connectivity_matrices
+        for k, (group, connectivity_matrices) in enumerate(grouped_connectivity_matrix.items())
+        if k % shard_count == shard_index - 1
+    }
+
+
+def get_shard_path(output_dir: Path, shard_index: int, shard_count: int) -> Path:
+    return output_dir / "shards" / f"shard-{shard_index}-of-{shard_count}.json"
+
+
+def get_checkpoint_path(output_dir: Path, group_tags: dict[str, str]) -> Path:
+    return output_dir / "records" / f"{make_file_label(group_tags)}.json"
+
+
+def resume_groups(
+    output_dir: Path,
+    group_by: list[str],
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    records: list[dict[str, Any]],
+) -> dict[tuple[str, ...], list[ConnectivityMatrix]]:
+    """
+    Skip the groups that were completed by a previous run, as recorded by their checkpoints.
+
+    Parameters:
+        output_dir (Path): The output directory of the previous run.
+        group_by (list[str]): The tags that the groups are defined by.
+        grouped_connectivity_matrix (dict): The connectivity matrices by group, as returned by `make_groups`.
+        records (list[dict[str, Any]]): The records of the completed groups are appended to this list.
+
+    Returns:
+        dict: The groups that still need to be evaluated.
+    """
+    remaining: dict[tuple[str, ...], list[ConnectivityMatrix]] = dict()
+    for group, connectivity_matrices in grouped_connectivity_matrix.items():
+        checkpoint_path = get_checkpoint_path(output_dir, dict(zip(group_by, group)))
+        if checkpoint_path.is_file():
+            checkpoint_group_by, checkpoint_records = load_records(checkpoint_path)
+            if checkpoint_group_by == group_by:
+                records.extend(checkpoint_records)
+                continue
+        remaining[group] = connectivity_matrices
+    gc_log.info(f"Resuming with {len(remaining)} of {len(grouped_connectivity_matrix)} groups left to evaluate")
+    return remaining
+
+
+def get_accumulator_path(accumulator_dir: Path, group_tags: dict[str, str]) -> Path:
+    return accumulator_dir / f"{make_file_label(group_tags)}_accumulator.npz"
+
+
+def get_new_connectivity_matrices(
+    accumulator_dir: Path,
+    grouped_connectivity_matrix: dict[tuple[str, ...], list[ConnectivityMatrix]],
+    group_by: list[str],
+) -> dict[tuple[str, ...], list[ConnectivityMatrix]]:
+    """
+    Get the connectivity matrices of each group that are not in its saved accumulator yet. Only these are
+    read with the phenotypes, so the subjects that were added before do not need to be in the phenotypes
+    file anymore. If connectivity matrices were removed from a group, its sums are calculated again, so
+    all of its connectivity matrices are new (see `evaluate_groups`).
+    """
+    new_connectivity_matrices: dict[tuple[str, ...], list[ConnectivityMatrix]] = dict()
+    for group, connectivity_matrices in grouped_connectivity_matrix.items():
+        accumulator_path = get_accumulator_path(accumulator_dir, dict(zip(group_by, group)))
+        if not accumulator_path.is_file():
+            new_connectivity_matrices[group] = connectivity_matrices
+            continue
+        added_paths = set(QCFCAccumulator.load_paths(accumulator_path))
+        paths = {str(connectivity_matrix.path) for connectivity_matrix in connectivity_matrices}
+        if added_paths - paths:
+            new_connectivity_matrices[group] = connectivity_matrices
+            continue
+        new_connectivity_matrices[group] = [c for c in connectivity_matrices if str(c.path) not in added_paths]
+    return new_connectivity_matrices
+
+
+def get_subjects(index: BIDSIndex, connectivity_matrices: Sequence[ConnectivityMatrix]) -> list[str]:
+    """
+    Get the participant ID of each connectivity matrix, as used in the phenotypes file.
+    """
+    return [get_subject(index, connectivity_matrix) for connectivity_matrix in connectivity_matrices]
 
 
 def make_record(
     index: BIDSIndex,
     data_frame: pd.DataFrame,
     seg_to_atlas: dict[str, Atlas],
-    connectivity_matrices: list[ConnectivityMatrix],
-) -> dict[str, Any]:
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    metric_keys: list[str],
+    connectivity_array: npt.NDArray[np.float64] | None = None,
+    leave_one_out: bool = False,
+    accumulator: QCFCAccumulator | None = None,
+    batch_size: int | None = None,
+) -> tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]:
+    """
+    Calculate the metrics for a group of connectivity matrices, with the strategy that fits the group
+    and the options. All strategies give the same record for the same connectivity matrices.
+
+    - Sparse connectivity matrices are loaded and evaluated together (see `make_sparse_record`).
+    - Without an `accumulator` or a `batch_size`, the dense connectivity matrices are evaluated
+      together (see `make_dense_record`).
+    - Otherwise they are added to the `accumulator`, or to a new one, `batch_size` at a time
+      (see `make_accumulated_record`).
 
-    # seann: Add debugging to see what the atlas dictionary contains
-    gc_log.info(f"Atlas dictionary contains: {list(seg_to_atlas.keys())}")
+    The `connectivity_array` is only used for dense connectivity matrices, and `leave_one_out`
+    only without an accumulator. The options that cannot be combined are rejected by the
+    command line (see `wonkyconn.run.get_argument_problems`).
+    """
+    gc_log.debug(f"Atlas dictionary contains: {list(seg_to_atlas.keys())}")
 
-    # seann: added sub- tag when looking up subjects only if sub- is not already present
-    seg_subjects = []
-    for c in connectivity_matrices:
-        sub = index.get_tag_value(c.path, "sub")  # returns either "2" or "sub-2"
-        if not str(sub).startswith("sub-"):
-            sub = f"sub-{sub}"
-        seg_subjects.append(sub)
+    if is_sparse_group(connectivity_matrices):
+        return make_sparse_record(index, data_frame, seg_to_atlas, connectivity_matrices, metric_keys, leave_one_out)
+    if accumulator is None and batch_size is None:
+        return make_dense_record(index, data_frame, seg_to_atlas, connectivity_matrices, metric_keys, connectivity_array, leave_one_out)
+    if accumulator is None:
+        accumulator = QCFCAccumulator.empty(connectivity_matrices[0].region_count, metric_keys)
+    return make_accumulated_record(index, data_frame, seg_to_atlas, connectivity_matrices, accumulator, connectivity_array, batch_size)
 
-    seg_data_frame = data_frame.loc[seg_subjects]
-    qcfc = calculate_qcfc(seg_data_frame, connectivity_matrices)
 
+def make_sparse_record(
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    metric_keys: list[str],
+    leave_one_out: bool = False,
+) -> tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]:
+    """
+    Calculate the metrics for a group of sparse connectivity matrices, which are always loaded
+    here (see `SparseConnectivityArray`).
+    """
+    atlas = get_group_atlas(index, seg_to_atlas, connectivity_matrices)
+    metadata = [connectivity_matrix.metadata for connectivity_matrix in connectivity_matrices]
+    seg_subjects = get_subjects(index, connectivity_matrices)
+    evaluation = evaluate(
+        load_sparse_connectivity_array(connectivity_matrices),
+        {metric_key: [m.get(metric_key, np.nan) for m in metadata] for metric_key in metric_keys},
+        data_frame.loc[seg_subjects],
+        atlas=atlas,
+        metadata=metadata,
+        leave_one_out=leave_one_out,
+    )
+    return evaluation.record, evaluation.qcfc, evaluation.influence
+
+
+def make_dense_record(
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    metric_keys: list[str],
+    connectivity_array: npt.NDArray[np.float64] | None = None,
+    leave_one_out: bool = False,
+) -> tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]:
+    """
+    Calculate the metrics for a group of dense connectivity matrices that are all in memory at the same time.
+    The `connectivity_array` is loaded if it is not given, and is overwritten.
+    """
+    atlas = get_group_atlas(index, seg_to_atlas, connectivity_matrices)
+    metadata = [connectivity_matrix.metadata for connectivity_matrix in connectivity_matrices]
+    seg_subjects = get_subjects(index, connectivity_matrices)
+    if connectivity_array is None:
+        connectivity_array = load_connectivity_array(connectivity_matrices)
+    evaluation = evaluate(
+        connectivity_array,
+        {metric_key: [m.get(metric_key, np.nan) for m in metadata] for metric_key in metric_keys},
+        data_frame.loc[seg_subjects],
+        atlas=atlas,
+        metadata=metadata,
+        subjects=seg_subjects,
+        leave_one_out=leave_one_out,
+        overwrite=True,
+    )
+    return evaluation.record, evaluation.qcfc, evaluation.influence
+
+
+def make_accumulated_record(
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    accumulator: QCFCAccumulator,
+    connectivity_array: npt.NDArray[np.float64] | None = None,
+    batch_size: int | None = None,
+) -> tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]:
+    """
+    Calculate the metrics for a group of dense connectivity matrices from the sums of an accumulator.
+
+    Only the connectivity matrices that the `accumulator` does not contain yet are added to it, and
+    `connectivity_array` only needs to contain those. If a `batch_size` is given, they are added that
+    many at a time, and are loaded by batch unless they are in `connectivity_array`, so that the whole
+    group never needs to be in memory.
+    """
+    atlas = get_group_atlas(index, seg_to_atlas, connectivity_matrices)
+    new_connectivity_matrices = accumulator.get_new(connectivity_matrices)
+    step = batch_size or max(1, len(new_connectivity_matrices))
+    for start in range(0, len(new_connectivity_matrices), step):
+        batch = new_connectivity_matrices[start : start + step]
+        batch_data_frame = data_frame.loc[get_subjects(index, batch)]
+        accumulator.add(batch_data_frame, batch, None if connectivity_array is None else connectivity_array[:, start : start + step])
+    qcfc_by_metric = accumulator.get_results()
+
+    record = summarize_qcfc(qcfc_by_metric, atlas)
+    record.update(calculate_degrees_of_freedom_loss(connectivity_matrices)._asdict())
+    return record, qcfc_by_metric, None
+
+
+def get_group_atlas(index: BIDSIndex, seg_to_atlas: dict[str, Atlas], connectivity_matrices: Sequence[ConnectivityMatrix]) -> Atlas:
     (seg,) = index.get_tag_values("seg", {c.path for c in connectivity_matrices})
-    atlas = seg_to_atlas[seg]
+    return seg_to_atlas[seg]
+
+
+def make_quick_record(
+    index: BIDSIndex,
+    data_frame: pd.DataFrame,
+    seg_to_atlas: dict[str, Atlas],
+    connectivity_matrices: Sequence[ConnectivityMatrix],
+    metric_keys: list[str],
+    edge_count: int,
+    subject_count: int | None = None,
+) -> tuple[dict[str, Any], dict[str, QCFCResult], pd.DataFrame | None]:
+    """
+    Approximate the metrics for a group of connectivity matrices from a random sample of edges
+    and optionally of subjects, with confidence bounds (see `wonkyconn.quick`).
+    """
+    atlas = get_group_atlas(index, seg_to_atlas, connectivity_matrices)
 
-    record = dict(
-        median_absolute_qcfc=calculate_median_absolute(qcfc.correlation),
-        percentage_significant_qcfc=calculate_qcfc_percentage(qcfc),
-        distance_dependence=calculate_distance_dependence(qcfc, atlas),
-        **calculate_degrees_of_freedom_loss(connectivity_matrices)._asdict(),
+    seg_subjects = get_subjects(index, connectivity_matrices)
+    if subject_count is not None:
+        sample = sample_subjects(seg_subjects, subject_count)
+        connectivity_matrices = [connectivity_matrices[k] for k in sample]
+        seg_subjects = [seg_subjects[k] for k in sample]
+    metadata = [connectivity_matrix.metadata for connectivity_matrix in connectivity_matrices]
+
+    edge_indices = sample_edges(get_group_region_count(connectivity_matrices), edge_count)
+    evaluation = evaluate(
+        load_edge_sample(connectivity_matrices, edge_indices),
+        {metric_key: [m.get(metric_key, np.nan) for m in metadata] for metric_key in metric_keys},
+        data_frame.loc[seg_subjects],
+        atlas=atlas,
+        metadata=metadata,
     )
+    record = evaluation.record
+    record.update(calculate_bounds(evaluation.qcfc, atlas))
+    record.update(quick_edge_count=int(edge_indices.size), quick_subject_count=len(set(seg_subjects)))
+    return record, evaluation.qcfc, None
+
 
-    return record
+def load_network_blocks(args: argparse.Namespace) -> dict[str, NetworkBlocks]:
+    """
+    Load the networks of each atlas from the label files given by `--seg-to-labels`,
+    or from the label files next to the atlas files.
+    """
+    seg_to_label_path = {seg: Path(label_path_str) for seg, label_path_str in args.seg_to_labels}
+    seg_to_network_blocks: dict[str, NetworkBlocks] = dict()
+    for seg, atlas_path_str in args.seg_to_atlas:
+        label_path = seg_to_label_path.get(seg, get_label_path(Path(atlas_path_str)))
+        if not label_path.is_file():
+            raise ValueError(f'Cannot find the label file for atlas "{seg}" at "{label_path}". Use `--seg-to-labels` to specify it.')
+        seg_to_network_blocks[seg] = NetworkBlocks.from_region_networks(load_region_networks(label_path))
+    return seg_to_network_blocks
 
 
-def load_data_frame(args: argparse.Namespace) -> pd.DataFrame:
+def load_data_frame(phenotypes: str | Path) -> pd.DataFrame:
     data_frame = pd.read_csv(
-        args.phenotypes,
+        phenotypes,
         sep="\t",
         index_col="participant_id",
         dtype={"participant_id": str},